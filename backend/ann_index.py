@@ -0,0 +1,377 @@
+import logging
+import threading
+import numpy as np
+from sharded_index import ShardedIndex
+
+# Approximate nearest-neighbour indexes layered over a FaceGallery.
+#
+# Every index reads its vectors from the gallery and catches up on rows the
+# gallery gained since the last query, so registrations only ever need to
+# call gallery.add(). Search results have the same shape as
+# FaceGallery.search(): a list of (user_id, distance) pairs, best first.
+
+logger = logging.getLogger(__name__)
+
+
+def _sync_for_search(index):
+    # Bring index up to date before a search. Returns False without waiting
+    # while another thread runs its first sync (training or encoding a large
+    # gallery, e.g. in the background at startup), so the search can answer
+    # with an exact scan meanwhile
+    if not index._lock.acquire(blocking=index._synced):
+        return False
+    try:
+        index.sync()
+    finally:
+        index._lock.release()
+    return True
+
+
+class FlatIndex:
+    # Exact brute-force scan, the baseline every other index is measured against
+
+    def __init__(self, gallery):
+        self.gallery = gallery
+
+    def __len__(self):
+        return len(self.gallery)
+
+    def sync(self):
+        pass
+
+    def search(self, encoding, top_k=1):
+        return self.gallery.search(encoding, top_k=top_k)
+
+
+def _sq_distances(x, centroids, centroid_sq_norms=None):
+    # Squared distances between every row of x and every centroid
+    if centroid_sq_norms is None:
+        centroid_sq_norms = np.einsum('ij,ij->i', centroids, centroids)
+    x_sq_norms = np.einsum('ij,ij->i', x, x)[:, None]
+    return x_sq_norms - 2.0 * (x @ centroids.T) + centroid_sq_norms[None, :]
+
+
+def _assign(x, centroids, chunk_size=65536):
+    # Index of the nearest centroid for every row of x
+    centroid_sq_norms = np.einsum('ij,ij->i', centroids, centroids)
+    labels = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), chunk_size):
+        chunk = x[start:start + chunk_size]
+        labels[start:start + chunk_size] = np.argmin(
+            _sq_distances(chunk, centroids, centroid_sq_norms), axis=1)
+    return labels
+
+
+def _kmeans(x, k, iterations, rng):
+    # Plain Lloyd's k-means; empty clusters are re-seeded from random points
+    x = np.ascontiguousarray(x, dtype=np.float32)
+    centroids = x[rng.choice(len(x), size=k, replace=len(x) < k)].copy()
+    for _ in range(iterations):
+        labels = _assign(x, centroids)
+        counts = np.bincount(labels, minlength=k)
+        order = np.argsort(labels, kind='stable')
+        present = np.flatnonzero(counts)
+        offsets = np.concatenate([[0], np.cumsum(counts[present])[:-1]])
+        centroids[present] = np.add.reduceat(x[order], offsets, axis=0) / counts[present, None]
+        empty = counts == 0
+        if empty.any():
+            centroids[empty] = x[rng.choice(len(x), size=int(empty.sum()))]
+    return centroids
+
+
+class IVFPQIndex:
+    # Inverted file over a coarse k-means quantizer with product-quantized
+    # residuals.
+    #
+    # Each encoding is filed under its nearest coarse centroid and stored as
+    # m one-byte codes of its residual. A query probes the nprobe closest
+    # lists, ranks their entries with asymmetric distance lookup tables and
+    # re-ranks the best `rerank` candidates with exact distances from the
+    # gallery. nprobe and rerank trade recall for latency.
+    #
+    # Until the gallery holds enough encodings to train the quantizers the
+    # index answers with an exact scan.
+
+    def __init__(self, gallery, nlist=0, m=16, nprobe=16, rerank=128,
+                 min_train_size=20000, max_train_size=50000,
+                 max_pq_train_size=16384, kmeans_iterations=10, seed=0):
+        if gallery.dim % m != 0:
+            raise ValueError(f'Encoding dimension {gallery.dim} is not divisible by m={m}')
+        self.gallery = gallery
+        self.nlist = nlist
+        self.m = m
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self.min_train_size = min_train_size
+        self.max_train_size = max_train_size
+        self.max_pq_train_size = max_pq_train_size
+        self.kmeans_iterations = kmeans_iterations
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.RLock()
+        self._coarse = None
+        self._codebooks = None
+        self._list_rows = []
+        self._list_codes = []
+        self._indexed = 0
+        self._synced = False
+
+    def __len__(self):
+        return len(self.gallery)
+
+    @property
+    def is_trained(self):
+        return self._coarse is not None
+
+    def train(self):
+        with self._lock:
+            size = len(self.gallery)
+            _, encodings = self.gallery.rows(0, size)
+            sample = encodings
+            if size > self.max_train_size:
+                sample = encodings[self._rng.choice(size, self.max_train_size, replace=False)]
+            nlist = self.nlist or int(np.clip(4 * np.sqrt(size), 16, 4096))
+            logger.info("Training IVF-PQ index on %d of %d encodings (nlist=%d, m=%d)",
+                        len(sample), size, nlist, self.m)
+
+            coarse = _kmeans(sample, nlist, self.kmeans_iterations, self._rng)
+            pq_sample = sample[:self.max_pq_train_size]
+            residuals = pq_sample - coarse[_assign(pq_sample, coarse)]
+            sub_dim = self.gallery.dim // self.m
+            codebooks = np.empty((self.m, 256, sub_dim), dtype=np.float32)
+            for j in range(self.m):
+                codebooks[j] = _kmeans(residuals[:, j * sub_dim:(j + 1) * sub_dim],
+                                       256, self.kmeans_iterations, self._rng)
+
+            self._coarse = coarse
+            self._codebooks = codebooks
+            self._list_rows = [np.empty(0, dtype=np.int64) for _ in range(nlist)]
+            self._list_codes = [np.empty((0, self.m), dtype=np.uint8) for _ in range(nlist)]
+            self._indexed = 0
+            self._insert_rows(0, size)
+
+    def _encode(self, residuals):
+        sub_dim = self.gallery.dim // self.m
+        codes = np.empty((len(residuals), self.m), dtype=np.uint8)
+        for j in range(self.m):
+            codes[:, j] = _assign(residuals[:, j * sub_dim:(j + 1) * sub_dim], self._codebooks[j])
+        return codes
+
+    def _insert_rows(self, start, end):
+        _, encodings = self.gallery.rows(start, end)
+        if len(encodings) == 0:
+            return
+        labels = _assign(encodings, self._coarse)
+        codes = self._encode(encodings - self._coarse[labels])
+        rows = np.arange(start, start + len(encodings), dtype=np.int64)
+        order = np.argsort(labels, kind='stable')
+        boundaries = np.flatnonzero(np.diff(labels[order])) + 1
+        for group in np.split(order, boundaries):
+            list_id = labels[group[0]]
+            self._list_rows[list_id] = np.concatenate([self._list_rows[list_id], rows[group]])
+            self._list_codes[list_id] = np.concatenate([self._list_codes[list_id], codes[group]])
+        self._indexed = start + len(encodings)
+
+    def sync(self):
+        # Train once the gallery is large enough, then file any rows appended
+        # to the gallery since the last call
+        with self._lock:
+            size = len(self.gallery)
+            if not self.is_trained:
+                if size >= self.min_train_size:
+                    self.train()
+            elif size > self._indexed:
+                self._insert_rows(self._indexed, size)
+            self._synced = True
+
+    def _candidates(self, query):
+        # Gallery rows of the `rerank` best entries by approximate distance
+        coarse_dist = _sq_distances(query[None, :], self._coarse)[0]
+        nprobe = min(self.nprobe, len(self._coarse))
+        probes = np.argpartition(coarse_dist, nprobe - 1)[:nprobe]
+        sub_dim = self.gallery.dim // self.m
+
+        # Lookup tables of squared distances from the query residual in each
+        # probed list to every sub-centroid: shape (nprobe, m, 256)
+        residuals = (query[None, :] - self._coarse[probes]).reshape(nprobe, self.m, 1, sub_dim)
+        tables = np.sum((self._codebooks[None] - residuals) ** 2, axis=3)
+
+        with self._lock:
+            rows = [self._list_rows[list_id] for list_id in probes]
+            codes = [self._list_codes[list_id] for list_id in probes]
+        owners = np.repeat(np.arange(nprobe), [len(r) for r in rows])
+        if len(owners) == 0:
+            return np.empty(0, dtype=np.int64)
+        rows = np.concatenate(rows)
+        codes = np.concatenate(codes)
+        approx = tables[owners[:, None], np.arange(self.m)[None, :], codes].sum(axis=1)
+        # Superseded rows must not take the place of live candidates
+        approx[self.gallery.superseded(rows)] = np.inf
+        if len(rows) > self.rerank:
+            rows = rows[np.argpartition(approx, self.rerank - 1)[:self.rerank]]
+        return rows
+
+    def search(self, encoding, top_k=1):
+        if top_k <= 0 or len(self.gallery) == 0:
+            return []
+        if not _sync_for_search(self) or not self.is_trained:
+            return self.gallery.search(encoding, top_k=top_k)
+
+        query = np.asarray(encoding, dtype=np.float32).reshape(self.gallery.dim)
+        rows = self._candidates(query)
+        if len(rows) == 0:
+            return []
+        ids, dist = self.gallery.row_distances(query, rows)
+        order = np.argsort(dist, kind='stable')[:top_k]
+        return [(ids[i], float(dist[i])) for i in order if np.isfinite(dist[i])]
+
+
+class QuantizedIndex:
+    # Exhaustive scan over a compact copy of the gallery.
+    #
+    # 'float16' halves the 4 bytes per dimension of the float32 gallery;
+    # 'int8' stores one byte per dimension, each dimension scalar-quantized
+    # with its own offset and scale fitted on the gallery (values outside
+    # the fitted range are clipped). Distances are computed on the compact
+    # codes one chunk at a time, so the full-precision rows are only read
+    # for the `rerank` best candidates, which are re-scored exactly from the
+    # gallery. A rerank of 0 returns the approximate distances as they are.
+    # NumPy widens float16 slowly, so 'float16' saves memory at the cost of
+    # scan time while 'int8' scans about as fast as the float32 gallery.
+    #
+    # int8 fits its scales once the gallery holds min_train_size encodings
+    # and answers with an exact scan until then.
+
+    PRECISIONS = ('float16', 'int8')
+
+    def __init__(self, gallery, precision='int8', rerank=32, min_train_size=1000,
+                 margin=0.1, chunk_size=4096):
+        if precision not in self.PRECISIONS:
+            raise ValueError(f"Unknown precision '{precision}'; expected one of {', '.join(self.PRECISIONS)}")
+        self.gallery = gallery
+        self.precision = precision
+        self.rerank = rerank
+        self.min_train_size = min_train_size
+        self.margin = margin
+        self.chunk_size = chunk_size
+        self._lock = threading.RLock()
+        self._offset = None
+        self._scale = None
+        self._codes = np.empty((0, gallery.dim), dtype=np.float16 if precision == 'float16' else np.int8)
+        self._sq_norms = np.empty(0, dtype=np.float32)
+        self._indexed = 0
+        self._synced = False
+        if precision == 'float16':
+            self._offset = np.zeros(gallery.dim, dtype=np.float32)
+            self._scale = np.ones(gallery.dim, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.gallery)
+
+    @property
+    def is_trained(self):
+        return self._scale is not None
+
+    @property
+    def nbytes(self):
+        # Memory held by the codes and their norms
+        return self._codes[:self._indexed].nbytes + self._sq_norms[:self._indexed].nbytes
+
+    def train(self):
+        # Fit per-dimension int8 ranges on the encodings stored so far
+        with self._lock:
+            _, encodings = self.gallery.rows(0, len(self.gallery))
+            low = encodings.min(axis=0)
+            high = encodings.max(axis=0)
+            padding = (high - low) * self.margin
+            low, high = low - padding, high + padding
+            self._offset = ((low + high) / 2.0).astype(np.float32)
+            self._scale = np.maximum((high - low) / 254.0, 1e-8).astype(np.float32)
+            logger.info("Fitted int8 quantization on %d encodings", len(encodings))
+
+    def encode(self, encodings):
+        encodings = np.asarray(encodings, dtype=np.float32)
+        if self.precision == 'float16':
+            return encodings.astype(np.float16)
+        return np.clip(np.rint((encodings - self._offset) / self._scale), -127, 127).astype(np.int8)
+
+    def decode(self, codes):
+        return self._offset + codes.astype(np.float32) * self._scale
+
+    def _insert_rows(self, start, end):
+        _, encodings = self.gallery.rows(start, end)
+        end = start + len(encodings)
+        if end > len(self._codes):
+            capacity = max(end, 2 * len(self._codes), 1024)
+            codes = np.empty((capacity, self.gallery.dim), dtype=self._codes.dtype)
+            sq_norms = np.empty(capacity, dtype=np.float32)
+            codes[:start] = self._codes[:start]
+            sq_norms[:start] = self._sq_norms[:start]
+            self._codes, self._sq_norms = codes, sq_norms
+        for chunk_start in range(0, len(encodings), self.chunk_size):
+            chunk = self.encode(encodings[chunk_start:chunk_start + self.chunk_size])
+            decoded = self.decode(chunk)
+            rows = slice(start + chunk_start, start + chunk_start + len(chunk))
+            self._codes[rows] = chunk
+            self._sq_norms[rows] = np.einsum('ij,ij->i', decoded, decoded)
+        self._indexed = end
+
+    def sync(self):
+        # Fit the int8 scales once the gallery is large enough, then encode
+        # any rows appended to the gallery since the last call
+        with self._lock:
+            size = len(self.gallery)
+            if not self.is_trained and size >= self.min_train_size:
+                self.train()
+            if self.is_trained and size > self._indexed:
+                self._insert_rows(self._indexed, size)
+            self._synced = True
+
+    def approximate_distances(self, encoding):
+        # Squared distances from one query to every indexed row, computed on
+        # the codes as ||x||^2 - 2 (offset + scale * code) . q + ||q||^2
+        query = np.asarray(encoding, dtype=np.float32).reshape(self.gallery.dim)
+        with self._lock:
+            codes = self._codes[:self._indexed]
+            sq_norms = self._sq_norms[:self._indexed]
+            scaled_query = self._scale * query
+            base = float(np.dot(self._offset, query))
+        dots = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), self.chunk_size):
+            dots[start:start + self.chunk_size] = codes[start:start + self.chunk_size].astype(np.float32) @ scaled_query
+        sq_dist = sq_norms - 2.0 * (dots + base) + np.dot(query, query)
+        return np.maximum(sq_dist, 0.0, out=sq_dist)
+
+    def search(self, encoding, top_k=1):
+        if top_k <= 0 or len(self.gallery) == 0:
+            return []
+        if not _sync_for_search(self) or not self.is_trained:
+            return self.gallery.search(encoding, top_k=top_k)
+
+        sq_dist = self.approximate_distances(encoding)
+        # Superseded rows must not take the place of live candidates
+        sq_dist[self.gallery.superseded(slice(0, len(sq_dist)))] = np.inf
+        count = min(max(top_k, self.rerank), len(sq_dist))
+        if count < len(sq_dist):
+            rows = np.argpartition(sq_dist, count - 1)[:count]
+        else:
+            rows = np.arange(len(sq_dist))
+        if self.rerank:
+            ids, dist = self.gallery.row_distances(encoding, rows)
+        else:
+            ids, exact = self.gallery.row_distances(encoding, rows)
+            dist = np.where(np.isfinite(exact), np.sqrt(sq_dist[rows]), np.inf)
+        order = np.argsort(dist, kind='stable')[:top_k]
+        return [(ids[i], float(dist[i])) for i in order if np.isfinite(dist[i])]
+
+
+def create_index(gallery, kind='flat', **options):
+    # Build the index named by the FACE_INDEX setting
+    if kind == 'flat':
+        return FlatIndex(gallery)
+    if kind == 'ivfpq':
+        return IVFPQIndex(gallery, **options)
+    if kind in QuantizedIndex.PRECISIONS:
+        return QuantizedIndex(gallery, precision=kind, **options)
+    if kind == 'sharded':
+        return ShardedIndex(gallery, **options)
+    raise ValueError(f"Unknown face index type: {kind}")
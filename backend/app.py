@@ -1,586 +1,1410 @@
-from flask import Flask, request, jsonify
+import time
+# Process start, for the cold-start time reported with the first successful request
+STARTED_AT = time.perf_counter()
+from flask import Flask, request, jsonify, g, Response, send_file
 from flask_cors import CORS
-import face_recognition
+from werkzeug.exceptions import RequestEntityTooLarge
 import numpy as np
 import os
 import json
 import base64
 from datetime import datetime
-from PIL import Image
-import io
 import cv2
-import dlib
 import sys
-import traceback
+import uuid
+import zipfile
+import re
+import shutil
+import logging
+import threading
+try:
+    from flask_sock import Sock
+except ImportError:  # Streaming detection is optional
+    Sock = None
+import config
+from gallery import FaceGallery
+from embedding_file import EmbeddingFile
+from user_store import UserStore
+from image_io import bytes_to_image, payload_to_bytes
+from ann_index import create_index
+from encoding_batcher import EncodingBatcher
+from encoding_cache import EncodingCache
+from face_tracking import FaceTracker, TrackingStats
+from frame_diff import FrameDiffCache, FrameDiffStats, reduced_gray
+from face_detection import detect_faces, locate_faces
+from face_quality import analyze_quality
+from sessions import DetectionSession, SessionRegistry
+from logging_setup import FRAME_LOGGER, configure_logging, set_request_id
+from metrics import registry, stage, server_timing_header
+from models import ModelLoader
+from bulk_enroll import (ImportLimitError, ImportQueue, extract_archive, import_summary, name_from_key, run_import,
+                         save_source, source_path, sources_dir)
+from profile_pictures import VARIANT_SIZES, ensure_variant, picture_path, save_profile_picture
+from profile_pictures import mimetype as picture_mimetype
+from registration_jobs import RegistrationError, RegistrationQueue
+from liveness import LivenessTracker, check_token
+from templates import centroid, max_distance, rescore, select_exemplars
+
+configure_logging(config.LOG_LEVEL, config.LOG_FORMAT, config.LOG_FRAME_SAMPLE_EVERY)
+logger = logging.getLogger('faceguard')
+# Per-frame detect-face records: DEBUG only, and sampled
+frame_logger = logging.getLogger(FRAME_LOGGER)
 
-print("Starting server initialization...")
+logger.info("Starting server initialization...")
 
 try:
     app = Flask(__name__)
+    app.config['MAX_CONTENT_LENGTH'] = config.MAX_UPLOAD_BYTES
     CORS(app)
-    print("Flask app and CORS initialized")
-
-    # Initialize dlib's face detector and facial landmark predictor
-    print("Initializing face detector...")
-    detector = dlib.get_frontal_face_detector()
-    print("Face detector initialized successfully")
+    logger.debug("Flask app and CORS initialized")
 
-    # Check if model file exists
+    # dlib's face detector, the 68-point landmark predictor (downloaded if
+    # missing) and face_recognition's models, loaded by init_app()
     MODEL_PATH = 'shape_predictor_68_face_landmarks.dat'
-    if not os.path.exists(MODEL_PATH):
-        print(f"Warning: Model file {MODEL_PATH} not found. Downloading...")
-        try:
-            import urllib.request
-            import bz2
-            
-            # Download the model
-            model_url = "http://dlib.net/files/shape_predictor_68_face_landmarks.dat.bz2"
-            print(f"Downloading model from {model_url}...")
-            urllib.request.urlretrieve(model_url, MODEL_PATH + ".bz2")
-            print("Model downloaded successfully")
-            
-            # Decompress the file
-            print("Decompressing model file...")
-            with bz2.open(MODEL_PATH + ".bz2", 'rb') as source, open(MODEL_PATH, 'wb') as dest:
-                dest.write(source.read())
-            print("Model decompressed successfully")
-            
-            # Remove the compressed file
-            os.remove(MODEL_PATH + ".bz2")
-            print("Compressed file removed")
-        except Exception as e:
-            print(f"Error downloading model: {str(e)}")
-            print(f"Traceback: {traceback.format_exc()}")
-            print("Please download the model manually from: http://dlib.net/files/shape_predictor_68_face_landmarks.dat.bz2")
-            sys.exit(1)
 
-    try:
-        print("Loading facial landmark predictor model...")
-        predictor = dlib.shape_predictor(MODEL_PATH)
-        print("Model loaded successfully!")
-    except Exception as e:
-        print(f"Error loading model: {str(e)}")
-        print(f"Traceback: {traceback.format_exc()}")
-        predictor = None
+    # Database storing user information, and the legacy JSON file it replaces
+    USER_DB_FILE = 'user_data/users.db'
+    USER_DATA_FILE = 'user_data/users.json'
+
+    # Memory-mapped face encodings, with a sidecar mapping rows to users
+    EMBEDDING_FILE = 'user_data/embeddings.f32'
+
+    # Encodings and profile pictures of bulk imports that are not committed yet
+    IMPORT_STAGING_DIR = 'user_data/imports'
+    logger.info("Server initialization completed successfully")
+
+except Exception:
+    logger.exception("Error during server initialization")
+    sys.exit(1)
+
+# Content types accepted as a raw image request body
+RAW_IMAGE_MIMETYPES = {'image/jpeg', 'image/png', 'image/webp', 'application/octet-stream'}
+
+def get_image_payload():
+    # Image payload and other fields of a request in any supported format: a
+    # raw JPEG/PNG body (fields from the query string), a multipart upload
+    # with an 'image' file part, or the original JSON body with a base64 data
+    # URL. The payload is None when the request carries no image.
+    if request.mimetype in RAW_IMAGE_MIMETYPES:
+        return request.get_data(cache=False) or None, request.args.to_dict()
+    if request.mimetype == 'multipart/form-data':
+        upload = request.files.get('image')
+        return (upload.read() if upload else None) or None, request.form.to_dict()
+    data = request.get_json(silent=True) or {}
+    return data.get('image') or None, data
+
+def get_image_payloads():
+    # Like get_image_payload() for requests that may carry several images:
+    # repeated 'image' parts of a multipart upload, or an 'images' list
+    # (or a single 'image') in a JSON body
+    if request.mimetype == 'multipart/form-data':
+        uploads = [upload.read() for upload in request.files.getlist('image')]
+        return [upload for upload in uploads if upload], request.form.to_dict()
+    if request.mimetype in RAW_IMAGE_MIMETYPES:
+        image_data, fields = get_image_payload()
+        return [image_data] if image_data else [], fields
+    data = request.get_json(silent=True) or {}
+    images = data.get('images') or [data.get('image')]
+    return [image for image in images if image], data
+
+def decode_samples(payloads):
+    # (image_array, image_bytes) of every payload; the bytes key the
+    # encoding cache and the arrays are needed for the profile picture
+    with stage('decode'):
+        samples = []
+        for payload in payloads:
+            image_bytes = payload_to_bytes(payload)
+            samples.append((bytes_to_image(image_bytes), image_bytes))
+        return samples
 
-    # Create a directory to store user data
-    if not os.path.exists('user_data'):
-        print("Creating user_data directory...")
-        os.makedirs('user_data')
-        print("user_data directory created")
+# Endpoints polled once per camera frame or by probes and scrapers; their
+# request summaries are logged through the sampled per-frame logger at DEBUG
+# instead of at INFO
+FRAME_ENDPOINTS = {'detect_face', 'get_registration', 'healthz', 'readyz', 'get_metrics'}
 
-    # Create a directory to store profile pictures
+# Endpoints that need the models; the first one to succeed ends the cold start
+MODEL_ENDPOINTS = {'detect_face', 'register_user', 'verify_user'}
+cold_start_seconds = None
+
+def models_unavailable():
+    # 503 response while the models are loading, or None once they are ready
+    if models.ready:
+        return None
+    g.outcome = 'models_unavailable'
+    message = ('Face models failed to load. Please check server logs.' if models.failed
+               else 'Face models are still loading. Please retry shortly.')
+    return jsonify({'success': False, 'message': message}), 503, {'Retry-After': '1'}
+
+@app.before_request
+def start_request_log():
+    # Tag log records with the caller's X-Request-Id, or a new id
+    g.request_start = time.perf_counter()
+    g.request_id = request.headers.get('X-Request-Id') or uuid.uuid4().hex
+    g.log_fields = {}
+    set_request_id(g.request_id)
+
+@app.after_request
+def finish_request_log(response):
+    # One summary record per request, with fields handlers added to g.log_fields
+    request_id = getattr(g, 'request_id', None)
+    if request_id is None:
+        return response
+    response.headers['X-Request-Id'] = request_id
+    duration = time.perf_counter() - g.request_start
+    endpoint = request.endpoint or 'unknown'
+    outcome = g.get('outcome') or ('ok' if response.status_code < 400 else
+                                   'client_error' if response.status_code < 500 else 'server_error')
+    request_count.inc(endpoint=endpoint, outcome=outcome)
+    request_seconds.observe(duration, endpoint=endpoint)
+    stage_timings = g.get('stage_timings')
+    if config.SERVER_TIMING and stage_timings:
+        response.headers['Server-Timing'] = server_timing_header(stage_timings)
+        response.headers['Timing-Allow-Origin'] = '*'
+    fields = {
+        'status': response.status_code,
+        'outcome': outcome,
+        'duration_ms': round(duration * 1000.0, 2),
+    }
+    fields.update(g.log_fields)
+    global cold_start_seconds
+    if cold_start_seconds is None and response.status_code < 400 and request.endpoint in MODEL_ENDPOINTS:
+        cold_start_seconds = time.perf_counter() - STARTED_AT
+        logger.info("First successful %s %.2f s after start", request.path, cold_start_seconds,
+                    extra={'fields': {'cold_start_s': round(cold_start_seconds, 3)}})
+    if request.endpoint in FRAME_ENDPOINTS:
+        frame_logger.debug("%s %s", request.method, request.path, extra={'fields': fields})
+    else:
+        logger.info("%s %s", request.method, request.path, extra={'fields': fields})
+    return response
+
+@app.teardown_request
+def clear_request_id(exc):
+    set_request_id(None)
+
+# Server state shared by the handlers below, created by init_app()
+models = None
+user_store = None
+gallery = None
+face_index = None
+registration_queue = None
+import_queue = None
+
+# Set once the face index has caught up with the gallery; /readyz waits for it
+index_ready = threading.Event()
+index_error = None
+
+# Bulk imports from /api/register/bulk are identified by ids this server issues
+UPLOAD_IMPORT_ID = re.compile(r'[0-9a-f]{32}')
+
+def create_face_index(gallery):
+    # The FACE_INDEX index over gallery, with its settings from config
+    options = {}
+    if config.FACE_INDEX == 'ivfpq':
+        options = {
+            'nlist': config.FACE_INDEX_NLIST,
+            'm': config.FACE_INDEX_PQ_M,
+            'nprobe': config.FACE_INDEX_NPROBE,
+            'rerank': config.FACE_INDEX_RERANK,
+            'min_train_size': config.FACE_INDEX_MIN_TRAIN_SIZE,
+        }
+    elif config.FACE_INDEX in ('float16', 'int8'):
+        options = {'rerank': config.FACE_INDEX_RERANK}
+    elif config.FACE_INDEX == 'sharded':
+        options = {'shards': config.FACE_INDEX_SHARDS or os.cpu_count() or 1}
+    return create_index(gallery, config.FACE_INDEX, **options)
+
+def init_app():
+    # Start loading the models, open the user store, map the gallery, build
+    # the face index and close out jobs and imports the last shutdown
+    # interrupted. Only the process that serves calls this (app.py's
+    # __main__, serve.py, the benchmarks), never an import of this module:
+    # bulk import pool workers spawned under `python app.py` re-import it as
+    # __mp_main__ and must not touch the live store.
+    global models, user_store, gallery, face_index, registration_queue, import_queue
+    if user_store is not None:
+        return
+
+    # The endpoints that need the models answer 503 until they are ready
+    models = ModelLoader(MODEL_PATH).start()
+
+    # Create the directories for user data and profile pictures
     if not os.path.exists('user_data/profile_pictures'):
-        print("Creating profile_pictures directory...")
         os.makedirs('user_data/profile_pictures')
-        print("profile_pictures directory created")
+        logger.info("Created user_data directories")
 
-    # File to store user information
-    USER_DATA_FILE = 'user_data/users.json'
-    print("Server initialization completed successfully")
+    user_store = UserStore(USER_DB_FILE)
+    migrated = user_store.migrate_from_json(USER_DATA_FILE)
+    if migrated is not None:
+        logger.info("Migrated %d users from %s", migrated, USER_DATA_FILE)
+    logger.info("User store opened with %d users", user_store.count())
 
-except Exception as e:
-    print(f"Error during server initialization: {str(e)}")
-    print(f"Traceback: {traceback.format_exc()}")
-    sys.exit(1)
+    # Keep every enrolled encoding resident so verification is one batched
+    # distance computation instead of a reload and loop over users.json
+    gallery = FaceGallery(embedding_file=EmbeddingFile(EMBEDDING_FILE))
+    # Append users the embedding file does not have yet: everyone on first
+    # start, or a registration interrupted between the database insert and
+    # the file append
+    mapped_user_ids = set(gallery.rows(0, len(gallery))[0])
+    missing_user_ids = [user_id for user_id in user_store.encoded_user_ids()
+                        if user_id not in mapped_user_ids]
+    if missing_user_ids:
+        logger.info("Adding %d encodings missing from %s", len(missing_user_ids), EMBEDDING_FILE)
+        gallery.add_many(*user_store.load_encodings(missing_user_ids))
+    logger.info("Face gallery mapped with %d encodings", len(gallery))
 
-def calculate_eye_aspect_ratio(eye_landmarks):
-    try:
-        # Calculate the vertical distance between eye landmarks
-        vertical_dist1 = np.linalg.norm(eye_landmarks[1] - eye_landmarks[5])
-        vertical_dist2 = np.linalg.norm(eye_landmarks[2] - eye_landmarks[4])
-        # Calculate the horizontal distance between eye landmarks
-        horizontal_dist = np.linalg.norm(eye_landmarks[0] - eye_landmarks[3])
-        # Calculate the eye aspect ratio
-        ear = (vertical_dist1 + vertical_dist2) / (2.0 * horizontal_dist)
-        return ear
-    except Exception as e:
-        print(f"Error calculating eye aspect ratio: {str(e)}")
-        print(f"Eye landmarks shape: {eye_landmarks.shape}")
-        return 0.0
+    # Nearest-neighbour index over the gallery; new registrations are picked
+    # up incrementally on the next search. It is first brought up to date by
+    # sync_index_in_background()
+    face_index = create_face_index(gallery)
+    logger.info("Using '%s' face index", config.FACE_INDEX)
 
-def calculate_face_alignment(landmarks):
-    try:
-        # Get the nose bridge points
-        nose_bridge = landmarks[27:31]
-        # Calculate the angle of the nose bridge relative to vertical
-        angle = np.arctan2(nose_bridge[-1][1] - nose_bridge[0][1], 
-                          nose_bridge[-1][0] - nose_bridge[0][0])
-        angle_degrees = np.degrees(angle)
-        print(f"Raw face angle: {angle_degrees}")
-        # Normalize angle to be between -90 and 90 degrees
-        if angle_degrees > 90:
-            angle_degrees = angle_degrees - 180
-        elif angle_degrees < -90:
-            angle_degrees = angle_degrees + 180
-        print(f"Normalized face angle: {angle_degrees}")
-        return angle_degrees
-    except Exception as e:
-        print(f"Error calculating face alignment: {str(e)}")
-        print(f"Landmarks shape: {landmarks.shape}")
-        return 0.0
+    # Registrations accepted by /api/registrations run on background threads
+    registration_queue = RegistrationQueue(user_store, workers=config.REGISTRATION_WORKERS,
+                                           max_pending=config.REGISTRATION_QUEUE_SIZE)
+    interrupted_jobs = user_store.finish_interrupted_jobs()
+    if interrupted_jobs:
+        logger.warning("Closed %d registration jobs interrupted by the last shutdown", interrupted_jobs)
 
-def detect_smile(landmarks):
-    try:
-        # Get mouth corner points
-        mouth_left = landmarks[48]
-        mouth_right = landmarks[54]
-        # Get mouth height points
-        mouth_top = landmarks[51]
-        mouth_bottom = landmarks[57]
-        
-        # Calculate mouth width and height
-        mouth_width = np.linalg.norm(mouth_right - mouth_left)
-        mouth_height = np.linalg.norm(mouth_bottom - mouth_top)
-        
-        # Calculate smile ratio - lowered threshold from 0.2 to 0.15
-        smile_ratio = mouth_height / mouth_width
-        return smile_ratio > 0.15  # More lenient threshold for smile detection
-    except Exception as e:
-        print(f"Error detecting smile: {str(e)}")
-        print(f"Landmarks shape: {landmarks.shape}")
-        return False
-
-def load_user_data():
-    if os.path.exists(USER_DATA_FILE):
-        with open(USER_DATA_FILE, 'r') as f:
-            return json.load(f)
-    return {}
-
-def save_user_data(data):
-    with open(USER_DATA_FILE, 'w') as f:
-        json.dump(data, f)
-
-def base64_to_image(base64_string):
-    # Remove the data URL prefix if present
-    if ',' in base64_string:
-        base64_string = base64_string.split(',')[1]
+    import_queue = ImportQueue(user_store, max_pending=config.BULK_IMPORT_QUEUE_SIZE)
+    interrupted_imports = user_store.finish_interrupted_imports()
+    if interrupted_imports:
+        logger.warning("Marked %d imports interrupted by the last shutdown", interrupted_imports)
+
+def sync_index_in_background(index=None):
+    # Bring the face index up to date on a background thread: training
+    # IVF-PQ or encoding a large gallery takes a while, and the server
+    # answers probes (and searches, with an exact scan) meanwhile
+    index = face_index if index is None else index
+
+    def sync():
+        global index_error
+        start = time.perf_counter()
+        try:
+            index.sync()
+        except Exception as e:
+            index_error = str(e)
+            logger.exception("Face index sync failed")
+            return
+        index_ready.set()
+        logger.info("Face index ready in %.2f s", time.perf_counter() - start)
+
+    threading.Thread(target=sync, name='index-sync', daemon=True).start()
+
+# Face encodings from concurrent register/verify requests run in batches
+encoding_batcher = EncodingBatcher(max_batch_size=config.ENCODING_BATCH_MAX_SIZE,
+                                   max_wait_ms=config.ENCODING_BATCH_MAX_WAIT_MS)
+logger.info("Encoding batches of up to %d faces, waiting at most %s ms",
+            encoding_batcher.max_batch_size, config.ENCODING_BATCH_MAX_WAIT_MS)
+
+# Faces of recently submitted images, so retries and resubmitted frames skip
+# detection and encoding
+encoding_cache = EncodingCache(max_entries=config.ENCODING_CACHE_SIZE,
+                               ttl_seconds=config.ENCODING_CACHE_TTL_SECONDS)
+
+# Detect-face clients that send a session id get a face tracker that avoids
+# full-frame detection on most frames
+tracking_stats = TrackingStats()
+
+# ... and reuse the last result while their camera scene does not change
+frame_diff_stats = FrameDiffStats()
+
+def detect_full_frame(gray):
+    # Full-frame detection, on a downscaled copy if DETECTION_SHORT_SIDE is set
+    return detect_faces(models.detector, gray, config.DETECTION_SHORT_SIDE, config.DETECTION_UPSAMPLE)
+
+# Signs liveness tokens; a random secret is shared by serve.py's workers,
+# which fork after this module is imported
+LIVENESS_SECRET = config.LIVENESS_SECRET.encode('utf-8') if config.LIVENESS_SECRET else os.urandom(32)
+
+def new_detection_session(session_id):
+    return DetectionSession(
+        tracker=FaceTracker(
+            models.detector,
+            redetect_interval=config.TRACKING_REDETECT_INTERVAL,
+            min_score=config.TRACKING_MIN_SCORE,
+            stats=tracking_stats,
+            full_detect=detect_full_frame),
+        liveness=LivenessTracker(LIVENESS_SECRET, session_id, config.LIVENESS_TOKEN_TTL_SECONDS),
+        frames=FrameDiffCache(config.FRAME_DIFF_THRESHOLD, config.FRAME_DIFF_MAX_REUSE, frame_diff_stats)
+        if config.FRAME_DIFF_THRESHOLD > 0 else None)
+
+detection_sessions = SessionRegistry(new_detection_session,
+                                     ttl_seconds=config.SESSION_TTL_SECONDS,
+                                     max_sessions=config.MAX_SESSIONS)
+
+# Metrics exposed at /metrics. Stage timings (frame_diff, decode, grayscale, detect,
+# landmarks, quality, encode, duplicate_check, store_load, store_write,
+# picture, match) are recorded with metrics.stage() in the handlers below
+request_count = registry.counter(
+    'faceguard_requests', 'Requests handled, by endpoint and outcome', ('endpoint', 'outcome'))
+request_seconds = registry.histogram(
+    'faceguard_request_duration_seconds', 'Request latency by endpoint', ('endpoint',))
+registry.gauge('faceguard_gallery_size', 'Encodings in the face gallery', lambda: len(gallery))
+registry.gauge('faceguard_gallery_identities', 'Users with a template in the face gallery',
+               lambda: gallery.identities)
+registry.gauge('faceguard_encoding_queue_depth', 'Faces waiting for the encoding batcher',
+               lambda: encoding_batcher.stats()['queueDepth'])
+registry.callback_counter('faceguard_encoding_batches', 'Encoding batches run',
+                          lambda: encoding_batcher.stats()['batches'])
+registry.callback_counter('faceguard_encoding_batched_requests', 'Encoding requests served by batches',
+                          lambda: encoding_batcher.stats()['requests'])
+registry.callback_histogram('faceguard_encoding_batch_size', 'Faces encoded per encoding batch',
+                            lambda: encoding_batcher.stats()['batchSizes'], (1, 2, 4, 8, 16, 32, 64))
+registry.gauge('faceguard_encoding_batch_max_size', 'Configured ENCODING_BATCH_MAX_SIZE',
+               lambda: encoding_batcher.max_batch_size)
+registry.gauge('faceguard_encoding_batch_max_wait_seconds', 'Configured ENCODING_BATCH_MAX_WAIT_MS, in seconds',
+               lambda: encoding_batcher.max_wait)
+registry.callback_counter('faceguard_encoding_cache_lookups', 'Encoding cache lookups by result',
+                          lambda: {'hit': encoding_cache.hits, 'miss': encoding_cache.misses}, ('result',))
+registry.gauge('faceguard_encoding_cache_entries', 'Entries in the encoding cache', lambda: len(encoding_cache))
+registry.gauge('faceguard_models_ready', 'Whether the face models are loaded', lambda: int(models.ready))
+registry.gauge('faceguard_cold_start_seconds', 'Time from process start to the first successful request',
+               lambda: cold_start_seconds if cold_start_seconds is not None else float('nan'))
+registry.gauge('faceguard_detection_sessions', 'Active detect-face tracking sessions',
+               lambda: len(detection_sessions))
+liveness_sessions = registry.counter('faceguard_liveness_sessions', 'Detect-face sessions that passed the liveness check')
+
+def tracking_frame_counts():
+    counts = tracking_stats.as_dict()
+    return {'full': counts['fullDetections'], 'tracked': counts['trackedFrames'],
+            'lost': counts['lostTracks']}
+
+registry.callback_counter('faceguard_tracking_frames', 'Detect-face session frames by detection path',
+                          tracking_frame_counts, ('path',))
+
+def frame_diff_counts():
+    counts = frame_diff_stats.as_dict()
+    return {'reused': counts['reusedFrames'], 'forced_refresh': counts['forcedRefreshes'],
+            'changed': counts['changedFrames']}
+
+registry.callback_counter('faceguard_frame_diff_frames', 'Detect-face session frames by frame-difference result',
+                          frame_diff_counts, ('result',))
+
+def analyze_payload(payload, session=None):
+    # analyze_frame() for an uploaded image, answering from the session's
+    # last result when the scene has not changed since
+    image_bytes = payload_to_bytes(payload)
+    frames = session.frames if session is not None else None
+    # While a required liveness check is still observing, every frame counts
+    if frames is not None and (not config.LIVENESS_REQUIRED or session.liveness.live):
+        with stage('frame_diff'):
+            thumbnail = reduced_gray(image_bytes)
+            with session.lock:
+                cached = frames.lookup(thumbnail)
+                if cached is not None:
+                    return reused_response(cached, session.liveness)
+    else:
+        thumbnail = None
+    with stage('decode'):
+        image_array = bytes_to_image(image_bytes)
+    response = analyze_frame(image_array, session)
+    if thumbnail is not None:
+        with session.lock:
+            frames.store(thumbnail, response)
+    return response
+
+def reused_response(cached, liveness):
+    # The cached result with the session's current liveness status
+    response = dict(cached, frameReused=True)
+    if 'liveness' in response:
+        response['liveness'] = liveness.status()
+        response.pop('livenessToken', None)
+        if liveness.live:
+            response['livenessToken'] = liveness.new_token()
+    return response
+
+def analyze_frame(image_array, session=None):
+    # Face position and quality guidance for one RGB frame, shared by the
+    # HTTP and streaming detect-face endpoints
+    if session is None:
+        return _analyze_frame(image_array, detect_full_frame)
+    with session.lock:
+        return _analyze_frame(image_array, session.tracker.detect, session.liveness)
+
+def _analyze_frame(image_array, detect, liveness=None):
+    # Convert to grayscale for dlib
+    with stage('grayscale'):
+        gray = cv2.cvtColor(image_array, cv2.COLOR_RGB2GRAY)
     
-    # Decode base64 string to bytes
-    image_bytes = base64.b64decode(base64_string)
+    # Detect faces using dlib
+    with stage('detect'):
+        faces = detect(gray)
     
-    # Convert bytes to image
-    image = Image.open(io.BytesIO(image_bytes))
+    if len(faces) == 0:
+        response = {
+            'success': True,
+            'faceDetected': False,
+            'faceCount': 0,
+            'message': 'No face detected'
+        }
+        if liveness is not None:
+            response['liveness'] = liveness.lost_face()
+        return response
+    
+    if len(faces) > 1:
+        response = {
+            'success': True,
+            'faceDetected': True,
+            'faceCount': len(faces),
+            'message': 'Multiple faces detected'
+        }
+        if liveness is not None:
+            response['liveness'] = liveness.lost_face()
+        return response
     
-    # Convert PIL Image to numpy array
-    return np.array(image)
-
-def check_lighting(image_array, face_rect):
     try:
-        # Extract face region
-        top, right, bottom, left = face_rect
-        face_region = image_array[top:bottom, left:right]
-        
-        # Convert to grayscale if not already
-        if len(face_region.shape) == 3:
-            face_region = cv2.cvtColor(face_region, cv2.COLOR_RGB2GRAY)
+        # Get facial landmarks
+        with stage('landmarks'):
+            landmarks = models.predictor(gray, faces[0])
+            landmarks = np.array([[p.x, p.y] for p in landmarks.parts()])
         
-        # Calculate average brightness
-        avg_brightness = np.mean(face_region)
+        # Calculate face position relative to center
+        face_rect = faces[0]
+        image_center_x = image_array.shape[1] / 2
+        image_center_y = image_array.shape[0] / 2
+        face_center_x = (face_rect.left() + face_rect.right()) / 2
+        face_center_y = (face_rect.top() + face_rect.bottom()) / 2
         
-        # Define thresholds - adjusted for more accurate lighting detection
-        MIN_BRIGHTNESS = 40  # Increased from 30 to 40
-        IDEAL_BRIGHTNESS = 120  # Increased from 80 to 120
+        # Calculate normalized position (-1 to 1)
+        pos_x = (face_center_x - image_center_x) / (image_array.shape[1] / 2)
+        pos_y = (face_center_y - image_center_y) / (image_array.shape[0] / 2)
         
-        print(f"Lighting check - Average brightness: {avg_brightness:.2f}")
-        print(f"Lighting check - Minimum threshold: {MIN_BRIGHTNESS}")
-        print(f"Lighting check - Ideal threshold: {IDEAL_BRIGHTNESS}")
+        # Calculate face size relative to ideal size
+        face_width = face_rect.right() - face_rect.left()
+        face_height = face_rect.bottom() - face_rect.top()
+        ideal_size = min(image_array.shape[0], image_array.shape[1]) * 0.4  # 40% of smaller dimension
+        current_size = max(face_width, face_height)
+        scale = current_size / ideal_size
         
-        is_well_lit = avg_brightness >= MIN_BRIGHTNESS
-        is_ideal_lighting = avg_brightness >= IDEAL_BRIGHTNESS
+        face_position = {
+            'x': float(pos_x),
+            'y': float(pos_y),
+            'scale': float(scale)
+        }
         
-        print(f"Lighting check - Is well lit: {is_well_lit}")
-        print(f"Lighting check - Is ideal lighting: {is_ideal_lighting}")
+        # Eye, mouth, pose, lighting and sharpness metrics in one pass over the
+        # landmarks and the existing grayscale frame
+        face_box = (faces[0].top(), faces[0].right(), faces[0].bottom(), faces[0].left())
+        with stage('quality'):
+            quality = analyze_quality(landmarks, gray, face_box)
+        if frame_logger.isEnabledFor(logging.DEBUG):
+            frame_logger.debug("Face analyzed", extra={'fields': {
+                'shape': 'x'.join(map(str, image_array.shape[:2])),
+                'x': round(pos_x, 3), 'y': round(pos_y, 3), 'scale': round(scale, 3),
+                'ear': round(quality['ear'], 3), 'mouth_ratio': round(quality['mouthRatio'], 3),
+                'brightness': round(quality['brightness'], 1), 'sharpness': round(quality['sharpness'], 1),
+                'roll': round(quality['roll'], 1), 'yaw': round(quality['yaw'], 2),
+                'pitch': round(quality['pitch'], 2),
+            }})
         
-        return {
-            'isWellLit': is_well_lit,
-            'brightness': float(avg_brightness),  # Convert to float for JSON serialization
-            'isIdealLighting': is_ideal_lighting
+        # Prepare response
+        response = {
+            'success': True,
+            'faceDetected': True,
+            'faceCount': 1,
+            'facePosition': face_position,
+            'faceQuality': {
+                'eyesOpen': quality['eyesOpen'],
+                'isSmiling': quality['isSmiling'],
+                'isWellLit': quality['isWellLit'],
+                'isIdealLighting': quality['isIdealLighting']
+            },
+            'faceMetrics': {
+                key: quality[key]
+                for key in ('ear', 'mouthRatio', 'roll', 'yaw', 'pitch', 'brightness', 'sharpness')
+            }
         }
-    except Exception as e:
-        print(f"Error in check_lighting: {str(e)}")
+        
+        # Add guidance messages
+        messages = []
+        if not response['faceQuality']['eyesOpen']:
+            messages.append('Please open your eyes')
+        if not response['faceQuality']['isSmiling']:
+            messages.append('Please smile')
+        if not response['faceQuality']['isWellLit']:
+            messages.append('Please move to a well-lit area')
+        elif not response['faceQuality']['isIdealLighting']:
+            messages.append('Better lighting would improve face detection')
+        
+        if messages:
+            response['message'] = ' | '.join(messages)
+        
+        # A blink makes the session live; live sessions get a fresh
+        # single-use token with every frame
+        if liveness is not None:
+            was_live = liveness.live
+            response['liveness'] = liveness.update(quality['ear'])
+            if liveness.live:
+                response['livenessToken'] = liveness.new_token()
+                if not was_live:
+                    liveness_sessions.inc()
+        
+        return response
+        
+    except Exception:
+        logger.exception("Error processing face")
         return {
-            'isWellLit': False,  # Changed default to False
-            'brightness': 0,
-            'isIdealLighting': False  # Changed default to False
+            'success': True,
+            'faceDetected': True,
+            'faceCount': 1,
+            'message': 'Face detected but could not analyze features'
         }
 
 @app.route('/api/detect-face', methods=['POST'])
 def detect_face():
     try:
-        if predictor is None:
-            return jsonify({
-                'success': False,
-                'message': 'Face detection model not loaded. Please check server logs.'
-            }), 500
+        unavailable = models_unavailable()
+        if unavailable:
+            return unavailable
 
-        data = request.json
-        image_data = data.get('image')
+        image_data, data = get_image_payload()
         
         if not image_data:
-            print("No image data received")
             return jsonify({
                 'success': False,
                 'message': 'Image is required'
             }), 400
         
-        # Convert base64 image to numpy array
-        image_array = base64_to_image(image_data)
-        print(f"Image shape: {image_array.shape}")
-        
-        # Convert to grayscale for dlib
-        gray = cv2.cvtColor(image_array, cv2.COLOR_RGB2GRAY)
-        
-        # Detect faces using dlib
-        faces = detector(gray)
-        print(f"Number of faces detected: {len(faces)}")
+        # Clients identify their camera session to enable face tracking and
+        # reuse of the last result for unchanged frames
+        session_id = request.headers.get('X-Session-Id') or data.get('sessionId')
+        session = detection_sessions.get(session_id) if session_id else None
+        saved_liveness = load_liveness(session_id, session)
+        response = analyze_payload(image_data, session)
+        save_liveness(session_id, session, saved_liveness)
+        g.log_fields['face_count'] = response['faceCount']
+        g.log_fields['frame_reused'] = response.get('frameReused', False)
+        g.outcome = 'no_face' if response['faceCount'] == 0 else \
+            'multiple_faces' if response['faceCount'] > 1 else 'face'
+        return jsonify(response)
+    
+    except Exception as e:
+        logger.warning("Error in detect_face: %s", e, exc_info=True)
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+
+def load_liveness(session_id, session):
+    # The next frame of an HTTP session may reach another serve.py worker, so
+    # its liveness state is kept in the user store between frames. Returns
+    # the saved state, or None
+    if session is None:
+        return None
+    saved = user_store.get_liveness_state(session_id)
+    if saved is not None:
+        with session.lock:
+            session.liveness.restore(saved)
+    return saved
+
+def save_liveness(session_id, session, saved):
+    if session is None:
+        return
+    with session.lock:
+        state = session.liveness.to_dict()
+    if state != saved:
+        user_store.save_liveness_state(session_id, state,
+                                       max(config.SESSION_TTL_SECONDS, config.LIVENESS_TOKEN_TTL_SECONDS))
+
+# Streaming face guidance: the client pushes camera frames (binary JPEG/PNG
+# or base64 data URL text messages) over a WebSocket and receives one
+# detect-face result per analyzed frame
+if Sock is not None:
+    sock = Sock(app)
+
+    @sock.route('/api/detect-face/stream')
+    def detect_face_stream(ws):
+        session = None
+        frames = 0
+        dropped = 0
+        while True:
+            frame = ws.receive()
+            # Skip to the newest frame if more arrived while the last one was
+            # being analyzed, so guidance latency stays bounded
+            while True:
+                newer = ws.receive(timeout=0)
+                if newer is None:
+                    break
+                frame = newer
+                dropped += 1
+            frames += 1
+            
+            try:
+                if not models.ready:
+                    response = {
+                        'success': False,
+                        'message': 'Face models are not loaded yet. Please retry shortly.'
+                    }
+                else:
+                    # Liveness tokens are bound to the session id the client
+                    # names in the URL, which it sends again with verify. The
+                    # connection keeps the session on this worker, so its
+                    # state stays in memory
+                    session = session or new_detection_session(
+                        request.args.get('sessionId') or uuid.uuid4().hex)
+                    response = analyze_payload(frame, session)
+            except Exception as e:
+                logger.warning("Error in detect_face_stream: %s", e, exc_info=True)
+                response = {
+                    'success': False,
+                    'message': str(e)
+                }
+            response['frame'] = frames
+            response['droppedFrames'] = dropped
+            frame_logger.debug("Stream frame", extra={'fields': {
+                'frame': frames, 'dropped': dropped, 'face_count': response.get('faceCount')}})
+            ws.send(json.dumps(response))
+else:
+    logger.warning("flask-sock is not installed; /api/detect-face/stream is disabled")
+
+def encode_sample(image_array, image_bytes):
+    # Face encoding of one enrollment image, through the encoding cache.
+    # Raises RegistrationError if the image does not show exactly one face.
+    cache_key = encoding_cache.key(image_bytes)
+    cached = encoding_cache.get(cache_key)
+    
+    # Find face locations in the image
+    if cached is None:
+        with stage('detect'):
+            face_locations = locate_faces(image_array, config.DETECTION_SHORT_SIDE, config.ENCODING_DETECTION_UPSAMPLE)
+        if len(face_locations) != 1:
+            encoding_cache.put(cache_key, face_locations)
+    else:
+        face_locations, face_encoding = cached
+    
+    if not face_locations:
+        raise RegistrationError('no_face', 'No face detected in the image')
+    
+    if len(face_locations) > 1:
+        raise RegistrationError('multiple_faces', 'Multiple faces detected. Please ensure only one face is visible.')
+    
+    # Get face encoding
+    if cached is None:
+        with stage('encode'):
+            face_encoding = encoding_batcher.encode(image_array, face_locations)[0]
+        encoding_cache.put(cache_key, face_locations, face_encoding)
+    return face_encoding
+
+def find_duplicate(template):
+    # Closest enrolled user within DUPLICATE_DISTANCE of a template, as
+    # (user_id, distance), or None
+    if not config.DUPLICATE_DISTANCE:
+        return None
+    with stage('duplicate_check'):
+        gallery.refresh()
+        matches = face_index.search(template, top_k=1)
+    if matches and matches[0][1] <= config.DUPLICATE_DISTANCE:
+        return matches[0]
+    return None
+
+def save_picture(user_id, image_array):
+    # Save a profile picture, size-capped, with its smaller variants
+    with stage('picture'):
+        profile_pic_path = picture_path('user_data/profile_pictures', user_id, config.PROFILE_PICTURE_FORMAT)
+        save_profile_picture(image_array, profile_pic_path, config.PROFILE_PICTURE_QUALITY)
+        user_store.set_profile_picture(user_id, profile_pic_path)
+    return profile_pic_path
+
+def enroll(name, samples, on_matchable=None):
+    # Detect, encode and store one person from one or more (image_array,
+    # image_bytes) samples, and return the user id, the profile picture path
+    # and whether the samples were merged into an existing user. The
+    # template is the centroid of the samples. A face already enrolled
+    # within DUPLICATE_DISTANCE under the same name gets the samples added
+    # to its template instead of a second user; under another name the
+    # registration is refused. on_matchable(user_id) is called as soon as
+    # the user is in the gallery, before the profile picture is written.
+    # Raises RegistrationError for unusable samples.
+    encodings = [encode_sample(image_array, image_bytes) for image_array, image_bytes in samples]
+    if max_distance(encodings) > config.MATCH_THRESHOLD:
+        raise RegistrationError('inconsistent_samples', 'The images do not all show the same person')
+    template = centroid(encodings)
+    
+    duplicate = find_duplicate(template)
+    existing = user_store.get_user(duplicate[0]) if duplicate else None
+    if existing is not None:
+        user_id = duplicate[0]
+        if existing['name'].strip().casefold() != name.strip().casefold():
+            raise RegistrationError('duplicate', 'This face is already registered to another user', 409)
+        with stage('store_write'):
+            template, sample_count = user_store.add_samples(user_id, encodings, config.TEMPLATE_MAX_EXEMPLARS)
+            gallery.add(user_id, template, existing['name'])
+        if on_matchable:
+            on_matchable(user_id)
+        profile_pic_path = existing.get('profilePicture') or save_picture(user_id, samples[0][0])
+        logger.info("Added %d samples to user %s (%d in total)", len(encodings), user_id, sample_count)
+        return user_id, profile_pic_path, True
+    
+    # Store user data; the store assigns a new unique user ID. A single
+    # sample is its own exemplar, so only multi-sample templates keep any
+    exemplars = None
+    if len(encodings) > 1:
+        exemplars = [encodings[i] for i in select_exemplars(encodings, config.TEMPLATE_MAX_EXEMPLARS)]
+    with stage('store_write'):
+        user_id = user_store.add_user(name, template, datetime.now().isoformat(),
+                                      exemplars=exemplars, sample_count=len(encodings))
+        gallery.add(user_id, template, name)
+    if on_matchable:
+        on_matchable(user_id)
+    
+    profile_pic_path = save_picture(user_id, samples[0][0])
+    logger.info("Registered user %s from %d samples", user_id, len(encodings))
+    return user_id, profile_pic_path, False
+
+@app.route('/api/register', methods=['POST'])
+def register_user():
+    try:
+        unavailable = models_unavailable()
+        if unavailable:
+            return unavailable
+
+        payloads, data = get_image_payloads()
+        name = data.get('name')
         
-        if len(faces) == 0:
+        if not name or not payloads:
             return jsonify({
-                'success': True,
-                'faceDetected': False,
-                'faceCount': 0,
-                'message': 'No face detected'
-            })
+                'success': False,
+                'message': 'Name and image are required'
+            }), 400
         
-        if len(faces) > 1:
+        if len(payloads) > config.REGISTRATION_MAX_SAMPLES:
             return jsonify({
-                'success': True,
-                'faceDetected': True,
-                'faceCount': len(faces),
-                'message': 'Multiple faces detected'
-            })
+                'success': False,
+                'message': f'At most {config.REGISTRATION_MAX_SAMPLES} images are accepted per registration'
+            }), 400
         
+        samples = decode_samples(payloads)
         try:
-            # Get facial landmarks
-            print("Getting facial landmarks...")
-            landmarks = predictor(gray, faces[0])
-            landmarks = np.array([[p.x, p.y] for p in landmarks.parts()])
-            print(f"Landmarks shape: {landmarks.shape}")
-            
-            # Calculate face position relative to center
-            face_rect = faces[0]
-            image_center_x = image_array.shape[1] / 2
-            image_center_y = image_array.shape[0] / 2
-            face_center_x = (face_rect.left() + face_rect.right()) / 2
-            face_center_y = (face_rect.top() + face_rect.bottom()) / 2
-            
-            # Calculate normalized position (-1 to 1)
-            pos_x = (face_center_x - image_center_x) / (image_array.shape[1] / 2)
-            pos_y = (face_center_y - image_center_y) / (image_array.shape[0] / 2)
-            
-            # Calculate face size relative to ideal size
-            face_width = face_rect.right() - face_rect.left()
-            face_height = face_rect.bottom() - face_rect.top()
-            ideal_size = min(image_array.shape[0], image_array.shape[1]) * 0.4  # 40% of smaller dimension
-            current_size = max(face_width, face_height)
-            scale = current_size / ideal_size
-            
-            print(f"Face position calculation:")
-            print(f"Image center: ({image_center_x}, {image_center_y})")
-            print(f"Face center: ({face_center_x}, {face_center_y})")
-            print(f"Normalized position: ({pos_x}, {pos_y})")
-            print(f"Scale: {scale}")
-            
-            face_position = {
-                'x': float(pos_x),
-                'y': float(pos_y),
-                'scale': float(scale)
-            }
-            
-            # Calculate eye aspect ratios
-            print("Calculating eye aspect ratios...")
-            left_eye = landmarks[36:42]
-            right_eye = landmarks[42:48]
-            left_ear = calculate_eye_aspect_ratio(left_eye)
-            right_ear = calculate_eye_aspect_ratio(right_eye)
-            avg_ear = (left_ear + right_ear) / 2.0
-            print(f"Eye aspect ratios - Left: {left_ear}, Right: {right_ear}, Average: {avg_ear}")
-            
-            # Detect smile
-            print("Detecting smile...")
-            is_smiling = detect_smile(landmarks)
-            print(f"Is smiling: {is_smiling}")
-            
-            # Check lighting
-            print("Checking lighting...")
-            face_rect = (faces[0].top(), faces[0].right(), faces[0].bottom(), faces[0].left())
-            lighting_info = check_lighting(image_array, face_rect)
-            print(f"Lighting info: {lighting_info}")
-            
-            # Convert NumPy boolean to Python boolean
-            eyes_open = bool(avg_ear > 0.15)  # Lowered threshold from 0.2 to 0.15
-            is_smiling_bool = bool(is_smiling)
-            
-            print(f"Quality checks - Eyes open: {eyes_open} (threshold: 0.15)")
-            print(f"Quality checks - Smiling: {is_smiling_bool}")
-            print(f"Quality checks - Well lit: {lighting_info['isWellLit']}")
-            
-            # Prepare response
-            response = {
-                'success': True,
-                'faceDetected': True,
-                'faceCount': 1,
-                'facePosition': face_position,
-                'faceQuality': {
-                    'eyesOpen': eyes_open,
-                    'isSmiling': is_smiling_bool,
-                    'isWellLit': bool(lighting_info['isWellLit']),
-                    'isIdealLighting': bool(lighting_info['isIdealLighting'])
-                }
-            }
-            
-            # Add guidance messages
-            messages = []
-            if not response['faceQuality']['eyesOpen']:
-                messages.append('Please open your eyes')
-            if not response['faceQuality']['isSmiling']:
-                messages.append('Please smile')
-            if not response['faceQuality']['isWellLit']:
-                messages.append('Please move to a well-lit area')
-            elif not response['faceQuality']['isIdealLighting']:
-                messages.append('Better lighting would improve face detection')
-            
-            if messages:
-                response['message'] = ' | '.join(messages)
-            
-            print("Successfully processed face features")
-            return jsonify(response)
-            
-        except Exception as e:
-            print(f"Error processing face: {str(e)}")
-            print(f"Error type: {type(e)}")
-            print(f"Traceback: {traceback.format_exc()}")
+            user_id, profile_pic_path, merged = enroll(name, samples)
+        except RegistrationError as e:
+            g.outcome = e.outcome
             return jsonify({
-                'success': True,
-                'faceDetected': True,
-                'faceCount': 1,
-                'message': 'Face detected but could not analyze features'
-            })
+                'success': False,
+                'message': str(e)
+            }), e.status
+        g.outcome = 'merged' if merged else 'registered'
+        g.log_fields.update(user_id=user_id, samples=len(samples))
+        
+        return jsonify({
+            'success': True,
+            'message': 'Samples added to the existing user' if merged else 'User registered successfully',
+            'userId': user_id,
+            'merged': merged,
+            'profilePicture': profile_pic_path
+        })
     
     except Exception as e:
-        print(f"Error in detect_face: {str(e)}")
-        print(f"Error type: {type(e)}")
-        print(f"Traceback: {traceback.format_exc()}")
+        logger.warning("Error in register_user: %s", e, exc_info=True)
         return jsonify({
             'success': False,
             'message': str(e)
         }), 400
 
-@app.route('/api/register', methods=['POST'])
-def register_user():
+# Asynchronous registration: the request is answered as soon as the image is
+# decoded, with a job id to poll at /api/registrations/<job_id>. The user is
+# matchable once the job reports 'matchable', while the profile picture is
+# still being written; 'completed' means everything is stored.
+@app.route('/api/registrations', methods=['POST'])
+def create_registration():
     try:
-        data = request.json
+        unavailable = models_unavailable()
+        if unavailable:
+            return unavailable
+
+        payloads, data = get_image_payloads()
         name = data.get('name')
-        image_data = data.get('image')
         
-        if not name or not image_data:
+        if not name or not payloads:
             return jsonify({
                 'success': False,
                 'message': 'Name and image are required'
             }), 400
         
-        # Convert base64 image to numpy array
-        image_array = base64_to_image(image_data)
-        
-        # Find face locations in the image
-        face_locations = face_recognition.face_locations(image_array)
-        
-        if not face_locations:
+        if len(payloads) > config.REGISTRATION_MAX_SAMPLES:
             return jsonify({
                 'success': False,
-                'message': 'No face detected in the image'
+                'message': f'At most {config.REGISTRATION_MAX_SAMPLES} images are accepted per registration'
             }), 400
         
-        if len(face_locations) > 1:
+        # Validate the images now so a broken upload fails fast
+        try:
+            samples = decode_samples(payloads)
+        except Exception:
+            g.outcome = 'invalid_image'
             return jsonify({
                 'success': False,
-                'message': 'Multiple faces detected. Please ensure only one face is visible.'
+                'message': 'Invalid image format'
             }), 400
         
-        # Get face encoding
-        face_encoding = face_recognition.face_encodings(image_array, face_locations)[0]
+        def register(report):
+            user_id, profile_pic_path, _ = enroll(
+                name, samples, on_matchable=lambda user_id: report('matchable', user_id=user_id))
+            return user_id, profile_pic_path
         
-        # Load existing user data
-        users = load_user_data()
+        job_id = registration_queue.submit(name, register)
+        if job_id is None:
+            g.outcome = 'queue_full'
+            return jsonify({
+                'success': False,
+                'message': 'Too many registrations in progress. Please retry shortly.'
+            }), 503, {'Retry-After': '1'}
         
-        # Generate user ID
-        user_id = str(len(users) + 1)
+        g.outcome = 'accepted'
+        g.log_fields['job_id'] = job_id
+        return jsonify({
+            'success': True,
+            'jobId': job_id,
+            'status': 'queued',
+            'statusUrl': f'/api/registrations/{job_id}'
+        }), 202
+    
+    except Exception as e:
+        logger.warning("Error in create_registration: %s", e, exc_info=True)
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+
+@app.route('/api/registrations/<job_id>', methods=['GET'])
+def get_registration(job_id):
+    job = user_store.get_job(job_id)
+    if job is None:
+        return jsonify({
+            'success': False,
+            'message': 'Registration job not found'
+        }), 404
+    return jsonify(dict(job, success=job['status'] != 'failed'))
+
+# Add enrollment samples to an existing user's template, e.g. captures in
+# other lighting or with and without glasses
+@app.route('/api/users/<user_id>/samples', methods=['POST'])
+def add_user_samples(user_id):
+    try:
+        unavailable = models_unavailable()
+        if unavailable:
+            return unavailable
+
+        payloads, _ = get_image_payloads()
+        if not payloads or len(payloads) > config.REGISTRATION_MAX_SAMPLES:
+            return jsonify({
+                'success': False,
+                'message': f'Between 1 and {config.REGISTRATION_MAX_SAMPLES} images are required'
+            }), 400
         
-        # Save profile picture
-        profile_pic_path = f'user_data/profile_pictures/{user_id}.jpg'
-        profile_pic = Image.fromarray(image_array)
-        profile_pic.save(profile_pic_path)
+        user = user_store.get_user(user_id)
+        if user is None or user['faceEncoding'] is None:
+            return jsonify({
+                'success': False,
+                'message': 'User not found'
+            }), 404
         
-        # Store user data
-        users[user_id] = {
-            'name': name,
-            'faceEncoding': face_encoding.tolist(),
-            'registeredAt': datetime.now().isoformat(),
-            'profilePicture': profile_pic_path
-        }
+        try:
+            encodings = [encode_sample(image_array, image_bytes)
+                         for image_array, image_bytes in decode_samples(payloads)]
+        except RegistrationError as e:
+            g.outcome = e.outcome
+            return jsonify({
+                'success': False,
+                'message': str(e)
+            }), e.status
         
-        save_user_data(users)
+        # Refuse samples of someone else, so a template cannot drift away
+        # from the person it was enrolled for
+        current = np.asarray(user['faceEncoding'], dtype=np.float32)
+        if any(np.linalg.norm(encoding - current) > config.MATCH_THRESHOLD for encoding in encodings):
+            g.outcome = 'sample_mismatch'
+            return jsonify({
+                'success': False,
+                'message': 'The images do not match this user'
+            }), 400
         
+        with stage('store_write'):
+            template, sample_count = user_store.add_samples(user_id, encodings, config.TEMPLATE_MAX_EXEMPLARS)
+            gallery.add(user_id, template, user['name'])
+        g.outcome = 'samples_added'
+        g.log_fields.update(user_id=user_id, samples=len(encodings))
         return jsonify({
             'success': True,
-            'message': 'User registered successfully',
             'userId': user_id,
-            'profilePicture': profile_pic_path
+            'sampleCount': sample_count
         })
     
     except Exception as e:
+        logger.warning("Error in add_user_samples: %s", e, exc_info=True)
         return jsonify({
             'success': False,
             'message': str(e)
         }), 400
 
+@app.route('/api/register/bulk', methods=['POST'])
+def register_bulk():
+    # Enroll a batch of people at once: a multipart upload of 'images' parts
+    # (named by optional 'names' fields in the same order, or by file name)
+    # and/or a zip 'archive' part, or a raw zip body. The upload is saved to
+    # disk and the import queued; the response carries the importId to poll
+    # at /api/imports/<importId>. Sending the same batch again with that
+    # importId resumes an interrupted import.
+    source_dir = None
+    try:
+        unavailable = models_unavailable()
+        if unavailable:
+            return unavailable
+
+        raw_archive = request.mimetype in ('application/zip', 'application/x-zip-compressed')
+        fields = request.args if raw_archive else request.form
+
+        # Only ids this server issued are accepted
+        import_id = fields.get('importId')
+        if import_id:
+            existing = user_store.get_import(import_id) if UPLOAD_IMPORT_ID.fullmatch(import_id) else None
+            if existing is None or existing['source'] != 'upload':
+                return jsonify({
+                    'success': False,
+                    'message': 'Unknown importId'
+                }), 400
+            if existing['status'] in ('queued', 'processing'):
+                return jsonify(dict(existing, success=False, message='Import is already in progress')), 409
+        else:
+            import_id = uuid.uuid4().hex
+
+        source_dir = sources_dir(IMPORT_STAGING_DIR, import_id)
+        shutil.rmtree(source_dir, ignore_errors=True)
+        os.makedirs(source_dir)
+        with stage('bulk_upload'):
+            items = save_bulk_upload(raw_archive, fields, source_dir)
+
+        if not items:
+            shutil.rmtree(source_dir, ignore_errors=True)
+            return jsonify({
+                'success': False,
+                'message': 'At least one image or an archive is required'
+            }), 400
+
+        def run():
+            try:
+                with stage('bulk_import'):
+                    summary = run_import(user_store, gallery, items, import_id, IMPORT_STAGING_DIR,
+                                         'user_data/profile_pictures', workers=config.BULK_ENROLL_WORKERS or None,
+                                         source='upload', start_method='spawn')
+                logger.info("Import %s enrolled %d of %d images", import_id, summary['enrolled'], summary['total'])
+            finally:
+                shutil.rmtree(source_dir, ignore_errors=True)
+
+        user_store.start_import(import_id, 'upload')
+        if not import_queue.submit(import_id, run):
+            shutil.rmtree(source_dir, ignore_errors=True)
+            g.outcome = 'queue_full'
+            return jsonify({
+                'success': False,
+                'message': 'Too many imports in progress. Please retry later.'
+            }), 503, {'Retry-After': '30'}
+
+        g.outcome = 'accepted'
+        g.log_fields.update(import_id=import_id, images=len(items))
+        return jsonify({
+            'success': True,
+            'importId': import_id,
+            'status': 'queued',
+            'total': len(items),
+            'statusUrl': f'/api/imports/{import_id}'
+        }), 202
+
+    except zipfile.BadZipFile:
+        shutil.rmtree(source_dir, ignore_errors=True)
+        return jsonify({
+            'success': False,
+            'message': 'Archive is not a valid zip file'
+        }), 400
+    except (ImportLimitError, RequestEntityTooLarge) as e:
+        if source_dir:
+            shutil.rmtree(source_dir, ignore_errors=True)
+        g.outcome = 'too_large'
+        return jsonify({
+            'success': False,
+            'message': str(e) if isinstance(e, ImportLimitError) else 'Upload is too large'
+        }), 413
+    except Exception as e:
+        logger.exception("Error in register_bulk")
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 500
+
+def save_bulk_upload(raw_archive, fields, directory):
+    # Save the images of a bulk upload to directory one file at a time and
+    # return their (key, name, path) items, within the bulk import limits
+    max_images = config.BULK_IMPORT_MAX_IMAGES
+    max_bytes = config.BULK_IMPORT_MAX_BYTES
+    if raw_archive:
+        if request.content_length is not None and request.content_length > config.MAX_UPLOAD_BYTES:
+            raise RequestEntityTooLarge()
+        archive_path = save_source(request.stream, os.path.join(directory, 'upload.zip'), config.MAX_UPLOAD_BYTES)
+        try:
+            return extract_archive(archive_path, directory, max_images=max_images, max_bytes=max_bytes)
+        finally:
+            os.remove(archive_path)
+
+    items = []
+    names = fields.getlist('names')
+    uploads = request.files.getlist('images')
+    if len(uploads) > max_images:
+        raise ImportLimitError(f'{len(uploads)} images uploaded; at most {max_images} are accepted')
+    keys = set()
+    for index, upload in enumerate(uploads):
+        key = upload.filename or f'image-{index}'
+        if key in keys:
+            key = f'{key}#{index}'
+        keys.add(key)
+        name = names[index] if index < len(names) and names[index] else name_from_key(key)
+        path = save_source(upload.stream, source_path(directory, key), max_bytes)
+        max_bytes -= os.path.getsize(path)
+        items.append((key, name, path))
+    archive = request.files.get('archive')
+    if archive:
+        items.extend(extract_archive(archive.stream, directory, max_images=max_images - len(items),
+                                     max_bytes=max_bytes))
+    return items
+
+# Status and summary (so far) of a bulk import
+@app.route('/api/imports/<import_id>', methods=['GET'])
+def get_import(import_id):
+    existing = user_store.get_import(import_id) if UPLOAD_IMPORT_ID.fullmatch(import_id) else None
+    if existing is None or existing['source'] != 'upload':
+        return jsonify({
+            'success': False,
+            'message': 'Import not found'
+        }), 404
+    summary = import_summary(user_store, import_id)
+    return jsonify(dict(summary, status=existing['status'], message=existing['message'],
+                        success=existing['status'] != 'failed'))
+
 @app.route('/api/verify', methods=['POST'])
 def verify_user():
     try:
-        data = request.json
-        if not data:
-            print("No data received in verify request")
+        unavailable = models_unavailable()
+        if unavailable:
+            return unavailable
+
+        image_data, data = get_image_payload()
+        if not image_data and not data:
             return jsonify({
                 'success': False,
                 'message': 'No data received'
             }), 400
 
-        image_data = data.get('image')
         if not image_data:
-            print("No image data in verify request")
             return jsonify({
                 'success': False,
                 'message': 'Image is required'
             }), 400
         
-        print("Processing verification image...")
-        # Convert base64 image to numpy array
         try:
-            image_array = base64_to_image(image_data)
-            print(f"Image converted successfully, shape: {image_array.shape}")
-        except Exception as e:
-            print(f"Error converting image: {str(e)}")
+            top_k = int(data.get('topK', 1))
+        except (TypeError, ValueError):
+            g.outcome = 'invalid_request'
             return jsonify({
                 'success': False,
-                'message': 'Invalid image format'
+                'message': 'topK must be an integer'
             }), 400
+        top_k = min(max(1, top_k), config.VERIFY_MAX_TOP_K)
         
-        # Find face locations in the image
+        # Refuse requests without a liveness token before any decoding,
+        # detection or encoding work
+        if config.LIVENESS_REQUIRED:
+            token = request.headers.get('X-Liveness-Token') or data.get('livenessToken')
+            session_id = request.headers.get('X-Session-Id') or data.get('sessionId')
+            checked = check_token(LIVENESS_SECRET, token, session_id)
+            if checked is None or not user_store.use_liveness_nonce(*checked):
+                g.outcome = 'liveness_required'
+                return jsonify({
+                    'success': False,
+                    'message': 'Liveness check required. Please look at the camera and blink.'
+                }), 403
+        
+        # Decode the uploaded image to a numpy array, unless the same image
+        # was analyzed recently
         try:
-            face_locations = face_recognition.face_locations(image_array)
-            print(f"Face locations found: {len(face_locations)}")
+            with stage('decode'):
+                image_bytes = payload_to_bytes(image_data)
+                cache_key = encoding_cache.key(image_bytes)
+                cached = encoding_cache.get(cache_key)
+                if cached is None:
+                    image_array = bytes_to_image(image_bytes)
         except Exception as e:
-            print(f"Error detecting faces: {str(e)}")
+            g.outcome = 'invalid_image'
+            logger.info("Invalid verification image: %s", e)
             return jsonify({
                 'success': False,
-                'message': 'Error detecting face in image'
+                'message': 'Invalid image format'
             }), 400
+        g.log_fields['encoding_cache'] = 'miss' if cached is None else 'hit'
+        
+        # Find face locations in the image
+        if cached is None:
+            try:
+                with stage('detect'):
+                    face_locations = locate_faces(image_array, config.DETECTION_SHORT_SIDE, config.ENCODING_DETECTION_UPSAMPLE)
+            except Exception:
+                logger.exception("Error detecting faces")
+                return jsonify({
+                    'success': False,
+                    'message': 'Error detecting face in image'
+                }), 400
+            if len(face_locations) != 1:
+                encoding_cache.put(cache_key, face_locations)
+        else:
+            face_locations, face_encoding = cached
+        g.log_fields['face_count'] = len(face_locations)
         
         if not face_locations:
-            print("No face detected in verification image")
+            g.outcome = 'no_face'
             return jsonify({
                 'success': False,
                 'message': 'No face detected in the image'
             }), 400
         
         if len(face_locations) > 1:
-            print(f"Multiple faces detected: {len(face_locations)}")
+            g.outcome = 'multiple_faces'
             return jsonify({
                 'success': False,
                 'message': 'Multiple faces detected. Please ensure only one face is visible.'
             }), 400
         
         # Get face encoding
-        try:
-            face_encoding = face_recognition.face_encodings(image_array, face_locations)[0]
-            print("Face encoding generated successfully")
-        except Exception as e:
-            print(f"Error generating face encoding: {str(e)}")
-            return jsonify({
-                'success': False,
-                'message': 'Error processing face features'
-            }), 400
+        if cached is None:
+            try:
+                with stage('encode'):
+                    face_encoding = encoding_batcher.encode(image_array, face_locations)[0]
+            except Exception:
+                logger.exception("Error generating face encoding")
+                return jsonify({
+                    'success': False,
+                    'message': 'Error processing face features'
+                }), 400
+            encoding_cache.put(cache_key, face_locations, face_encoding)
         
-        # Load user data
-        try:
-            users = load_user_data()
-            print(f"Loaded {len(users)} registered users")
-        except Exception as e:
-            print(f"Error loading user data: {str(e)}")
-            return jsonify({
-                'success': False,
-                'message': 'Error accessing user database'
-            }), 500
+        # Map registrations made by other worker processes
+        with stage('store_load'):
+            gallery.refresh()
         
-        if not users:
-            print("No registered users found")
+        # 1:1 verification against a claimed identity (e.g. a badge or
+        # employee id typed at a kiosk) looks up that user's row directly
+        # instead of searching the whole gallery
+        claimed_id = data.get('userId')
+        if claimed_id:
+            claimed_id = str(claimed_id)
+            g.log_fields['mode'] = '1:1'
+            with stage('match'):
+                distance = gallery.user_distance(claimed_id, face_encoding)
+                if distance is not None and config.TEMPLATE_RESCORE_CANDIDATES:
+                    exemplars = user_store.load_exemplars([claimed_id])
+                    distance = rescore(face_encoding, [(claimed_id, distance)], exemplars)[0][1]
+            if distance is None:
+                g.outcome = 'unknown_user'
+                return jsonify({
+                    'success': False,
+                    'message': 'User not found'
+                }), 404
+            matches = [(claimed_id, distance)]
+            top_k = 1
+        else:
+            g.log_fields['mode'] = '1:N'
+            if gallery.identities == 0:
+                g.outcome = 'empty_gallery'
+                return jsonify({
+                    'success': False,
+                    'message': 'No registered users found'
+                }), 404
+            
+            # Search the face index for the closest enrolled templates and
+            # re-score the best candidates against their users' exemplars
+            try:
+                with stage('match'):
+                    matches = face_index.search(face_encoding, top_k=max(top_k, config.TEMPLATE_RESCORE_CANDIDATES))
+                    if config.TEMPLATE_RESCORE_CANDIDATES and matches:
+                        exemplars = user_store.load_exemplars([candidate_id for candidate_id, _ in matches])
+                        matches = rescore(face_encoding, matches, exemplars)
+                    matches = matches[:top_k]
+            except Exception:
+                logger.exception("Error matching face")
+                return jsonify({
+                    'success': False,
+                    'message': 'Error accessing user database'
+                }), 500
+        
+        g.log_fields['gallery_size'] = len(gallery)
+        if not matches:
+            g.outcome = 'not_recognized'
             return jsonify({
                 'success': False,
-                'message': 'No registered users found'
+                'message': 'Face not recognized'
             }), 404
         
-        # Compare with stored face encodings
-        for user_id, user_data in users.items():
-            try:
-                stored_encoding = np.array(user_data['faceEncoding'])
-                # Compare face encodings
-                match = face_recognition.compare_faces([stored_encoding], face_encoding, tolerance=0.6)[0]
-                
-                if match:
-                    print(f"Face verified successfully for user: {user_data['name']}")
-                    return jsonify({
-                        'success': True,
-                        'message': 'Face verified successfully',
-                        'userId': user_id,
-                        'name': user_data['name']
-                    })
-            except Exception as e:
-                print(f"Error comparing with user {user_id}: {str(e)}")
-                continue
+        user_id, distance = matches[0]
+        g.log_fields['distance'] = round(distance, 4)
+        if distance <= config.MATCH_THRESHOLD:
+            user = user_store.get_user(user_id)
+            name = user['name'] if user else None
+            g.outcome = 'matched'
+            g.log_fields['user_id'] = user_id
+            response = {
+                'success': True,
+                'message': 'Face verified successfully',
+                'userId': user_id,
+                'name': name,
+                'distance': distance,
+                'threshold': config.MATCH_THRESHOLD
+            }
+            if top_k > 1:
+                response['candidates'] = [
+                    {'userId': candidate_id, 'distance': candidate_distance}
+                    for candidate_id, candidate_distance in matches
+                ]
+            return jsonify(response)
         
-        print("No matching face found")
+        g.outcome = 'not_recognized'
         return jsonify({
             'success': False,
-            'message': 'Face not recognized'
+            'message': 'Face does not match the claimed user' if claimed_id else 'Face not recognized',
+            'distance': distance,
+            'threshold': config.MATCH_THRESHOLD
         }), 404
     
-    except Exception as e:
-        print(f"Unexpected error in verify_user: {str(e)}")
-        print(f"Traceback: {traceback.format_exc()}")
+    except Exception:
+        logger.exception("Unexpected error in verify_user")
         return jsonify({
             'success': False,
             'message': 'An unexpected error occurred'
         }), 500
 
-# Add new endpoint to get profile picture
+# Change the number of gallery shards of a 'sharded' face index while
+# verification keeps running, e.g. after adding cores
+@app.route('/api/face-index/shards', methods=['POST'])
+def resize_face_index():
+    if config.FACE_INDEX != 'sharded':
+        return jsonify({
+            'success': False,
+            'message': f"The face index is not sharded (FACE_INDEX is '{config.FACE_INDEX}')"
+        }), 400
+    data = request.get_json(silent=True) or {}
+    try:
+        shards = int(data.get('shards'))
+    except (TypeError, ValueError):
+        shards = 0
+    max_shards = os.cpu_count() or 1
+    if not 1 <= shards <= max_shards:
+        return jsonify({
+            'success': False,
+            'message': f'shards must be an integer between 1 and {max_shards}'
+        }), 400
+    with stage('resize'):
+        face_index.resize(shards)
+    g.outcome = 'resized'
+    return jsonify(dict(face_index.stats(), success=True))
+
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    return jsonify({
+        'success': True,
+        'gallerySize': len(gallery),
+        'identities': gallery.identities,
+        'faceIndex': config.FACE_INDEX,
+        'faceIndexShards': face_index.stats() if config.FACE_INDEX == 'sharded' else None,
+        'encodingBatcher': encoding_batcher.stats(),
+        'encodingCache': encoding_cache.stats(),
+        'pendingRegistrations': registration_queue.pending(),
+        'pendingImports': import_queue.pending(),
+        'detectionSessions': len(detection_sessions),
+        'faceTracking': tracking_stats.as_dict(),
+        'frameDiff': frame_diff_stats.as_dict()
+    })
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    # Liveness: the process is serving; fails only if the models cannot load
+    if models.failed:
+        return jsonify({'status': 'error', 'error': models.error}), 500
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    # Readiness: the models are loaded, the face index has caught up with
+    # the gallery and every endpoint can serve
+    status = models.status()
+    status['coldStartSeconds'] = cold_start_seconds
+    status['faceIndexReady'] = index_ready.is_set()
+    status['faceIndexError'] = index_error
+    ready = models.ready and index_ready.is_set()
+    return jsonify(dict(status, ready=ready)), 200 if ready else 503
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Prometheus text exposition format
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+def find_profile_picture(user_id):
+    # (path of the requested variant, None) or (None, error response)
+    size = request.args.get('size', 'full')
+    if size not in VARIANT_SIZES:
+        return None, (jsonify({
+            'success': False,
+            'message': f"Unknown size '{size}'; expected one of {', '.join(VARIANT_SIZES)}"
+        }), 400)
+
+    profile_pic_path = user_store.get_profile_picture(user_id)
+    if profile_pic_path is None:
+        return None, (jsonify({
+            'success': False,
+            'message': 'User not found'
+        }), 404)
+
+    path = ensure_variant(profile_pic_path, size, config.PROFILE_PICTURE_QUALITY) if profile_pic_path else None
+    if path is None:
+        return None, (jsonify({
+            'success': False,
+            'message': 'Profile picture not found'
+        }), 404)
+    return path, None
+
+# Profile picture as an image, with ETag/Last-Modified validation and a long
+# cache lifetime; ?size=full|medium|thumb picks the variant
+@app.route('/api/profile-picture/<user_id>/image', methods=['GET'])
+def get_profile_picture_image(user_id):
+    try:
+        path, error = find_profile_picture(user_id)
+        if error:
+            return error
+        # send_file resolves relative paths against the app's directory, but
+        # stored picture paths are relative to the working directory
+        return send_file(os.path.abspath(path), mimetype=picture_mimetype(path), conditional=True, etag=True,
+                         max_age=config.PROFILE_PICTURE_MAX_AGE)
+    
+    except Exception as e:
+        logger.warning("Error in get_profile_picture_image: %s", e, exc_info=True)
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), 400
+
+# Profile picture as a base64 data URL in JSON, for existing clients
 @app.route('/api/profile-picture/<user_id>', methods=['GET'])
 def get_profile_picture(user_id):
     try:
-        users = load_user_data()
-        if user_id not in users:
-            return jsonify({
-                'success': False,
-                'message': 'User not found'
-            }), 404
-        
-        profile_pic_path = users[user_id]['profilePicture']
-        if not os.path.exists(profile_pic_path):
-            return jsonify({
-                'success': False,
-                'message': 'Profile picture not found'
-            }), 404
+        path, error = find_profile_picture(user_id)
+        if error:
+            return error
         
         # Read and encode the image
-        with open(profile_pic_path, 'rb') as f:
+        with open(path, 'rb') as f:
             image_data = base64.b64encode(f.read()).decode('utf-8')
         
         return jsonify({
             'success': True,
-            'image': f'data:image/jpeg;base64,{image_data}'
+            'image': f'data:{picture_mimetype(path)};base64,{image_data}'
         })
     
     except Exception as e:
+        logger.warning("Error in get_profile_picture: %s", e, exc_info=True)
         return jsonify({
             'success': False,
             'message': str(e)
@@ -588,21 +1412,22 @@ def get_profile_picture(user_id):
 
 if __name__ == '__main__':
     try:
-        print("Starting Flask server...")
+        init_app()
+        sync_index_in_background()
+        logger.info("Starting Flask server...")
         # Try higher port numbers that are less likely to be restricted
         ports = [8000, 8080, 8888, 9000, 9090]
         for port in ports:
             try:
-                print(f"Attempting to start server on port {port}...")
+                logger.info("Attempting to start server on port %d...", port)
                 app.run(debug=True, host='0.0.0.0', port=port)
                 break
             except OSError as e:
                 if "address already in use" in str(e).lower() or "access permissions" in str(e).lower():
-                    print(f"Port {port} is not available, trying next port...")
+                    logger.warning("Port %d is not available, trying next port...", port)
                     continue
                 else:
                     raise e
-    except Exception as e:
-        print(f"Error starting Flask server: {str(e)}")
-        print(f"Traceback: {traceback.format_exc()}")
+    except Exception:
+        logger.exception("Error starting Flask server")
         sys.exit(1) 
\ No newline at end of file
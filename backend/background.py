@@ -0,0 +1,80 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Background threads owned by the process that uses them.
+#
+# Threads do not survive fork: a serve.py worker inherits the parent's
+# objects but none of their threads, and locks held at fork time stay held.
+# ProcessLocal therefore builds its value (a started thread, an executor, a
+# queue listener) on first use in each process, and a forked child starts
+# over with a fresh lock and builds its own.
+
+
+class ProcessLocal:
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._lock = threading.Lock()
+        self._value = None
+        self._pid = None
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def get(self):
+        # This process's value, built on first use
+        if self._pid == os.getpid():
+            return self._value
+        with self._lock:
+            if self._pid != os.getpid():
+                self._value = self.factory()
+                self._pid = os.getpid()
+            return self._value
+
+    def peek(self):
+        # This process's value, or None if it has not been built yet
+        return self._value if self._pid == os.getpid() else None
+
+
+class _Pool:
+
+    def __init__(self, workers, name):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self.lock = threading.Lock()
+        self.pending = 0
+
+
+class BoundedExecutor:
+    # Thread pool refusing work beyond max_pending queued or running tasks
+
+    def __init__(self, workers=1, max_pending=100, name='background'):
+        self.max_pending = max_pending
+        self._pool = ProcessLocal(lambda: _Pool(max(1, workers), name))
+
+    def submit(self, fn, *args, before=None):
+        # Run fn(*args) in the background and return its Future, or None if
+        # the pool is full. before() runs once the task is accepted, before it
+        # can start, e.g. to record a job the task will update
+        pool = self._pool.get()
+        with pool.lock:
+            if pool.pending >= self.max_pending:
+                return None
+            if before is not None:
+                before()
+            pool.pending += 1
+            return pool.executor.submit(self._run, pool, fn, args)
+
+    @staticmethod
+    def _run(pool, fn, args):
+        try:
+            return fn(*args)
+        finally:
+            with pool.lock:
+                pool.pending -= 1
+
+    def pending(self):
+        pool = self._pool.peek()
+        return pool.pending if pool is not None else 0
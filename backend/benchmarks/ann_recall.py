@@ -0,0 +1,98 @@
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gallery import FaceGallery
+from ann_index import FlatIndex, IVFPQIndex
+
+# Recall of the IVF-PQ index against the exact brute-force scan.
+#
+# Builds a synthetic gallery shaped like dlib encodings (identity centres with
+# per-capture noise), queries it with fresh captures of enrolled identities
+# and reports recall@1 and query latency for several nprobe
+# settings. Exits non-zero when recall@1 at the default setting falls below
+# --min-recall, so it can gate changes to the index.
+
+
+def synthetic_encodings(count, rng, dim=128):
+    centres = rng.normal(0.0, 0.09, size=(count, dim)).astype(np.float32)
+    return centres
+
+
+def capture(centres, rng, noise=0.03):
+    return centres + rng.normal(0.0, noise, size=centres.shape).astype(np.float32)
+
+
+def evaluate(index, exact, queries):
+    hits = 0
+    latencies = []
+    for query in queries:
+        truth = exact.search(query, top_k=1)[0][0]
+        start = time.perf_counter()
+        result = index.search(query, top_k=1)
+        latencies.append(time.perf_counter() - start)
+        hits += bool(result) and result[0][0] == truth
+    latencies = np.array(latencies) * 1000.0
+    return {
+        'recall@1': hits / len(queries),
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='IVF-PQ recall against brute force')
+    parser.add_argument('--size', type=int, default=200000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[4, 8, 16, 32])
+    parser.add_argument('--rerank', type=int, default=128)
+    parser.add_argument('--default-nprobe', type=int, default=16)
+    parser.add_argument('--min-recall', type=float, default=0.95)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    centres = synthetic_encodings(args.size, rng)
+    gallery = FaceGallery(initial_capacity=args.size)
+    # Enroll most identities up front and the rest afterwards, so the
+    # incremental-insert path is exercised as well
+    initial = int(args.size * 0.9)
+    gallery.add_many([str(i) for i in range(initial)], centres[:initial])
+
+    exact = FlatIndex(gallery)
+    index = IVFPQIndex(gallery, nprobe=args.default_nprobe, rerank=args.rerank,
+                       min_train_size=min(20000, initial))
+    start = time.perf_counter()
+    index.sync()
+    train_seconds = time.perf_counter() - start
+
+    gallery.add_many([str(i) for i in range(initial, args.size)], centres[initial:])
+    query_ids = rng.choice(args.size, size=args.queries, replace=False)
+    queries = capture(centres[query_ids], rng)
+
+    report = {
+        'size': args.size,
+        'queries': args.queries,
+        'train_seconds': train_seconds,
+        'flat': evaluate(exact, exact, queries),
+        'ivfpq': {},
+    }
+    for nprobe in args.nprobe:
+        index.nprobe = nprobe
+        report['ivfpq'][f'nprobe={nprobe}'] = evaluate(index, exact, queries)
+    print(json.dumps(report, indent=2))
+
+    index.nprobe = args.default_nprobe
+    recall = evaluate(index, exact, queries)['recall@1']
+    if recall < args.min_recall:
+        print(f"recall@1 {recall:.3f} is below the required {args.min_recall:.3f}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+import cv2
+import dlib
+import numpy as np
+import face_recognition
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from face_detection import detect_faces, locate_faces
+from image_io import bytes_to_image
+
+# Accuracy and latency of detection on downscaled frames.
+#
+# Runs both detection paths (dlib HOG for /api/detect-face, face_recognition
+# for register/verify) over a fixed directory of test images at several
+# DETECTION_SHORT_SIDE settings. Boxes found at full resolution are the
+# reference: each setting reports how many reference faces it finds again
+# (IoU >= 0.5), the mean IoU of those, how far the full-resolution encoding
+# computed from its box moves from the reference encoding, and the median
+# detection latency.
+
+
+def iou(a, b):
+    top, right, bottom, left = max(a[0], b[0]), min(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3])
+    inter = max(0, right - left) * max(0, bottom - top)
+    area_a = (a[1] - a[3]) * (a[2] - a[0])
+    area_b = (b[1] - b[3]) * (b[2] - b[0])
+    return inter / float(area_a + area_b - inter) if inter else 0.0
+
+
+def rect_to_css(rect):
+    return rect.top(), rect.right(), rect.bottom(), rect.left()
+
+
+def timed(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append((time.perf_counter() - start) * 1000.0)
+    return result, float(np.median(timings))
+
+
+def evaluate(images, detector, short_side, upsample, encoding_upsample, repeat, reference):
+    matched = 0
+    total = 0
+    ious = []
+    encoding_shifts = []
+    detect_ms = []
+    locate_ms = []
+    for name, image in images:
+        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        faces, ms = timed(lambda: detect_faces(detector, gray, short_side, upsample), repeat)
+        detect_ms.append(ms)
+        locations, ms = timed(lambda: locate_faces(image, short_side, encoding_upsample), repeat)
+        locate_ms.append(ms)
+
+        ref_boxes, ref_locations, ref_encodings = reference[name]
+        boxes = [rect_to_css(face) for face in faces]
+        for refs, found in ((ref_boxes, boxes), (ref_locations, locations)):
+            for ref in refs:
+                total += 1
+                best = max((iou(ref, box) for box in found), default=0.0)
+                if best >= 0.5:
+                    matched += 1
+                    ious.append(best)
+        if locations and ref_locations:
+            encodings = face_recognition.face_encodings(image, locations)
+            for ref_encoding in ref_encodings:
+                encoding_shifts.append(float(np.min(np.linalg.norm(np.array(encodings) - ref_encoding, axis=1))))
+    return {
+        'shortSide': short_side or 'full',
+        'faceRecall': matched / total if total else None,
+        'meanIoU': float(np.mean(ious)) if ious else None,
+        'meanEncodingShift': float(np.mean(encoding_shifts)) if encoding_shifts else None,
+        'maxEncodingShift': float(np.max(encoding_shifts)) if encoding_shifts else None,
+        'detectFaceMedianMs': float(np.median(detect_ms)),
+        'locateFacesMedianMs': float(np.median(locate_ms)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark detection on downscaled frames')
+    parser.add_argument('images', help='directory of test images containing faces')
+    parser.add_argument('--short-sides', type=int, nargs='+', default=[0, 480, 360, 240, 180])
+    parser.add_argument('--upsample', type=int, default=0, help='DETECTION_UPSAMPLE')
+    parser.add_argument('--encoding-upsample', type=int, default=1, help='ENCODING_DETECTION_UPSAMPLE')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    images = []
+    for path in sorted(glob.glob(os.path.join(args.images, '*'))):
+        with open(path, 'rb') as f:
+            try:
+                images.append((os.path.basename(path), bytes_to_image(f.read())))
+            except ValueError:
+                print(f"Skipping {path}: not an image", file=sys.stderr)
+    if not images:
+        sys.exit(f"No images found in {args.images}")
+
+    detector = dlib.get_frontal_face_detector()
+    reference = {}
+    for name, image in images:
+        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        boxes = [rect_to_css(face) for face in detector(gray, args.upsample)]
+        locations = face_recognition.face_locations(image, number_of_times_to_upsample=args.encoding_upsample)
+        encodings = face_recognition.face_encodings(image, locations)
+        reference[name] = (boxes, locations, encodings)
+
+    report = {
+        'images': len(images),
+        'results': [evaluate(images, detector, short_side, args.upsample, args.encoding_upsample,
+                             args.repeat, reference)
+                    for short_side in args.short_sides],
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
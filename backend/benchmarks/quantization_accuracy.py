@@ -0,0 +1,123 @@
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from run_benchmarks import git_commit, percentiles  # noqa: E402
+
+# Match decisions of the compact float16 and int8 indexes against float64.
+#
+# Builds a synthetic gallery of --identities random 128-d identity centres
+# and queries it with noisy captures of enrolled people (genuine probes) and
+# of people who are not enrolled (impostor probes). The float64 reference
+# decision for each probe is the nearest identity if it lies within
+# --threshold, else no match. Each compact index, with and without exact
+# re-scoring, reports how often its decision agrees with the reference, how
+# often the nearest identity differs, the error of the reported distance,
+# its memory and its query latency. Distances are tuned to resemble dlib
+# encodings (same person around 0.4-0.6 apart, different people 0.8-1.0).
+
+
+def synthetic_set(identities, probes, rng, spread, noise):
+    centres = rng.normal(0.0, spread, size=(identities, 128))
+    genuine = centres[rng.integers(0, identities, size=probes)] + rng.normal(0.0, noise, size=(probes, 128))
+    impostors = rng.normal(0.0, spread, size=(probes, 128)) + rng.normal(0.0, noise, size=(probes, 128))
+    return centres, np.concatenate([genuine, impostors])
+
+
+def reference_matches(centres, queries, chunk_size=256):
+    # Nearest centre and its distance for every query, in float64
+    sq_norms = np.einsum('ij,ij->i', centres, centres)
+    nearest = np.empty(len(queries), dtype=np.int64)
+    distances = np.empty(len(queries))
+    for start in range(0, len(queries), chunk_size):
+        chunk = queries[start:start + chunk_size]
+        sq_dist = sq_norms[None, :] - 2.0 * (chunk @ centres.T) + np.einsum('ij,ij->i', chunk, chunk)[:, None]
+        nearest[start:start + chunk_size] = np.argmin(sq_dist, axis=1)
+        rows = np.arange(len(chunk))
+        distances[start:start + chunk_size] = np.sqrt(np.maximum(sq_dist[rows, nearest[start:start + chunk_size]], 0.0))
+    return nearest, distances
+
+
+def evaluate(index, queries, nearest, distances, threshold):
+    agree = 0
+    same_nearest = 0
+    errors = []
+    latencies = []
+    for query, ref_row, ref_distance in zip(queries, nearest, distances):
+        start = time.perf_counter()
+        user_id, distance = index.search(query, top_k=1)[0]
+        latencies.append((time.perf_counter() - start) * 1000.0)
+        row = int(user_id)
+        same_nearest += row == ref_row
+        errors.append(abs(distance - ref_distance) if row == ref_row else np.nan)
+        decision = row if distance <= threshold else None
+        reference = int(ref_row) if ref_distance <= threshold else None
+        agree += decision == reference
+    errors = np.asarray(errors)
+    return {
+        'decision_agreement': agree / len(queries),
+        'decision_disagreements': len(queries) - agree,
+        'nearest_agreement': same_nearest / len(queries),
+        'max_distance_error': float(np.nanmax(errors)) if np.isfinite(errors).any() else None,
+        'mean_distance_error': float(np.nanmean(errors)) if np.isfinite(errors).any() else None,
+        'latency': percentiles(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Accuracy of the float16 and int8 gallery indexes')
+    parser.add_argument('--identities', type=int, default=100000)
+    parser.add_argument('--probes', type=int, default=1000, help='genuine and impostor probes each')
+    parser.add_argument('--threshold', type=float, default=0.6)
+    parser.add_argument('--spread', type=float, default=0.055, help='std-dev of identity centres per dimension')
+    parser.add_argument('--noise', type=float, default=0.048, help='std-dev of capture noise per dimension')
+    parser.add_argument('--rerank', type=int, nargs='+', default=[0, 32])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    from ann_index import FlatIndex, create_index
+    from gallery import FaceGallery
+
+    rng = np.random.default_rng(args.seed)
+    centres, queries = synthetic_set(args.identities, args.probes, rng, args.spread, args.noise)
+    nearest, distances = reference_matches(centres, queries)
+
+    gallery = FaceGallery(initial_capacity=args.identities)
+    gallery.add_many([str(i) for i in range(args.identities)], centres)
+
+    report = {
+        'commit': git_commit(),
+        'identities': args.identities,
+        'queries': len(queries),
+        'threshold': args.threshold,
+        'reference_matches': int((distances <= args.threshold).sum()),
+        'reference_near_threshold': int((np.abs(distances - args.threshold) < 0.01).sum()),
+        'indexes': {},
+    }
+    flat = FlatIndex(gallery)
+    report['indexes']['float32'] = dict(evaluate(flat, queries, nearest, distances, args.threshold),
+                                        bytes=len(gallery) * (gallery.dim * 4 + 4))
+    for precision in ('float16', 'int8'):
+        for rerank in args.rerank:
+            index = create_index(gallery, precision, rerank=rerank, min_train_size=1)
+            index.sync()
+            report['indexes'][f'{precision}[rerank={rerank}]'] = dict(
+                evaluate(index, queries, nearest, distances, args.threshold), bytes=index.nbytes)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
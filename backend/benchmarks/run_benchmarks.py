@@ -0,0 +1,305 @@
+import argparse
+import base64
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+# Throughput and latency of the detect-face, register and verify endpoints.
+#
+# Replays a directory of local test images as raw JPEG/PNG request bodies,
+# either through the Flask test client (the default, which imports app.py in
+# a scratch user_data directory) or against a running server given with
+# --url. /api/verify runs against synthetic galleries of random 128-d
+# encodings of each --gallery-sizes size, with the corpus faces enrolled as
+# well so that the matching path is exercised; verify-claimed does 1:1
+# verification of each image against its own corpus id. Each endpoint is driven at
+# every --concurrency level and reports p50/p95/p99 latency and requests/s.
+# Microbenchmarks cover image decoding, detection, encoding and gallery
+# matching, and test-client runs also time the cold start from importing
+# app.py to the first detect-face response. The report is one JSON document
+# (stdout or --output) stamped with the git commit, so runs can be compared
+# across commits. Nothing is downloaded: the shape predictor must already be
+# in backend/.
+#
+# The corpus is replayed many times, so the encoding cache would turn every
+# request after the first pass into a cache hit. Test-client runs disable it
+# (ENCODING_CACHE_SIZE=0); start a server given with --url with
+# ENCODING_CACHE_SIZE=0 and DUPLICATE_DISTANCE=0 as well to measure full
+# detection and encoding.
+
+MODEL_FILE = 'shape_predictor_68_face_landmarks.dat'
+
+
+def percentiles(latencies_ms):
+    latencies_ms = np.asarray(latencies_ms)
+    return {
+        'p50_ms': float(np.percentile(latencies_ms, 50)),
+        'p95_ms': float(np.percentile(latencies_ms, 95)),
+        'p99_ms': float(np.percentile(latencies_ms, 99)),
+        'mean_ms': float(latencies_ms.mean()),
+    }
+
+
+def microbenchmark(fn, args, repeat):
+    # Median-friendly latency summary of fn over every item of args
+    timings = []
+    for _ in range(repeat):
+        for arg in args:
+            start = time.perf_counter()
+            fn(arg)
+            timings.append((time.perf_counter() - start) * 1000.0)
+    return dict(percentiles(timings), calls=len(timings))
+
+
+def load_corpus(image_dir):
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(image_dir, '*'))):
+        extension = os.path.splitext(path)[1].lower()
+        if extension in ('.jpg', '.jpeg', '.png'):
+            with open(path, 'rb') as f:
+                mimetype = 'image/png' if extension == '.png' else 'image/jpeg'
+                corpus.append((os.path.basename(path), mimetype, f.read()))
+    return corpus
+
+
+def synthetic_gallery(size, rng, chunk=100000):
+    from gallery import FaceGallery
+    gallery = FaceGallery(initial_capacity=max(size, 1))
+    for start in range(0, size, chunk):
+        count = min(chunk, size - start)
+        encodings = rng.normal(0.0, 0.09, size=(count, 128)).astype(np.float32)
+        gallery.add_many([f'synthetic-{start + i}' for i in range(count)], encodings)
+    return gallery
+
+
+class TestClientTarget:
+    # Requests through app.py's Flask test client, one client per thread
+
+    def __init__(self, app_module):
+        self.app_module = app_module
+        self._local = threading.local()
+
+    def post(self, path, body, mimetype, query=''):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app_module.app.test_client()
+        response = client.post(path + query, data=body, content_type=mimetype)
+        return response.status_code
+
+
+class HttpTarget:
+    # Requests against a running server, e.g. one started with serve.py
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def post(self, path, body, mimetype, query=''):
+        request = urllib.request.Request(self.url + path + query, data=body,
+                                         headers={'Content-Type': mimetype}, method='POST')
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code
+
+
+def drive(target, path, corpus, concurrency, requests, query=None):
+    # Send `requests` requests cycling through the corpus from `concurrency`
+    # threads; returns latency percentiles, throughput and status counts
+    def send(i):
+        name, mimetype, body = corpus[i % len(corpus)]
+        start = time.perf_counter()
+        status = target.post(path, body, mimetype, query(i) if query else '')
+        return (time.perf_counter() - start) * 1000.0, status
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(send, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    statuses = {}
+    for _, status in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return dict(percentiles([latency for latency, _ in results]),
+                requests=requests, concurrency=concurrency,
+                requests_per_second=requests / elapsed, statuses=statuses)
+
+
+def enroll_corpus(app_module, gallery, corpus):
+    # Add the corpus faces to a synthetic gallery so verify finds matches
+    import face_recognition
+    from image_io import bytes_to_image
+    for name, _, body in corpus:
+        image = bytes_to_image(body)
+        encodings = face_recognition.face_encodings(image)
+        if len(encodings) == 1:
+            gallery.add(f'corpus-{name}', encodings[0], name)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BACKEND_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_microbenchmarks(corpus, gallery_sizes, rng, repeat):
+    import cv2
+    import dlib
+    import face_recognition
+    from ann_index import FlatIndex
+    from face_detection import detect_faces, locate_faces
+    from image_io import base64_to_image, bytes_to_image
+
+    data_urls = [f'data:{mimetype};base64,{base64.b64encode(body).decode("ascii")}'
+                 for _, mimetype, body in corpus]
+    images = [bytes_to_image(body) for _, _, body in corpus]
+    grays = [cv2.cvtColor(image, cv2.COLOR_RGB2GRAY) for image in images]
+    detector = dlib.get_frontal_face_detector()
+    locations = [face_recognition.face_locations(image) for image in images]
+    single = [(image, loc) for image, loc in zip(images, locations) if len(loc) == 1]
+
+    report = {
+        'base64_to_image': microbenchmark(base64_to_image, data_urls, repeat),
+        'bytes_to_image': microbenchmark(bytes_to_image, [body for _, _, body in corpus], repeat),
+        'detect_faces': microbenchmark(lambda gray: detect_faces(detector, gray, 0, 0), grays, repeat),
+        'locate_faces': microbenchmark(lambda image: locate_faces(image, 0, 1), images, repeat),
+    }
+    if single:
+        report['face_encodings'] = microbenchmark(
+            lambda item: face_recognition.face_encodings(item[0], item[1]), single, repeat)
+
+    report['match'] = {}
+    for size in gallery_sizes:
+        gallery = synthetic_gallery(size, rng)
+        queries = rng.normal(0.0, 0.09, size=(100, 128)).astype(np.float32)
+        report['match'][str(size)] = microbenchmark(FlatIndex(gallery).search, queries, repeat)
+        del gallery
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Endpoint and hot-path benchmarks')
+    parser.add_argument('--images', required=True, help='directory of local JPEG/PNG test images')
+    parser.add_argument('--url', help='benchmark a running server instead of the Flask test client')
+    parser.add_argument('--gallery-sizes', type=int, nargs='+', default=[1000, 100000, 1000000])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint and concurrency')
+    parser.add_argument('--endpoints', nargs='+', default=['detect-face', 'register', 'verify'],
+                        choices=['detect-face', 'register', 'verify', 'verify-claimed'])
+    parser.add_argument('--repeat', type=int, default=3, help='passes over the corpus per microbenchmark')
+    parser.add_argument('--skip-micro', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.images)
+    if not corpus:
+        parser.error(f'no JPEG or PNG images in {args.images}')
+    rng = np.random.default_rng(args.seed)
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'cpus': os.cpu_count(),
+        'images': len(corpus),
+        'target': args.url or 'test-client',
+        'endpoints': {},
+    }
+
+    if args.url:
+        target = HttpTarget(args.url)
+        app_module = None
+    else:
+        # Import the app in a scratch directory so registrations and the
+        # synthetic galleries never touch real user data
+        model_path = os.path.join(BACKEND_DIR, MODEL_FILE)
+        if not os.path.exists(model_path):
+            parser.error(f'{model_path} is missing; run download_model.py first')
+        workdir = tempfile.mkdtemp(prefix='faceguard-bench-')
+        os.symlink(model_path, os.path.join(workdir, MODEL_FILE))
+        os.chdir(workdir)
+        os.environ.setdefault('LOG_LEVEL', 'WARNING')
+        # The corpus is registered over and over; measure full registrations
+        # rather than duplicate refusals
+        os.environ.setdefault('DUPLICATE_DISTANCE', '0')
+        # ... and uncached detection and encoding rather than cache hits
+        os.environ.setdefault('ENCODING_CACHE_SIZE', '0')
+        start = time.perf_counter()
+        import app as app_module
+        app_module.init_app()
+        imported = time.perf_counter() - start
+        from ann_index import create_index
+        target = TestClientTarget(app_module)
+        report['workdir'] = workdir
+        # Cold start: the app starts without waiting for the models, which
+        # load in the background
+        if not app_module.models.wait():
+            sys.exit(f'Face models failed to load: {app_module.models.error}')
+        ready = time.perf_counter() - start
+        _, mimetype, body = corpus[0]
+        target.post('/api/detect-face', body, mimetype)
+        report['cold_start'] = {
+            'import_s': imported,
+            'models_ready_s': ready,
+            'first_request_s': time.perf_counter() - start,
+            'model_timings_s': app_module.models.timings,
+        }
+
+    for endpoint in args.endpoints:
+        # verify-claimed sends each image's own corpus id as the claimed
+        # userId, for 1:1 verification
+        query = None
+        if endpoint == 'register':
+            query = lambda i: f'?name=bench-{i}'
+        elif endpoint == 'verify-claimed':
+            query = lambda i: '?userId=' + urllib.parse.quote(f'corpus-{corpus[i % len(corpus)][0]}')
+        if endpoint.startswith('verify') and app_module is not None:
+            # Swap in each synthetic gallery; the server's own gallery is
+            # benchmarked as-is in --url mode
+            for size in args.gallery_sizes:
+                gallery = synthetic_gallery(size, rng)
+                enroll_corpus(app_module, gallery, corpus)
+                app_module.gallery = gallery
+                app_module.face_index = create_index(gallery, 'flat')
+                report['endpoints'][f'{endpoint}[{size}]'] = [
+                    drive(target, '/api/verify', corpus, concurrency, args.requests, query)
+                    for concurrency in args.concurrency]
+            continue
+        path = '/api/verify' if endpoint == 'verify-claimed' else f'/api/{endpoint}'
+        report['endpoints'][endpoint] = [
+            drive(target, path, corpus, concurrency, args.requests, query)
+            for concurrency in args.concurrency]
+
+    if not args.skip_micro:
+        report['micro'] = run_microbenchmarks(corpus, args.gallery_sizes, rng, args.repeat)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from run_benchmarks import git_commit, percentiles, synthetic_gallery  # noqa: E402
+
+# Query latency of the sharded gallery index as shards are added.
+#
+# Builds one synthetic gallery of --gallery-size random 128-d encodings and
+# times --queries 1:N searches against the production default, FACE_INDEX=flat
+# (one process, BLAS with its default threads), and against a ShardedIndex
+# with each of --shards shard processes, checking that every configuration
+# returns the same nearest match. Each sharded run reports its speedup over
+# the flat index and its scaling over the 1-shard run. A final phase keeps
+# querying from a background thread while the index is resized up and down,
+# and reports the latency and any wrong answers seen meanwhile.
+#
+# Exits with status 1 if a configuration of n >= 2 shards returns a
+# different nearest match, or scales by less than
+# --min-efficiency * min(n, cpus) over one shard (scaling is bounded by the
+# cores, reported as "cpus"), so a machine where sharding does not pay off
+# fails loudly.
+
+
+def required_scaling(shards, efficiency):
+    # Least p50 speedup over one shard expected from `shards` shards
+    return efficiency * min(shards, os.cpu_count() or 1)
+
+
+def time_queries(index, queries, top_k):
+    latencies = []
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(index.search(query, top_k=top_k))
+        latencies.append((time.perf_counter() - start) * 1000.0)
+    return percentiles(latencies), [matches[0][0] for matches in results]
+
+
+def resize_under_load(index, queries, expected, sizes):
+    # Resize through each of sizes while a thread keeps querying
+    latencies = []
+    wrong = 0
+    stop = threading.Event()
+
+    def query_loop():
+        nonlocal wrong
+        i = 0
+        while not stop.is_set():
+            start = time.perf_counter()
+            matches = index.search(queries[i % len(queries)], top_k=1)
+            latencies.append((time.perf_counter() - start) * 1000.0)
+            wrong += matches[0][0] != expected[i % len(queries)]
+            i += 1
+
+    thread = threading.Thread(target=query_loop, daemon=True)
+    thread.start()
+    resizes = []
+    for size in sizes:
+        start = time.perf_counter()
+        index.resize(size)
+        resizes.append({'shards': size, 'seconds': time.perf_counter() - start})
+    stop.set()
+    thread.join()
+    return {
+        'resizes': resizes,
+        'queries': len(latencies),
+        'wrong_answers': wrong,
+        'latency': percentiles(latencies) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sharded gallery scaling benchmark')
+    parser.add_argument('--gallery-size', type=int, default=1000000)
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--resize', type=int, nargs='*', default=[4, 2],
+                        help='shard counts to resize through under load (none to skip)')
+    parser.add_argument('--min-efficiency', type=float, default=0.7,
+                        help='fail if n shards are less than this x min(n, cpus) faster than one shard')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    from ann_index import FlatIndex
+    from sharded_index import ShardedIndex
+
+    rng = np.random.default_rng(args.seed)
+    gallery = synthetic_gallery(args.gallery_size, rng)
+    # Probes near enrolled encodings, so each has a well-defined nearest match
+    rows = rng.integers(0, args.gallery_size, size=args.queries)
+    _, encodings = gallery.rows(0, len(gallery))
+    queries = encodings[rows] + rng.normal(0.0, 0.02, size=(args.queries, 128)).astype(np.float32)
+
+    baseline, expected = time_queries(FlatIndex(gallery), queries, args.top_k)
+    report = {
+        'commit': git_commit(),
+        'cpus': os.cpu_count(),
+        'gallery_size': args.gallery_size,
+        'queries': args.queries,
+        'top_k': args.top_k,
+        'flat': baseline,
+        'sharded': [],
+    }
+
+    # The 1-shard run is the baseline that scaling is measured against
+    for shards in sorted(set(args.shards) | {1}):
+        index = ShardedIndex(gallery, shards=shards)
+        start = time.perf_counter()
+        index.sync()
+        load_seconds = time.perf_counter() - start
+        index.search(queries[0], top_k=args.top_k)
+        latency, nearest = time_queries(index, queries, args.top_k)
+        report['sharded'].append({
+            'shards': shards,
+            'load_seconds': load_seconds,
+            'latency': latency,
+            'speedup_p50': baseline['p50_ms'] / latency['p50_ms'],
+            'scaling_p50': report['sharded'][0]['latency']['p50_ms'] / latency['p50_ms']
+            if report['sharded'] else 1.0,
+            'matches_flat': nearest == expected,
+        })
+        if shards == max(args.shards) and args.resize:
+            report['resize_under_load'] = dict(
+                resize_under_load(index, queries, expected, args.resize), from_shards=shards)
+        index.close()
+
+    failures = [entry['shards'] for entry in report['sharded'] if entry['shards'] >= 2 and (
+        entry['scaling_p50'] < required_scaling(entry['shards'], args.min_efficiency)
+        or not entry['matches_flat'])]
+    report['min_efficiency'] = args.min_efficiency
+    report['passed'] = not failures
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if failures:
+        print(f"Sharding with {', '.join(map(str, failures))} shards scales by less than "
+              f"{args.min_efficiency} x min(shards, cpus) over one shard, or disagrees with flat",
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
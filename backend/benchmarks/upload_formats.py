@@ -0,0 +1,88 @@
+import argparse
+import base64
+import glob
+import io
+import json
+import os
+import sys
+import time
+import cv2
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from image_io import base64_to_image, bytes_to_image
+
+# Payload size and decode latency of the binary upload path against the
+# legacy base64 JSON data URL path.
+#
+# For each image the legacy request body is the JSON the frontend used to
+# send ({"image": "data:image/jpeg;base64,..."}) decoded the way the server
+# used to (split, b64decode, PIL open, np.array). The binary body is the JPEG
+# bytes themselves, decoded with a single cv2.imdecode.
+
+
+def legacy_decode(body):
+    image_data = json.loads(body)['image']
+    if ',' in image_data:
+        image_data = image_data.split(',')[1]
+    image_bytes = base64.b64decode(image_data)
+    return np.array(Image.open(io.BytesIO(image_bytes)))
+
+
+def synthetic_frame(width=640, height=480, seed=0):
+    # Smooth gradient with noise, close to a webcam frame in JPEG size
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    frame = np.stack([x * 255 / width, y * 255 / height, (x + y) * 127 / (width + height)], axis=2)
+    frame += rng.normal(0, 12, frame.shape)
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+
+def load_jpegs(image_dir):
+    if not image_dir:
+        ok, encoded = cv2.imencode('.jpg', synthetic_frame(), [cv2.IMWRITE_JPEG_QUALITY, 80])
+        return [('synthetic-640x480', encoded.tobytes())]
+    jpegs = []
+    for path in sorted(glob.glob(os.path.join(image_dir, '*'))):
+        with open(path, 'rb') as f:
+            jpegs.append((os.path.basename(path), f.read()))
+    return jpegs
+
+
+def time_ms(fn, arg, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(arg)
+        timings.append((time.perf_counter() - start) * 1000.0)
+    return float(np.median(timings))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare binary and base64 JSON image uploads')
+    parser.add_argument('--images', help='directory of JPEG/PNG files (default: one synthetic frame)')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    results = []
+    for name, jpeg in load_jpegs(args.images):
+        json_body = json.dumps({
+            'image': 'data:image/jpeg;base64,' + base64.b64encode(jpeg).decode('ascii')
+        }).encode('utf-8')
+        results.append({
+            'image': name,
+            'binaryBytes': len(jpeg),
+            'jsonBase64Bytes': len(json_body),
+            'payloadInflation': len(json_body) / len(jpeg),
+            'legacyDecodeMs': time_ms(legacy_decode, json_body, args.repeat),
+            'base64DecodeMs': time_ms(lambda body: base64_to_image(json.loads(body)['image']),
+                                      json_body, args.repeat),
+            'binaryDecodeMs': time_ms(bytes_to_image, jpeg, args.repeat),
+        })
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,278 @@
+import csv
+import hashlib
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import zipfile
+import config
+from background import BoundedExecutor
+from face_detection import locate_faces
+from image_io import bytes_to_image
+from profile_pictures import FORMATS, save_profile_picture
+
+# Bulk enrollment from a directory, an archive or a batch of uploads.
+#
+# Uploaded images and archive entries are copied to files one at a time
+# (save_source, extract_archive), so no import is ever held in memory, and
+# are named by a hash of their key, never by a name taken from the upload.
+#
+# Images are encoded across a process pool. Each result (an encoding and a
+# staged copy of the profile picture, or the reason the image was rejected)
+# is recorded against the import in the user store as it arrives, so an
+# interrupted import resumes where it stopped: items already staged are not
+# encoded again. Once every item is staged, all enrolled users are created
+# in one database transaction, their pictures are moved into place and
+# their encodings are appended to the gallery in one batch. Both of those
+# last steps are repeated on the next run if a crash cut them short.
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+# Results recorded per user store transaction while encoding
+STAGE_BATCH_SIZE = 100
+
+# Bytes copied at a time when saving uploads and archive entries
+COPY_CHUNK_SIZE = 1 << 20
+
+# Import ids name directories under the staging directory
+IMPORT_ID_PATTERN = re.compile(r'[0-9A-Za-z_-]{1,64}')
+
+logger = logging.getLogger(__name__)
+
+
+def name_from_key(key):
+    # "people/Jane_Doe.jpg" -> "Jane Doe"
+    stem = os.path.splitext(os.path.basename(key))[0]
+    return stem.replace('_', ' ').strip() or stem
+
+
+def load_names(csv_path):
+    # Optional filename,name manifest overriding names taken from file names
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        return {row[0]: row[1] for row in csv.reader(f) if len(row) >= 2}
+
+
+def directory_items(directory, names=None):
+    # (key, name, path) for every image below directory, keyed by relative path
+    names = names or {}
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for filename in sorted(files):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(root, filename)
+                key = os.path.relpath(path, directory).replace(os.sep, '/')
+                yield key, names.get(key) or names.get(filename) or name_from_key(key), path
+
+
+def sources_dir(staging_dir, import_id):
+    # Where an import's uploaded images wait to be encoded; '.sources' cannot
+    # be an import id, so it never collides with an import's staging dir
+    return os.path.join(staging_dir, '.sources', import_id)
+
+
+def source_path(directory, key):
+    # Where the image with this key is saved while it waits to be encoded
+    extension = os.path.splitext(key)[1].lower()
+    if extension not in IMAGE_EXTENSIONS:
+        extension = ''
+    return os.path.join(directory, hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest() + extension)
+
+
+class ImportLimitError(ValueError):
+    # An upload or archive beyond the limits on what one import may hold
+    pass
+
+
+def save_source(stream, path, max_bytes=None):
+    # Copy a file object to path without reading it into memory at once,
+    # refusing it once more than max_bytes have been read
+    copied = 0
+    with open(path, 'wb') as f:
+        while True:
+            chunk = stream.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            copied += len(chunk)
+            if max_bytes is not None and copied > max_bytes:
+                raise ImportLimitError(f'Upload is larger than {max_bytes} bytes')
+            f.write(chunk)
+    return path
+
+
+def extract_archive(archive, directory, names=None, max_images=None, max_bytes=None):
+    # (key, name, path) for every image in a zip archive (path or file
+    # object), each entry copied to its own file in directory. Archives of
+    # more than max_images images or max_bytes uncompressed are refused,
+    # going by the sizes they declare and then by the bytes actually read
+    names = names or {}
+    os.makedirs(directory, exist_ok=True)
+    items = []
+    with zipfile.ZipFile(archive) as zf:
+        entries = [info for info in zf.infolist()
+                   if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTENSIONS)]
+        if max_images is not None and len(entries) > max_images:
+            raise ImportLimitError(f'Archive holds {len(entries)} images; at most {max_images} are accepted')
+        if max_bytes is not None and sum(info.file_size for info in entries) > max_bytes:
+            raise ImportLimitError(f'Archive images are larger than {max_bytes} bytes uncompressed')
+        remaining = max_bytes
+        for info in entries:
+            key = info.filename
+            name = names.get(key) or names.get(os.path.basename(key)) or name_from_key(key)
+            with zf.open(info) as entry:
+                path = save_source(entry, source_path(directory, key), remaining)
+            if remaining is not None:
+                remaining -= os.path.getsize(path)
+            items.append((key, name, path))
+    return items
+
+
+def _load_models():
+    # Pool initializer: load face_recognition's models once per worker
+    import face_recognition  # noqa: F401
+
+
+def encode_item(task):
+    # Runs in a pool worker. Encodes one image and saves its profile picture
+    # to staged_picture; failures are returned, not raised
+    key, name, source, staged_picture = task
+    result = {'key': key, 'name': name, 'status': 'ok', 'message': None, 'encoding': None, 'picture': None}
+    try:
+        if isinstance(source, str):
+            with open(source, 'rb') as f:
+                source = f.read()
+        image = bytes_to_image(source)
+        face_locations = locate_faces(image, config.DETECTION_SHORT_SIDE, config.ENCODING_DETECTION_UPSAMPLE)
+        if not face_locations:
+            result.update(status='no_face', message='No face detected in the image')
+        elif len(face_locations) > 1:
+            result.update(status='multiple_faces',
+                          message=f'{len(face_locations)} faces detected; exactly one is required')
+        else:
+            import face_recognition
+            result['encoding'] = face_recognition.face_encodings(image, face_locations)[0]
+            # Smaller variants are generated when first requested
+            save_profile_picture(image, staged_picture, config.PROFILE_PICTURE_QUALITY, variants=False)
+            result['picture'] = staged_picture
+    except Exception as e:
+        result.update(status='error', message=str(e))
+    return result
+
+
+def _pool_context(start_method=None):
+    # Forked workers inherit models the parent already loaded, which is only
+    # safe from a single-threaded process such as the CLI; the server asks
+    # for 'spawn'. spawn is also the fallback where fork is unavailable
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context(start_method or ('fork' if 'fork' in methods else 'spawn'))
+
+
+def run_import(user_store, gallery, items, import_id, staging_dir, picture_dir,
+               workers=None, source=None, progress=None, start_method=None):
+    # Import (key, name, path-or-bytes) items; returns a summary with the
+    # created users and every rejected item. progress(done, total) is called
+    # as results are staged.
+    if not IMPORT_ID_PATTERN.fullmatch(import_id):
+        raise ValueError(f'Invalid import id {import_id!r}')
+    if user_store.start_import(import_id, source) is None:
+        import_staging_dir = os.path.join(staging_dir, import_id)
+        os.makedirs(import_staging_dir, exist_ok=True)
+        staged = user_store.staged_import_keys(import_id)
+        extension = FORMATS[config.PROFILE_PICTURE_FORMAT]
+        tasks = []
+        for key, name, item_source in items:
+            if key not in staged:
+                staged.add(key)
+                picture = hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest() + extension
+                tasks.append((key, name, item_source, os.path.join(import_staging_dir, picture)))
+
+        if tasks:
+            logger.info("Encoding %d images for import %s", len(tasks), import_id)
+            done = 0
+            pending = []
+            with _pool_context(start_method).Pool(workers or None, initializer=_load_models) as pool:
+                for result in pool.imap_unordered(encode_item, tasks, chunksize=4):
+                    pending.append(result)
+                    if len(pending) >= STAGE_BATCH_SIZE:
+                        user_store.stage_import_items(import_id, pending)
+                        done += len(pending)
+                        pending = []
+                        if progress:
+                            progress(done, len(tasks))
+            user_store.stage_import_items(import_id, pending)
+            if progress:
+                progress(len(tasks), len(tasks))
+
+        user_store.commit_import(import_id, lambda user_id: os.path.join(picture_dir, user_id + extension))
+
+    _finish_import(user_store, gallery, import_id, os.path.join(staging_dir, import_id))
+    return import_summary(user_store, import_id)
+
+
+def _finish_import(user_store, gallery, import_id, import_staging_dir):
+    # Move staged pictures into place and append the import's encodings to
+    # the gallery; both are no-ops for steps an earlier run completed
+    for staged_picture, profile_picture in user_store.import_pictures(import_id):
+        if os.path.exists(staged_picture):
+            os.replace(staged_picture, profile_picture)
+    if os.path.isdir(import_staging_dir) and not os.listdir(import_staging_dir):
+        os.rmdir(import_staging_dir)
+
+    user_ids = [item['userId'] for item in user_store.import_items(import_id) if item['userId']]
+    if user_ids:
+        gallery.refresh()
+        mapped = set(gallery.rows(0, len(gallery))[0])
+        missing = [user_id for user_id in user_ids if user_id not in mapped]
+        if missing:
+            gallery.add_many(*user_store.load_encodings(missing))
+            logger.info("Added %d encodings from import %s to the gallery", len(missing), import_id)
+
+
+def import_summary(user_store, import_id):
+    items = user_store.import_items(import_id)
+    failures = [item for item in items if item['status'] != 'ok']
+    counts = {}
+    for item in items:
+        counts[item['status']] = counts.get(item['status'], 0) + 1
+    return {
+        'importId': import_id,
+        'total': len(items),
+        'enrolled': len(items) - len(failures),
+        'failed': len(failures),
+        'statusCounts': counts,
+        'users': [{'key': item['key'], 'userId': item['userId'], 'name': item['name']}
+                  for item in items if item['status'] == 'ok'],
+        'failures': [{'key': item['key'], 'status': item['status'], 'message': item['message']}
+                     for item in failures],
+    }
+
+
+class ImportQueue:
+    # Bulk imports run one at a time on a background thread. submit() marks
+    # the import queued in the user store and returns straight away; the
+    # import's status (queued, processing, completed or failed) and its
+    # summary so far are then read from the store, so any worker process
+    # can answer status requests.
+
+    def __init__(self, user_store, max_pending=4):
+        self.user_store = user_store
+        self.max_pending = max_pending
+        self._executor = BoundedExecutor(1, max_pending, 'import')
+
+    def submit(self, import_id, run):
+        # Queue run() for the import; False if the queue is full
+        future = self._executor.submit(self._run, import_id, run,
+                                       before=lambda: self.user_store.update_import(import_id, 'queued'))
+        return future is not None
+
+    def pending(self):
+        return self._executor.pending()
+
+    def _run(self, import_id, run):
+        try:
+            self.user_store.update_import(import_id, 'processing')
+            run()
+            self.user_store.update_import(import_id, 'completed')
+        except Exception as e:
+            logger.exception("Import %s failed", import_id)
+            self.user_store.update_import(import_id, 'failed', str(e))
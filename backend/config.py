@@ -0,0 +1,137 @@
+import os
+
+# Server settings that vary between deployments. Each one can be overridden
+# with an environment variable of the same name.
+
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, '') else default
+
+
+def _env_float(name, default):
+    value = os.environ.get(name)
+    return float(value) if value not in (None, '') else default
+
+
+def _env_str(name, default):
+    value = os.environ.get(name)
+    return value if value not in (None, '') else default
+
+
+# Nearest-neighbour index behind /api/verify: 'flat' (exact scan), 'ivfpq',
+# a scan of a compact 'float16' or 'int8' copy of the gallery, or an exact
+# scan split across FACE_INDEX_SHARDS 'sharded' processes (0 = one per core).
+# serve.py starts the shards once and all its workers query them. The shard
+# count can be changed at runtime through POST /api/face-index/shards
+FACE_INDEX = _env_str('FACE_INDEX', 'flat')
+FACE_INDEX_SHARDS = _env_int('FACE_INDEX_SHARDS', 0)
+
+# IVF-PQ tuning. A larger nprobe/rerank improves recall at the cost of latency;
+# an nlist of 0 sizes the coarse quantizer from the gallery at training time.
+# The float16 and int8 indexes re-score FACE_INDEX_RERANK candidates exactly
+FACE_INDEX_NLIST = _env_int('FACE_INDEX_NLIST', 0)
+FACE_INDEX_NPROBE = _env_int('FACE_INDEX_NPROBE', 16)
+FACE_INDEX_RERANK = _env_int('FACE_INDEX_RERANK', 128)
+FACE_INDEX_PQ_M = _env_int('FACE_INDEX_PQ_M', 16)
+FACE_INDEX_MIN_TRAIN_SIZE = _env_int('FACE_INDEX_MIN_TRAIN_SIZE', 20000)
+
+# Micro-batching of face encodings across concurrent requests. A batch runs
+# once it holds ENCODING_BATCH_MAX_SIZE faces or its oldest request has waited
+# ENCODING_BATCH_MAX_WAIT_MS; a max size of 1 encodes each request directly
+ENCODING_BATCH_MAX_SIZE = _env_int('ENCODING_BATCH_MAX_SIZE', 8)
+ENCODING_BATCH_MAX_WAIT_MS = _env_float('ENCODING_BATCH_MAX_WAIT_MS', 5.0)
+
+# Face tracking between detect-face frames of one session. The full-frame
+# detector runs every TRACKING_REDETECT_INTERVAL frames or when the face is
+# lost; other frames only search around the previous box
+TRACKING_REDETECT_INTERVAL = _env_int('TRACKING_REDETECT_INTERVAL', 10)
+TRACKING_MIN_SCORE = _env_float('TRACKING_MIN_SCORE', 0.2)
+
+# Detect-face sessions answer a frame that differs from the last analyzed one
+# by less than FRAME_DIFF_THRESHOLD grey levels (mean absolute difference of
+# small grayscale thumbnails of the frame and of the face) with the last
+# result instead of analyzing it; at most FRAME_DIFF_MAX_REUSE frames in a
+# row. 0 disables the short-circuit
+FRAME_DIFF_THRESHOLD = _env_float('FRAME_DIFF_THRESHOLD', 3.0)
+FRAME_DIFF_MAX_REUSE = _env_int('FRAME_DIFF_MAX_REUSE', 4)
+
+# Detect-face sessions expire after this long without a frame
+SESSION_TTL_SECONDS = _env_float('SESSION_TTL_SECONDS', 60.0)
+MAX_SESSIONS = _env_int('MAX_SESSIONS', 1000)
+
+# Detection runs on a copy of the frame scaled so its short side is this many
+# pixels (0 = full resolution); landmarks and encodings always use the full
+# frame. The upsample counts apply to the scaled frame in /api/detect-face
+# and in /api/register and /api/verify respectively
+DETECTION_SHORT_SIDE = _env_int('DETECTION_SHORT_SIDE', 0)
+DETECTION_UPSAMPLE = _env_int('DETECTION_UPSAMPLE', 0)
+ENCODING_DETECTION_UPSAMPLE = _env_int('ENCODING_DETECTION_UPSAMPLE', 1)
+
+# Logging. LOG_FORMAT is 'text' (key=value fields) or 'json'; at DEBUG, one in
+# every LOG_FRAME_SAMPLE_EVERY per-frame detect-face records is written
+LOG_LEVEL = _env_str('LOG_LEVEL', 'INFO')
+LOG_FORMAT = _env_str('LOG_FORMAT', 'text')
+LOG_FRAME_SAMPLE_EVERY = _env_int('LOG_FRAME_SAMPLE_EVERY', 100)
+
+# Add a Server-Timing header with the per-stage breakdown of each request
+SERVER_TIMING = _env_int('SERVER_TIMING', 0)
+
+# Encoding processes used by /api/register/bulk (0 = one per core). Imports
+# run one at a time in the background; at most BULK_IMPORT_QUEUE_SIZE wait
+BULK_ENROLL_WORKERS = _env_int('BULK_ENROLL_WORKERS', 0)
+BULK_IMPORT_QUEUE_SIZE = _env_int('BULK_IMPORT_QUEUE_SIZE', 4)
+
+# Largest request body accepted, and the most images and uncompressed image
+# bytes one bulk import may hold; larger uploads are refused with 413
+MAX_UPLOAD_BYTES = _env_int('MAX_UPLOAD_BYTES', 1 << 30)
+BULK_IMPORT_MAX_IMAGES = _env_int('BULK_IMPORT_MAX_IMAGES', 10000)
+BULK_IMPORT_MAX_BYTES = _env_int('BULK_IMPORT_MAX_BYTES', 4 << 30)
+
+# Faces and encodings of recently submitted images, keyed by a hash of the
+# image bytes (a size of 0 disables the cache)
+ENCODING_CACHE_SIZE = _env_int('ENCODING_CACHE_SIZE', 1024)
+ENCODING_CACHE_TTL_SECONDS = _env_float('ENCODING_CACHE_TTL_SECONDS', 300.0)
+
+# Profile pictures: 'jpeg' or 'webp', the encoder quality, and how long
+# clients may cache them (seconds)
+PROFILE_PICTURE_FORMAT = _env_str('PROFILE_PICTURE_FORMAT', 'jpeg')
+PROFILE_PICTURE_QUALITY = _env_int('PROFILE_PICTURE_QUALITY', 85)
+PROFILE_PICTURE_MAX_AGE = _env_int('PROFILE_PICTURE_MAX_AGE', 30 * 24 * 3600)
+
+# Background registrations (/api/registrations): worker threads per process
+# and the most jobs one process queues before answering 503
+REGISTRATION_WORKERS = _env_int('REGISTRATION_WORKERS', 2)
+REGISTRATION_QUEUE_SIZE = _env_int('REGISTRATION_QUEUE_SIZE', 100)
+
+# Multi-sample templates: samples kept per user as exemplars, and how many of
+# the best index candidates /api/verify re-scores against them (0 = none)
+TEMPLATE_MAX_EXEMPLARS = _env_int('TEMPLATE_MAX_EXEMPLARS', 5)
+TEMPLATE_RESCORE_CANDIDATES = _env_int('TEMPLATE_RESCORE_CANDIDATES', 5)
+
+# A registration whose face is within this distance of an enrolled user is a
+# duplicate: its samples are added to that user if the names match and it is
+# refused otherwise (0 disables the check). At most REGISTRATION_MAX_SAMPLES
+# images are accepted per registration
+DUPLICATE_DISTANCE = _env_float('DUPLICATE_DISTANCE', 0.4)
+REGISTRATION_MAX_SAMPLES = _env_int('REGISTRATION_MAX_SAMPLES', 10)
+
+# Largest face distance /api/verify accepts as a match, for both 1:N search
+# and 1:1 verification of a claimed userId. Also bounds how far apart the
+# samples of one registration may be
+MATCH_THRESHOLD = _env_float('MATCH_THRESHOLD', 0.6)
+
+# Most candidates a 1:N /api/verify request may ask for with topK, so one
+# probe cannot list the enrolled users
+VERIFY_MAX_TOP_K = _env_int('VERIFY_MAX_TOP_K', 10)
+
+# Liveness: with LIVENESS_REQUIRED set, /api/verify only runs for requests
+# carrying a token that a detect-face session earned by blinking, sent with
+# the same session id. Each token is accepted once. Tokens are signed with
+# LIVENESS_SECRET, which must be shared by every server process (by default
+# a random secret per server start, shared by serve.py's forked workers).
+# A session stays live, and keeps receiving fresh tokens, for
+# LIVENESS_TOKEN_TTL_SECONDS after its blink
+LIVENESS_REQUIRED = _env_int('LIVENESS_REQUIRED', 0)
+LIVENESS_SECRET = _env_str('LIVENESS_SECRET', '')
+LIVENESS_TOKEN_TTL_SECONDS = _env_float('LIVENESS_TOKEN_TTL_SECONDS', 30.0)
@@ -0,0 +1,157 @@
+import json
+import os
+import struct
+import threading
+from contextlib import contextmanager
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are only serialized within one process
+    fcntl = None
+
+# Fixed-stride binary file of float32 face encodings.
+#
+# Layout: a 64-byte header (magic, version, dimension) followed by one
+# little-endian float32 row per encoding. The server memory-maps the rows at
+# boot instead of parsing JSON, and every worker process maps the same file,
+# so the pages are shared through the OS page cache.
+#
+# A JSON-lines sidecar (<path>.meta.jsonl) maps each row to its user id and
+# name, and a binary one (<path>.norms) holds the squared norm of each row as
+# a float32, so opening the gallery does not read every row to compute them.
+# Rows and norms are written before their JSON line, so the number of
+# complete JSON lines is always the number of valid rows; a torn tail left by
+# a crash is cut off on the next append.
+#
+# Boot cost is therefore one pass over the JSON sidecar to map user ids to
+# rows, which is linear in the number of users, but no encoding pages are
+# read until a search touches them.
+
+MAGIC = b'FGEMB\x00\x00\x00'
+VERSION = 1
+HEADER = struct.Struct('<8sII48x')
+
+
+class EmbeddingFile:
+
+    def __init__(self, path, dim=128):
+        self.path = path
+        self.meta_path = path + '.meta.jsonl'
+        self.norms_path = path + '.norms'
+        self.dim = dim
+        self.stride = dim * 4
+        self._lock = threading.RLock()
+        self._meta_offset = 0
+        self.user_ids = []
+        self.names = []
+
+        if not os.path.exists(self.path):
+            with open(self.path, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION, dim))
+            open(self.meta_path, 'w').close()
+        elif not os.path.exists(self.meta_path):
+            open(self.meta_path, 'w').close()
+
+        with open(self.path, 'rb') as f:
+            magic, version, file_dim = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{self.path} is not a face embedding file')
+        if file_dim != dim:
+            raise ValueError(f'{self.path} stores {file_dim}-d encodings, expected {dim}')
+        self.refresh()
+        self._complete_norms()
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def refresh(self):
+        # Pick up rows appended since the last call (possibly by another
+        # process) and return the total row count
+        with self._lock:
+            with open(self.meta_path, 'rb') as f:
+                f.seek(self._meta_offset)
+                data = f.read()
+            end = data.rfind(b'\n') + 1
+            for line in data[:end].splitlines():
+                entry = json.loads(line)
+                self.user_ids.append(entry['userId'])
+                self.names.append(entry.get('name'))
+            self._meta_offset += end
+            return len(self.user_ids)
+
+    @contextmanager
+    def _exclusive(self):
+        # Held while writing, across threads and (where flock exists) processes
+        with self._lock, open(self.meta_path, 'ab') as meta:
+            if fcntl is not None:
+                fcntl.flock(meta.fileno(), fcntl.LOCK_EX)
+            try:
+                yield meta
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(meta.fileno(), fcntl.LOCK_UN)
+
+    def _stored_norms(self):
+        return os.path.getsize(self.norms_path) // 4 if os.path.exists(self.norms_path) else 0
+
+    def _complete_norms(self):
+        # Compute the norms missing from the norms sidecar, i.e. all of them
+        # for a file written before the sidecar existed
+        if self._stored_norms() >= len(self):
+            return
+        with self._exclusive():
+            count = self.refresh()
+            stored = self._stored_norms()
+            if stored >= count:
+                return
+            rows = self.matrix(count)[stored:]
+            with open(self.norms_path, 'ab') as f:
+                f.truncate(stored * 4)
+                f.write(np.einsum('ij,ij->i', rows, rows).astype('<f4').tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+    def sq_norms(self, start, end):
+        # Squared norms of rows [start, end)
+        norms = np.fromfile(self.norms_path, dtype='<f4', count=end - start, offset=start * 4)
+        if len(norms) < end - start:
+            # Not yet written by another process's _complete_norms()
+            rows = self.matrix(end)[start:end]
+            norms = np.einsum('ij,ij->i', rows, rows)
+        return norms.astype(np.float32)
+
+    def matrix(self, count=None):
+        # Read-only (count x dim) view of the stored rows
+        count = len(self) if count is None else count
+        if count == 0:
+            return np.empty((0, self.dim), dtype=np.float32)
+        return np.memmap(self.path, dtype='<f4', mode='r',
+                         offset=HEADER.size, shape=(count, self.dim))
+
+    def append(self, user_ids, names, encodings):
+        encodings = np.ascontiguousarray(encodings, dtype='<f4').reshape(-1, self.dim)
+        with self._exclusive() as meta:
+            count = self.refresh()
+            # Drop a torn trailing sidecar line, if any
+            meta.truncate(self._meta_offset)
+            with open(self.path, 'r+b') as f:
+                # Drop anything past the last complete sidecar line
+                f.truncate(HEADER.size + count * self.stride)
+                f.seek(0, os.SEEK_END)
+                f.write(encodings.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.norms_path, 'ab') as f:
+                f.truncate(count * 4)
+                f.write(np.einsum('ij,ij->i', encodings, encodings).astype('<f4').tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            lines = ''.join(
+                json.dumps({'row': count + i, 'userId': user_id, 'name': name}) + '\n'
+                for i, (user_id, name) in enumerate(zip(user_ids, names)))
+            meta.write(lines.encode('utf-8'))
+            meta.flush()
+            os.fsync(meta.fileno())
+        # Index of the first appended row
+        return count
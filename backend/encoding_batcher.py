@@ -0,0 +1,113 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+import dlib
+import numpy as np
+from background import ProcessLocal
+
+
+class EncodingBatcher:
+    # Micro-batches face encoding across concurrent requests.
+    #
+    # Request threads submit an image and its face locations and wait on a
+    # Future. A single scheduler thread collects submissions until it has
+    # max_batch_size of them or the oldest has waited max_wait_ms, then runs
+    # landmarking for the whole batch and one batched call to dlib's face
+    # encoder. The results match face_recognition.face_encodings() with its
+    # default 5-point landmark model.
+
+    def __init__(self, max_batch_size=8, max_wait_ms=5.0, num_jitters=1):
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.num_jitters = num_jitters
+        self._queue = ProcessLocal(self._start_worker)
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._batch_size_counts = {}
+        self._queue_wait_seconds = 0.0
+        self._encode_seconds = 0.0
+
+    def _start_worker(self):
+        # The scheduler and its submission queue, started once per process
+        submissions = queue.Queue()
+        threading.Thread(target=self._run, args=(submissions,), name='encoding-batcher', daemon=True).start()
+        return submissions
+
+    def submit(self, image, face_locations):
+        # Future resolving to the list of encodings for face_locations
+        future = Future()
+        self._queue.get().put((image, face_locations, future, time.perf_counter()))
+        return future
+
+    def encode(self, image, face_locations):
+        if self.max_batch_size == 1:
+            import face_recognition.api as face_api
+            return face_api.face_encodings(image, face_locations, self.num_jitters)
+        return self.submit(image, face_locations).result()
+
+    def _collect(self, submissions):
+        batch = [submissions.get()]
+        deadline = batch[0][3] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(submissions.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, submissions):
+        # Imported here rather than at module level: importing face_recognition
+        # loads its models, which app.py does in the background
+        import face_recognition.api as face_api
+        while True:
+            batch = self._collect(submissions)
+            start = time.perf_counter()
+            try:
+                images = []
+                shapes = []
+                for image, face_locations, _, _ in batch:
+                    detections = dlib.full_object_detections()
+                    for location in face_locations:
+                        detections.append(face_api.pose_predictor_5_point(image, face_api._css_to_rect(location)))
+                    images.append(image)
+                    shapes.append(detections)
+                descriptors = face_api.face_encoder.compute_face_descriptor(images, shapes, self.num_jitters)
+                results = [[np.array(descriptor) for descriptor in per_image] for per_image in descriptors]
+            except Exception as e:
+                for _, _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            finally:
+                self._record(batch, start)
+
+            for (_, _, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+    def _record(self, batch, start):
+        now = time.perf_counter()
+        with self._lock:
+            self._batches += 1
+            self._items += len(batch)
+            self._batch_size_counts[len(batch)] = self._batch_size_counts.get(len(batch), 0) + 1
+            self._queue_wait_seconds += sum(start - submitted for _, _, _, submitted in batch)
+            self._encode_seconds += now - start
+
+    def stats(self):
+        submissions = self._queue.peek()
+        with self._lock:
+            return {
+                'maxBatchSize': self.max_batch_size,
+                'maxWaitMs': self.max_wait * 1000.0,
+                'queueDepth': submissions.qsize() if submissions is not None else 0,
+                'batches': self._batches,
+                'requests': self._items,
+                'averageBatchSize': self._items / self._batches if self._batches else 0.0,
+                'batchSizes': dict(sorted(self._batch_size_counts.items())),
+                'averageQueueWaitMs': 1000.0 * self._queue_wait_seconds / self._items if self._items else 0.0,
+                'averageBatchEncodeMs': 1000.0 * self._encode_seconds / self._batches if self._batches else 0.0,
+            }
@@ -0,0 +1,73 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+class EncodingCache:
+    # Face locations and encodings of recently seen uploads.
+    #
+    # Keyed by a BLAKE2b hash of the image file bytes, so a retried or
+    # resubmitted frame skips decoding, detection and encoding entirely.
+    # Entries expire after ttl_seconds and are evicted least-recently-used
+    # beyond max_entries; a max_entries of 0 disables the cache. Results with
+    # no face or several faces are cached too, without an encoding.
+
+    def __init__(self, max_entries=1024, ttl_seconds=300.0):
+        self.max_entries = max(0, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(image_bytes):
+        return hashlib.blake2b(image_bytes, digest_size=16).digest()
+
+    def get(self, key):
+        # (face_locations, encoding or None), or None on a miss
+        if not self.max_entries:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or now - entry[2] > self.ttl_seconds:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, key, face_locations, encoding=None):
+        if not self.max_entries:
+            return
+        if encoding is not None:
+            encoding = np.array(encoding)
+            encoding.setflags(write=False)
+        with self._lock:
+            self._entries[key] = (list(face_locations), encoding, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'maxEntries': self.max_entries,
+                'ttlSeconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hitRate': self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,47 @@
+import cv2
+import dlib
+
+# Face detection on a downscaled copy of the frame.
+#
+# HOG detection cost grows with pixel count, while the faces a kiosk camera
+# sees are large. Detecting on a frame scaled so its short side is
+# target_short_side and mapping the boxes back keeps detection cheap; the
+# 68-point predictor and the face encoder still run on the original
+# full-resolution image. A target of 0 (or one larger than the frame)
+# detects at full resolution.
+
+
+def downscale(image, target_short_side):
+    # Returns the image to detect on and its scale relative to the original
+    short_side = min(image.shape[0], image.shape[1])
+    if not target_short_side or short_side <= target_short_side:
+        return image, 1.0
+    scale = target_short_side / float(short_side)
+    return cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA), scale
+
+
+def detect_faces(detector, gray, target_short_side, upsample=0):
+    # dlib rectangles in full-resolution coordinates, like detector(gray)
+    small, scale = downscale(gray, target_short_side)
+    faces = detector(small, upsample)
+    if scale == 1.0:
+        return list(faces)
+    height, width = gray.shape[:2]
+    return [dlib.rectangle(max(0, int(face.left() / scale)), max(0, int(face.top() / scale)),
+                           min(width - 1, int(face.right() / scale)), min(height - 1, int(face.bottom() / scale)))
+            for face in faces]
+
+
+def locate_faces(image, target_short_side, upsample=1):
+    # (top, right, bottom, left) tuples in full-resolution coordinates, like
+    # face_recognition.face_locations(image)
+    # Imported on first use: importing face_recognition loads its models
+    import face_recognition
+    small, scale = downscale(image, target_short_side)
+    locations = face_recognition.face_locations(small, number_of_times_to_upsample=upsample)
+    if scale == 1.0:
+        return locations
+    height, width = image.shape[:2]
+    return [(max(0, int(top / scale)), min(width, int(right / scale)),
+             min(height, int(bottom / scale)), max(0, int(left / scale)))
+            for top, right, bottom, left in locations]
@@ -0,0 +1,96 @@
+import cv2
+import numpy as np
+
+# Face quality metrics from 68-point landmarks and the grayscale frame.
+#
+# All geometric metrics are computed in one vectorized pass over a single
+# (68, 2) landmark set or a (B, 68, 2) batch, so enrollment photos can be
+# re-scored offline in bulk with the same code that guides the live camera.
+
+# Landmark indices of each eye, in the order the eye aspect ratio expects
+EYES = np.array([list(range(36, 42)), list(range(42, 48))])
+
+EYES_OPEN_EAR = 0.15     # Average eye aspect ratio above which eyes count as open
+SMILE_RATIO = 0.15       # Mouth height / width above which the face counts as smiling
+MIN_BRIGHTNESS = 40      # Mean face brightness needed to count as well lit
+IDEAL_BRIGHTNESS = 120   # Mean face brightness for ideal lighting
+
+
+def _distance(a, b):
+    return np.sqrt(np.sum((a - b) ** 2, axis=-1))
+
+
+def landmark_metrics(landmarks):
+    # Eye aspect ratios, mouth ratio, roll (degrees of the eye line), yaw
+    # (nose offset from the jaw midline, -1..1) and pitch (nose height between
+    # the eye line and the mouth corners, about 0.5 when frontal) for a
+    # (B, 68, 2) batch
+    points = np.asarray(landmarks, dtype=np.float64).reshape(-1, 68, 2)
+    eyes = points[:, EYES]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ear = (_distance(eyes[..., 1, :], eyes[..., 5, :]) + _distance(eyes[..., 2, :], eyes[..., 4, :])) \
+            / (2.0 * _distance(eyes[..., 0, :], eyes[..., 3, :]))
+        mouth_ratio = _distance(points[:, 57], points[:, 51]) / _distance(points[:, 54], points[:, 48])
+
+        eye_centres = eyes.mean(axis=2)
+        eye_line = eye_centres[:, 1] - eye_centres[:, 0]
+        roll = np.degrees(np.arctan2(eye_line[:, 1], eye_line[:, 0]))
+
+        nose_tip = points[:, 30]
+        jaw_mid_x = (points[:, 0, 0] + points[:, 16, 0]) / 2.0
+        jaw_half_width = (points[:, 16, 0] - points[:, 0, 0]) / 2.0
+        yaw = (nose_tip[:, 0] - jaw_mid_x) / jaw_half_width
+
+        eye_y = eye_centres[:, :, 1].mean(axis=1)
+        mouth_y = (points[:, 48, 1] + points[:, 54, 1]) / 2.0
+        pitch = (nose_tip[:, 1] - eye_y) / (mouth_y - eye_y)
+
+    return {
+        'leftEar': ear[:, 0],
+        'rightEar': ear[:, 1],
+        'ear': ear.mean(axis=1),
+        'mouthRatio': mouth_ratio,
+        'roll': roll,
+        'yaw': yaw,
+        'pitch': pitch,
+    }
+
+
+def region_metrics(gray, box):
+    # Mean brightness and sharpness (variance of the Laplacian) of the face
+    # box (top, right, bottom, left) in an existing grayscale buffer
+    top, right, bottom, left = (int(v) for v in box)
+    region = gray[max(0, top):max(0, bottom), max(0, left):max(0, right)]
+    if region.size == 0:
+        return 0.0, 0.0
+    return float(region.mean()), float(cv2.Laplacian(region, cv2.CV_64F).var())
+
+
+def analyze_quality(landmarks, gray=None, boxes=None):
+    # Every quality metric and pass/fail check for one landmark set (returns
+    # plain floats and bools) or a batch (returns arrays). gray is the
+    # grayscale frame, or a list with one frame per landmark set; boxes are
+    # the matching (top, right, bottom, left) face boxes.
+    single = np.ndim(landmarks) == 2
+    metrics = landmark_metrics(landmarks)
+    count = len(metrics['ear'])
+
+    brightness = np.full(count, np.nan)
+    sharpness = np.full(count, np.nan)
+    if gray is not None and boxes is not None:
+        grays = gray if isinstance(gray, (list, tuple)) else [gray] * count
+        boxes = np.asarray(boxes).reshape(count, 4)
+        for i in range(count):
+            brightness[i], sharpness[i] = region_metrics(grays[i], boxes[i])
+    metrics['brightness'] = brightness
+    metrics['sharpness'] = sharpness
+
+    with np.errstate(invalid='ignore'):
+        metrics['eyesOpen'] = metrics['ear'] > EYES_OPEN_EAR
+        metrics['isSmiling'] = metrics['mouthRatio'] > SMILE_RATIO
+        metrics['isWellLit'] = brightness >= MIN_BRIGHTNESS
+        metrics['isIdealLighting'] = brightness >= IDEAL_BRIGHTNESS
+
+    if single:
+        return {key: value[0].item() for key, value in metrics.items()}
+    return metrics
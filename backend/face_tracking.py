@@ -0,0 +1,98 @@
+import threading
+import cv2
+import dlib
+import numpy as np
+
+
+class TrackingStats:
+    # Process-wide counts of how detect-face frames found their face
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.full_detections = 0
+        self.tracked_frames = 0
+        self.lost_tracks = 0
+
+    def record(self, full_detection=False, tracked=False, lost=False):
+        with self._lock:
+            self.full_detections += full_detection
+            self.tracked_frames += tracked
+            self.lost_tracks += lost
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'fullDetections': self.full_detections,
+                'trackedFrames': self.tracked_frames,
+                'lostTracks': self.lost_tracks,
+            }
+
+
+class FaceTracker:
+    # Finds the face in consecutive frames of one session without running
+    # the HOG detector over every full frame.
+    #
+    # A full-frame detection runs on the first frame, every redetect_interval
+    # frames (so a second face entering the frame is still reported), and
+    # whenever tracking is lost. In between, the detector only searches a
+    # window around the previous box, downscaled so the face is about
+    # roi_face_size pixels wide, and the track is kept only if exactly one
+    # face scores at least min_score there. full_detect replaces
+    # detector(gray) for full-frame detections.
+
+    def __init__(self, detector, redetect_interval=10, min_score=0.2,
+                 search_margin=0.5, roi_face_size=100, stats=None, full_detect=None):
+        self.detector = detector
+        self.full_detect = full_detect or detector
+        self.redetect_interval = redetect_interval
+        self.min_score = min_score
+        self.search_margin = search_margin
+        self.roi_face_size = roi_face_size
+        self.stats = stats
+        self._box = None
+        self._frames_since_detection = 0
+
+    def detect(self, gray):
+        # Face rectangles in full-frame coordinates, like detector(gray)
+        if self._box is not None and self._frames_since_detection < self.redetect_interval:
+            face = self._detect_near(gray, self._box)
+            if face is not None:
+                self._box = face
+                self._frames_since_detection += 1
+                self._record(tracked=True)
+                return [face]
+            self._record(lost=True)
+
+        faces = list(self.full_detect(gray))
+        self._box = faces[0] if len(faces) == 1 else None
+        self._frames_since_detection = 0
+        self._record(full_detection=True)
+        return faces
+
+    def _detect_near(self, gray, box):
+        height, width = gray.shape[:2]
+        size = max(box.width(), box.height())
+        margin = self.search_margin * size
+        x0 = max(0, int(box.left() - margin))
+        y0 = max(0, int(box.top() - margin))
+        x1 = min(width, int(box.right() + margin))
+        y1 = min(height, int(box.bottom() + margin))
+        if x1 <= x0 or y1 <= y0:
+            return None
+
+        roi = gray[y0:y1, x0:x1]
+        scale = min(1.0, self.roi_face_size / float(size))
+        if scale < 1.0:
+            roi = cv2.resize(roi, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        else:
+            roi = np.ascontiguousarray(roi)
+        rects, scores, _ = self.detector.run(roi, 0, 0)
+        if len(rects) != 1 or scores[0] < self.min_score:
+            return None
+        rect = rects[0]
+        return dlib.rectangle(int(rect.left() / scale) + x0, int(rect.top() / scale) + y0,
+                              int(rect.right() / scale) + x0, int(rect.bottom() / scale) + y0)
+
+    def _record(self, **kwargs):
+        if self.stats is not None:
+            self.stats.record(**kwargs)
@@ -0,0 +1,110 @@
+import threading
+import cv2
+import numpy as np
+
+# Reuse of the last detect-face result while the camera scene is static.
+#
+# Each session keeps a tiny grayscale thumbnail of its last analyzed frame,
+# plus one of the face region located from the returned facePosition. A new
+# frame is decoded at 1/8 scale (JPEG decoders skip most of the work for
+# that), thumbnailed the same way and compared with the previous one; if
+# both the whole frame and the face changed by less than `threshold` (mean
+# absolute difference in grey levels), the previous response is returned
+# without full decoding, detection, landmarking or quality checks. After
+# max_reuse reused frames in a row a full analysis is forced anyway, so the
+# guidance cannot drift from what the camera sees.
+
+FRAME_THUMBNAIL_SIZE = (32, 24)
+FACE_THUMBNAIL_SIZE = (24, 24)
+
+
+class FrameDiffStats:
+    # Process-wide counts of how detect-face session frames were answered
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reused = 0
+        self.forced_refreshes = 0
+        self.changed = 0
+
+    def record(self, reused=False, forced=False, changed=False):
+        with self._lock:
+            self.reused += reused
+            self.forced_refreshes += forced
+            self.changed += changed
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'reusedFrames': self.reused,
+                'forcedRefreshes': self.forced_refreshes,
+                'changedFrames': self.changed,
+            }
+
+
+def reduced_gray(image_bytes):
+    # Grayscale frame decoded at 1/8 of its size
+    buffer = np.frombuffer(image_bytes, dtype=np.uint8)
+    image = cv2.imdecode(buffer, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if image is None:
+        raise ValueError('Could not decode image')
+    return image
+
+
+def _thumbnails(gray, face_position):
+    frame = cv2.resize(gray, FRAME_THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA).astype(np.float32)
+    if face_position is None:
+        return frame, None
+    # Invert the normalized position and scale reported by detect-face:
+    # centre in -1..1 of the frame, size relative to 40% of its short side
+    height, width = gray.shape[:2]
+    centre_x = (face_position['x'] + 1.0) * width / 2.0
+    centre_y = (face_position['y'] + 1.0) * height / 2.0
+    half = face_position['scale'] * 0.4 * min(width, height) / 2.0
+    x0, x1 = int(max(0, centre_x - half)), int(min(width, centre_x + half))
+    y0, y1 = int(max(0, centre_y - half)), int(min(height, centre_y + half))
+    if x1 - x0 < 2 or y1 - y0 < 2:
+        return frame, None
+    face = cv2.resize(gray[y0:y1, x0:x1], FACE_THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+    return frame, face.astype(np.float32)
+
+
+class FrameDiffCache:
+    # Last analyzed frame of one session and its response
+
+    def __init__(self, threshold=3.0, max_reuse=4, stats=None):
+        self.threshold = threshold
+        self.max_reuse = max_reuse
+        self.stats = stats
+        self._response = None
+        self._frame = None
+        self._face = None
+        self._reused = 0
+
+    def lookup(self, gray):
+        # The previous response if gray shows the same scene, else None
+        if self._response is None:
+            self._record(changed=True)
+            return None
+        frame, face = _thumbnails(gray, self._response.get('facePosition'))
+        if frame.shape != self._frame.shape or np.abs(frame - self._frame).mean() >= self.threshold or (
+                face is not None and self._face is not None
+                and np.abs(face - self._face).mean() >= self.threshold):
+            self._record(changed=True)
+            return None
+        if self._reused >= self.max_reuse:
+            self._record(forced=True)
+            return None
+        self._reused += 1
+        self._record(reused=True)
+        return self._response
+
+    def store(self, gray, response):
+        # Remember a freshly analyzed frame and its response
+        self._frame, self._face = _thumbnails(gray, response.get('facePosition'))
+        self._response = response
+        self._reused = 0
+
+    def _record(self, **kwargs):
+        if self.stats is not None:
+            self.stats.record(**kwargs)
@@ -0,0 +1,175 @@
+import threading
+import numpy as np
+
+# dlib face encodings are 128-dimensional
+ENCODING_DIM = 128
+
+
+class FaceGallery:
+    # Resident matrix of enrolled face encodings.
+    #
+    # Encodings live in one contiguous float32 (N x 128) matrix with a
+    # parallel array of user ids, so a query is a single batched distance
+    # computation instead of a Python loop over every user. The matrix is
+    # over-allocated and grown geometrically so registrations append in
+    # amortized O(1).
+    #
+    # When backed by an EmbeddingFile the matrix is instead a read-only
+    # memory map of that file: registrations are appended to the file and
+    # re-mapped, and refresh() picks up rows appended by other processes.
+    #
+    # Rows are never rewritten. When a user's template changes a new row is
+    # appended for them and their earlier row is superseded: its squared
+    # norm is set to infinity so every distance to it is infinite, and
+    # searches skip it.
+
+    def __init__(self, dim=ENCODING_DIM, initial_capacity=1024, embedding_file=None):
+        self.dim = dim
+        self._lock = threading.RLock()
+        self._file = embedding_file
+        if embedding_file is None:
+            self._encodings = np.empty((initial_capacity, dim), dtype=np.float32)
+        else:
+            self._encodings = embedding_file.matrix(0)
+        self._sq_norms = np.empty(initial_capacity, dtype=np.float32)
+        self._ids = np.empty(initial_capacity, dtype=object)
+        self._rows_by_id = {}
+        self._size = 0
+        self.refresh()
+
+    def __len__(self):
+        # Stored rows, superseded ones included
+        return self._size
+
+    @property
+    def identities(self):
+        # Users with a current row
+        return len(self._rows_by_id)
+
+    def _supersede(self, start, end):
+        # Record rows [start, end) as the current rows of their users
+        for row in range(start, end):
+            previous = self._rows_by_id.get(self._ids[row])
+            if previous is not None:
+                self._sq_norms[previous] = np.inf
+            self._rows_by_id[self._ids[row]] = row
+
+    def _grow(self, min_capacity):
+        capacity = max(min_capacity, 2 * len(self._ids), 1)
+        sq_norms = np.empty(capacity, dtype=np.float32)
+        ids = np.empty(capacity, dtype=object)
+        sq_norms[:self._size] = self._sq_norms[:self._size]
+        ids[:self._size] = self._ids[:self._size]
+        self._sq_norms, self._ids = sq_norms, ids
+        if self._file is None:
+            encodings = np.empty((capacity, self.dim), dtype=np.float32)
+            encodings[:self._size] = self._encodings[:self._size]
+            self._encodings = encodings
+
+    def refresh(self):
+        # Map rows appended to the embedding file since the last call,
+        # including those written by other worker processes
+        if self._file is None:
+            return self._size
+        with self._lock:
+            count = self._file.refresh()
+            if count > self._size:
+                if count > len(self._ids):
+                    self._grow(count)
+                encodings = self._file.matrix(count)
+                self._sq_norms[self._size:count] = self._file.sq_norms(self._size, count)
+                self._ids[self._size:count] = self._file.user_ids[self._size:count]
+                self._supersede(self._size, count)
+                self._encodings = encodings
+                self._size = count
+            return self._size
+
+    def add(self, user_id, encoding, name=None):
+        return self.add_many([user_id], [encoding], [name])
+
+    def add_many(self, user_ids, encodings, names=None):
+        # Returns the range of rows the new encodings were stored at
+        encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, self.dim)
+        if len(user_ids) != len(encodings):
+            raise ValueError('user_ids and encodings must have the same length')
+        if self._file is not None:
+            names = names if names is not None else [None] * len(user_ids)
+            with self._lock:
+                start = self._file.append(user_ids, names, encodings)
+                self.refresh()
+            return range(start, start + len(encodings))
+        with self._lock:
+            end = self._size + len(encodings)
+            if end > len(self._ids):
+                self._grow(end)
+            self._encodings[self._size:end] = encodings
+            self._sq_norms[self._size:end] = np.einsum('ij,ij->i', encodings, encodings)
+            self._ids[self._size:end] = list(user_ids)
+            self._supersede(self._size, end)
+            start, self._size = self._size, end
+        return range(start, end)
+
+    def rows(self, start, end):
+        # Encodings and ids stored at rows [start, end)
+        with self._lock:
+            end = min(end, self._size)
+            return self._ids[start:end], self._encodings[start:end]
+
+    def row_distances(self, encoding, rows):
+        # Exact distances from one query to a subset of rows
+        query = np.asarray(encoding, dtype=np.float32).reshape(self.dim)
+        rows = np.asarray(rows, dtype=np.int64)
+        with self._lock:
+            ids = self._ids[rows]
+            diff = self._encodings[rows] - query
+            superseded = np.isinf(self._sq_norms[rows])
+        dist = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+        dist[superseded] = np.inf
+        return ids, dist
+
+    def superseded(self, rows):
+        # Which of rows (indices or a slice) have been superseded
+        with self._lock:
+            return np.isinf(self._sq_norms[rows])
+
+    def user_distance(self, user_id, encoding):
+        # Exact distance from one query to a user's current row, found with a
+        # dictionary lookup; None if the user has no row
+        with self._lock:
+            row = self._rows_by_id.get(user_id)
+        if row is None:
+            return None
+        return float(self.row_distances(encoding, [row])[1][0])
+
+    def distances(self, encoding):
+        # Euclidean distance from one query to every stored encoding, computed
+        # as ||a||^2 - 2ab + ||b||^2 with a single matrix-vector product
+        query = np.asarray(encoding, dtype=np.float32).reshape(self.dim)
+        with self._lock:
+            size = self._size
+            encodings = self._encodings[:size]
+            sq_norms = self._sq_norms[:size]
+            ids = self._ids[:size]
+        sq_dist = sq_norms - 2.0 * (encodings @ query) + np.dot(query, query)
+        np.maximum(sq_dist, 0.0, out=sq_dist)
+        return ids, np.sqrt(sq_dist)
+
+    def search(self, encoding, top_k=1):
+        # Return the top_k closest (user_id, distance) pairs, best first
+        if self._size == 0 or top_k <= 0:
+            return []
+        ids, dist = self.distances(encoding)
+        top_k = min(top_k, len(dist))
+        if top_k < len(dist):
+            candidates = np.argpartition(dist, top_k - 1)[:top_k]
+        else:
+            candidates = np.arange(len(dist))
+        candidates = candidates[np.argsort(dist[candidates], kind='stable')]
+        return [(ids[i], float(dist[i])) for i in candidates if np.isfinite(dist[i])]
+
+    def best_match(self, encoding, tolerance):
+        # Closest enrolled user if within tolerance, otherwise None
+        matches = self.search(encoding, top_k=1)
+        if matches and matches[0][1] <= tolerance:
+            return matches[0]
+        return None
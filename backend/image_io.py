@@ -0,0 +1,39 @@
+import base64
+import cv2
+import numpy as np
+
+# Decoding of uploaded images into RGB numpy arrays
+
+
+def bytes_to_image(image_bytes):
+    # Decode JPEG/PNG bytes straight into an RGB numpy array in a single decode
+    buffer = np.frombuffer(image_bytes, dtype=np.uint8)
+    image = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError('Could not decode image')
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
+
+
+def base64_to_bytes(base64_string):
+    # Remove the data URL prefix if present
+    if ',' in base64_string:
+        base64_string = base64_string.split(',')[1]
+
+    # Decode base64 string to bytes
+    return base64.b64decode(base64_string)
+
+
+def base64_to_image(base64_string):
+    return bytes_to_image(base64_to_bytes(base64_string))
+
+
+def payload_to_bytes(payload):
+    # Image file bytes of a payload: raw bytes, or a base64 string from
+    # legacy JSON clients
+    if isinstance(payload, str):
+        return base64_to_bytes(payload)
+    return payload
+
+
+def payload_to_image(payload):
+    return bytes_to_image(payload_to_bytes(payload))
\ No newline at end of file
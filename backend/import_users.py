@@ -0,0 +1,68 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+from bulk_enroll import directory_items, extract_archive, load_names, run_import, sources_dir
+from embedding_file import EmbeddingFile
+from gallery import FaceGallery
+from user_store import UserStore
+
+# Offline bulk enrollment from a directory (or zip archive) of photos, one
+# person per image, named after the file ("Jane_Doe.jpg" -> "Jane Doe")
+# unless --names maps file names to names. Safe to run while the server is
+# up: new users are appended to the shared embedding file, and rerunning an
+# interrupted import with the same source resumes it.
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Enroll every face photo in a directory or zip archive')
+    parser.add_argument('source', help='directory of images or a .zip archive')
+    parser.add_argument('--names', help='CSV of filename,name overriding names taken from file names')
+    parser.add_argument('--import-id', help='resume key of letters, digits, _ and - (default: derived from the source path)')
+    parser.add_argument('--workers', type=int, default=0, help='encoding processes (default: one per core)')
+    parser.add_argument('--db', default='user_data/users.db')
+    parser.add_argument('--embeddings', default='user_data/embeddings.f32')
+    parser.add_argument('--pictures', default='user_data/profile_pictures')
+    parser.add_argument('--staging', default='user_data/imports')
+    parser.add_argument('--report', help='write the JSON summary, including every failure, to this file')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    source = os.path.abspath(args.source)
+    import_id = args.import_id or 'cli-' + hashlib.blake2b(source.encode('utf-8'), digest_size=8).hexdigest()
+    names = load_names(args.names) if args.names else None
+    extracted = None
+    if os.path.isdir(source):
+        items = directory_items(source, names)
+    else:
+        # Archive entries are extracted to files rather than held in memory
+        extracted = sources_dir(args.staging, import_id)
+        items = extract_archive(source, extracted, names)
+
+    os.makedirs(args.pictures, exist_ok=True)
+    user_store = UserStore(args.db)
+    gallery = FaceGallery(embedding_file=EmbeddingFile(args.embeddings))
+
+    print(f"Importing {source} as {import_id}...")
+    def progress(done, total):
+        print(f"  encoded {done}/{total}")
+    try:
+        summary = run_import(user_store, gallery, items, import_id, args.staging, args.pictures,
+                             workers=args.workers or None, source=source, progress=progress)
+    finally:
+        if extracted:
+            shutil.rmtree(extracted, ignore_errors=True)
+
+    print(f"Enrolled {summary['enrolled']} of {summary['total']} images "
+          f"({summary['failed']} failed: {summary['statusCounts']})")
+    for failure in summary['failures'][:20]:
+        print(f"  {failure['key']}: {failure['status']} - {failure['message']}")
+    if summary['failed'] > 20:
+        print(f"  ... and {summary['failed'] - 20} more")
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+if __name__ == "__main__":
+    main()
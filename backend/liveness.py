@@ -0,0 +1,135 @@
+import hashlib
+import hmac
+import secrets
+import time
+
+# Cheap liveness pre-filter fed by the detect-face stream of one session.
+#
+# Each analyzed frame updates a small state machine watching for a blink: the
+# eye aspect ratio dropping below BLINK_CLOSED_EAR and recovering above
+# BLINK_OPEN_EAR. A printed photo or a still on a screen cannot blink. Head
+# movement and landmark micro-motion are not accepted instead: tilting a
+# photo moves its landmarks by more than any threshold that stays above the
+# detector's own jitter, so they cannot tell a photo from a face.
+#
+# Once a blink is seen in at least MIN_FRAMES frames the session is live
+# until its TTL runs out, and every frame it sends meanwhile is answered
+# with a fresh HMAC-signed token that /api/verify can require before it
+# spends any time on encoding and matching. Tokens are bound to the session
+# id they were issued to and are single-use: verify records each token's
+# nonce and refuses one it has seen. Losing the face, or a second face
+# appearing, starts over.
+
+BLINK_CLOSED_EAR = 0.18    # Eye aspect ratio below which the eyes count as closed
+BLINK_OPEN_EAR = 0.23      # ... and above which they count as open again
+MIN_FRAMES = 3             # Frames with a face before liveness can be decided
+
+
+class LivenessTracker:
+
+    def __init__(self, secret, session_id, token_ttl_seconds=30.0):
+        self.secret = secret
+        self.session_id = session_id
+        self.token_ttl_seconds = token_ttl_seconds
+        self.live_until = 0.0
+        self.reset()
+
+    def reset(self):
+        self.state = 'searching'
+        self.frames = 0
+        self.blinks = 0
+        self.eyes_closed = False
+
+    @property
+    def live(self):
+        return time.time() <= self.live_until
+
+    def update(self, ear):
+        # Feed the eye aspect ratio of one frame with exactly one face;
+        # returns the status
+        if self.state == 'live' and not self.live:
+            # The session's liveness expired: blink again
+            self.reset()
+        # Only reaching MIN_FRAMES matters; capping the count leaves a steady
+        # state unchanged, so it is not saved again on every frame
+        self.frames = min(self.frames + 1, MIN_FRAMES)
+        self.state = 'live' if self.state == 'live' else 'observing'
+
+        if ear < BLINK_CLOSED_EAR:
+            self.eyes_closed = True
+        elif ear > BLINK_OPEN_EAR and self.eyes_closed:
+            self.eyes_closed = False
+            self.blinks += 1
+
+        if self.state == 'observing' and self.frames >= MIN_FRAMES and self.blinks:
+            self.state = 'live'
+            self.live_until = int(time.time() + self.token_ttl_seconds)
+        return self.status()
+
+    def lost_face(self):
+        # No face, or several faces, in the latest frame
+        self.live_until = 0.0
+        self.reset()
+        return self.status()
+
+    def to_dict(self):
+        # The state carried between frames, to resume in another process
+        return {
+            'state': self.state,
+            'frames': self.frames,
+            'blinks': self.blinks,
+            'eyesClosed': self.eyes_closed,
+            'liveUntil': self.live_until,
+        }
+
+    def restore(self, saved):
+        self.state = saved['state']
+        self.frames = saved['frames']
+        self.blinks = saved['blinks']
+        self.eyes_closed = saved['eyesClosed']
+        self.live_until = saved['liveUntil']
+
+    def new_token(self):
+        # A fresh single-use token while the session is live, else None
+        if not self.live:
+            return None
+        return issue_token(self.secret, self.session_id, self.live_until)
+
+    def status(self):
+        status = {
+            'state': self.state,
+            'live': self.live,
+            'blinks': self.blinks,
+        }
+        if self.live:
+            status['expiresAt'] = self.live_until
+        return status
+
+
+def _signature(secret, payload):
+    return hmac.new(secret, payload.encode('utf-8'), hashlib.sha256).hexdigest().encode('ascii')
+
+
+def issue_token(secret, session_id, expires):
+    # "<expiry>.<nonce>.<signature>" with the signature also covering the
+    # session id, valid until the wall-clock expiry so any worker process
+    # sharing the secret can check it
+    payload = f'{int(expires)}.{secrets.token_hex(16)}'
+    return f"{payload}.{_signature(secret, f'{payload}.{session_id}').decode('ascii')}"
+
+
+def check_token(secret, token, session_id):
+    # (nonce, expiry) of token if it was issued with secret to session_id
+    # and has not expired, else None. Callers must still refuse a nonce
+    # they have seen before.
+    if not token or not session_id or token.count('.') != 2:
+        return None
+    payload, signature = token.rsplit('.', 1)
+    if not hmac.compare_digest(_signature(secret, f'{payload}.{session_id}'), signature.encode('utf-8')):
+        return None
+    expires, nonce = payload.split('.')
+    try:
+        expires = int(expires)
+    except ValueError:
+        return None
+    return (nonce, expires) if expires >= time.time() else None
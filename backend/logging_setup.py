@@ -0,0 +1,130 @@
+import collections
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+from background import ProcessLocal
+
+# Structured, leveled logging for the server.
+#
+# Records are handed to a QueueHandler and written by a background
+# QueueListener, so request threads never block on console I/O. Each record
+# carries the id of the request being handled plus any fields passed as
+# extra={'fields': {...}}, rendered as key=value pairs (LOG_FORMAT=text) or
+# one JSON object per line (LOG_FORMAT=json). Per-frame detect-face records
+# go to the FRAME_LOGGER at DEBUG, and only one in every
+# LOG_FRAME_SAMPLE_EVERY of them is kept.
+
+FRAME_LOGGER = 'faceguard.frames'
+
+_context = threading.local()
+_handler = None
+
+
+def set_request_id(request_id):
+    _context.request_id = request_id
+
+
+def get_request_id():
+    return getattr(_context, 'request_id', None)
+
+
+class RequestContextFilter(logging.Filter):
+    # Stamps records with the request id of the thread that emitted them
+
+    def filter(self, record):
+        record.request_id = get_request_id() or '-'
+        if not hasattr(record, 'fields'):
+            record.fields = {}
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    # Keeps one record in every `every` of each message, so interleaved kinds
+    # of per-frame records are all sampled
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = max(1, every)
+        self._counters = collections.defaultdict(itertools.count)
+
+    def filter(self, record):
+        return next(self._counters[record.msg]) % self.every == 0
+
+
+class TextFormatter(logging.Formatter):
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'requestId': getattr(record, 'request_id', '-'),
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def _start_listener(output_handler):
+    listener = logging.handlers.QueueListener(queue.SimpleQueue(), output_handler)
+    listener.start()
+    return listener
+
+
+class ProcessQueueHandler(logging.handlers.QueueHandler):
+    # Queues records for this process's listener, started on first use
+
+    def __init__(self, output_handler):
+        super().__init__(None)
+        self.listener = ProcessLocal(lambda: _start_listener(output_handler))
+
+    def enqueue(self, record):
+        self.listener.get().queue.put_nowait(record)
+
+
+def configure_logging(level='INFO', log_format='text', frame_sample_every=100):
+    # Route every logger through the queue; safe to call more than once
+    global _handler
+    if _handler is not None:
+        return
+
+    output_handler = logging.StreamHandler(sys.stdout)
+    if log_format == 'json':
+        output_handler.setFormatter(JsonFormatter())
+    else:
+        output_handler.setFormatter(TextFormatter(
+            '%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s'))
+
+    _handler = ProcessQueueHandler(output_handler)
+    _handler.addFilter(RequestContextFilter())
+
+    root = logging.getLogger()
+    root.setLevel(level.upper())
+    root.handlers[:] = [_handler]
+
+    # The per-request summary replaces werkzeug's access log line
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    logging.getLogger(FRAME_LOGGER).filters[:] = [SamplingFilter(frame_sample_every)]
+
+
+def stop_logging():
+    # Write out queued records, e.g. before the process exits
+    listener = _handler.listener.peek() if _handler is not None else None
+    if listener is not None:
+        listener.stop()
@@ -0,0 +1,214 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, has_request_context
+
+# In-process metrics rendered in the Prometheus text exposition format.
+#
+# Counters and histograms are updated on the request path under a per-metric
+# lock; gauges are callbacks evaluated when /metrics is scraped. Values are
+# per process: under serve.py every worker reports its own series, told apart
+# by the worker label that serve.py sets with set_worker_label().
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if value != value:
+        return 'NaN'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield self.name + '_total', dict(zip(self.labelnames, key)), value
+
+
+class Histogram:
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # label values -> [per-bucket counts (+Inf last), sum]
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        for key, (counts, total) in sorted(values.items()):
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield self.name + '_bucket', dict(labels, le=_format_value(float(bound))), cumulative
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, cumulative
+
+
+class Gauge:
+    # Value (or {label values: value} dict) read from a callback at scrape time
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, callback, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.labelnames = tuple(labelnames)
+
+    def samples(self):
+        value = self.callback()
+        if not self.labelnames:
+            yield self.name, {}, value
+            return
+        for key, item in sorted(value.items()):
+            key = key if isinstance(key, tuple) else (key,)
+            yield self.name, dict(zip(self.labelnames, key)), item
+
+
+class CallbackCounter(Gauge):
+    # Running total kept elsewhere (e.g. in EncodingBatcher.stats()), read at
+    # scrape time
+
+    kind = 'counter'
+
+    def samples(self):
+        for name, labels, value in super().samples():
+            yield name + '_total', labels, value
+
+
+class CallbackHistogram:
+    # Histogram of discrete observations counted elsewhere (e.g. batch sizes
+    # in EncodingBatcher.stats()): the callback returns {value: count}, read
+    # at scrape time
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, callback, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.buckets = tuple(sorted(buckets))
+
+    def samples(self):
+        counts = [0] * (len(self.buckets) + 1)
+        total = 0.0
+        for value, count in self.callback().items():
+            counts[bisect.bisect_left(self.buckets, value)] += count
+            total += value * count
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            yield self.name + '_bucket', {'le': _format_value(float(bound))}, cumulative
+        yield self.name + '_sum', {}, total
+        yield self.name + '_count', {}, cumulative
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = []
+        self.const_labels = {}
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name, documentation, callback, labelnames=()):
+        return self.register(Gauge(name, documentation, callback, labelnames))
+
+    def callback_counter(self, name, documentation, callback, labelnames=()):
+        return self.register(CallbackCounter(name, documentation, callback, labelnames))
+
+    def callback_histogram(self, name, documentation, callback, buckets):
+        return self.register(CallbackHistogram(name, documentation, callback, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                labels = dict(self.const_labels, **labels)
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram(
+    'faceguard_stage_duration_seconds', 'Time spent in each request processing stage', ('stage',))
+
+
+def set_worker_label(worker):
+    registry.const_labels['worker'] = str(worker)
+
+
+@contextmanager
+def stage(name):
+    # Time a block into the per-stage histogram and, inside a request, into
+    # the breakdown reported by the Server-Timing header
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, stage=name)
+        if has_request_context():
+            timings = g.setdefault('stage_timings', {})
+            timings[name] = timings.get(name, 0.0) + elapsed
+
+
+def server_timing_header(timings):
+    return ', '.join(f'{name};dur={seconds * 1000.0:.2f}' for name, seconds in timings.items())
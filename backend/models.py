@@ -0,0 +1,111 @@
+import bz2
+import logging
+import os
+import shutil
+import threading
+import time
+import urllib.request
+import dlib
+
+# Background loading of the detection and recognition models.
+#
+# The dlib HOG detector, the 68-point shape predictor (downloaded on first
+# start if missing) and face_recognition's models take seconds to load. A
+# ModelLoader does that on a daemon thread so app.py imports, and the server
+# binds its port, right away; endpoints that need the models answer 503
+# until `ready` is set, and /readyz reports the progress.
+
+MODEL_URL = 'http://dlib.net/files/shape_predictor_68_face_landmarks.dat.bz2'
+
+logger = logging.getLogger(__name__)
+
+
+def decompress_bz2(source_path, dest_path, chunk_size=1 << 20):
+    # Stream-decompress in chunks instead of reading the whole archive into
+    # memory; the output only appears under dest_path once it is complete
+    partial_path = dest_path + '.part'
+    with bz2.open(source_path, 'rb') as source, open(partial_path, 'wb') as dest:
+        shutil.copyfileobj(source, dest, chunk_size)
+    os.replace(partial_path, dest_path)
+
+
+def download_model(model_path, url=MODEL_URL):
+    archive_path = model_path + '.bz2'
+    logger.info("Downloading model from %s...", url)
+    urllib.request.urlretrieve(url, archive_path)
+    logger.info("Decompressing model file...")
+    decompress_bz2(archive_path, model_path)
+    os.remove(archive_path)
+    logger.info("Model saved to %s", model_path)
+
+
+class ModelLoader:
+
+    def __init__(self, model_path):
+        self.model_path = model_path
+        self.detector = None
+        self.predictor = None
+        self.error = None
+        self.stage = 'pending'
+        self.timings = {}
+        self._ready = threading.Event()
+        self._done = threading.Event()
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    @property
+    def failed(self):
+        return self.error is not None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._load, name='model-loader', daemon=True)
+            self._thread.start()
+        return self
+
+    def wait(self, timeout=None):
+        # Block until loading finished; True if the models are ready
+        self._done.wait(timeout)
+        return self.ready
+
+    def _timed(self, stage, fn):
+        self.stage = stage
+        start = time.perf_counter()
+        result = fn()
+        self.timings[stage] = time.perf_counter() - start
+        return result
+
+    def _load(self):
+        start = time.perf_counter()
+        try:
+            self.detector = self._timed('detector', dlib.get_frontal_face_detector)
+            if not os.path.exists(self.model_path):
+                logger.warning("Model file %s not found. Downloading...", self.model_path)
+                self._timed('download', lambda: download_model(self.model_path))
+            self.predictor = self._timed('predictor', lambda: dlib.shape_predictor(self.model_path))
+            # face_recognition loads its own detector, landmark and encoder
+            # models when first imported
+            self._timed('face_recognition', lambda: __import__('face_recognition.api'))
+            self.timings['total'] = time.perf_counter() - start
+            self.stage = 'ready'
+            self._ready.set()
+            logger.info("Models loaded in %.2f s", self.timings['total'],
+                        extra={'fields': {f'{key}_s': round(value, 3) for key, value in self.timings.items()}})
+        except Exception as e:
+            self.error = f'{self.stage}: {e}'
+            logger.exception("Error loading models during %s", self.stage)
+            if self.stage == 'download':
+                logger.error("Please download the model manually from: %s", MODEL_URL)
+        finally:
+            self._done.set()
+
+    def status(self):
+        return {
+            'ready': self.ready,
+            'stage': self.stage,
+            'error': self.error,
+            'timings': {key: round(value, 3) for key, value in self.timings.items()},
+        }
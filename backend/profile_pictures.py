@@ -0,0 +1,103 @@
+import os
+from PIL import Image
+
+# Profile pictures stored as size-capped JPEG (or WebP) files with
+# pre-generated smaller variants.
+#
+# The full picture is stored at the path recorded for the user, e.g.
+# user_data/profile_pictures/42.jpg, and each variant next to it with the
+# variant name appended (42_thumb.jpg). Variants missing on disk, such as
+# those of pictures saved before variants existed, are generated on first
+# request. Such older pictures were stored at their original resolution;
+# they are left as they are and a capped copy (42_full.jpg) is served as
+# their full size instead.
+
+# Longest side in pixels of each variant
+VARIANT_SIZES = {
+    'full': 640,
+    'medium': 256,
+    'thumb': 96,
+}
+
+FORMATS = {
+    'jpeg': '.jpg',
+    'webp': '.webp',
+}
+
+# Pillow format for each extension; older pictures may be PNG
+SAVE_FORMATS = {
+    '.webp': 'WEBP',
+    '.png': 'PNG',
+}
+
+MIMETYPES = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.webp': 'image/webp',
+    '.png': 'image/png',
+}
+
+
+def picture_path(directory, user_id, image_format='jpeg'):
+    return os.path.join(directory, f'{user_id}{FORMATS[image_format]}')
+
+
+def variant_path(path, size):
+    if size == 'full':
+        return path
+    return _suffixed(path, size)
+
+
+def _suffixed(path, suffix):
+    stem, extension = os.path.splitext(path)
+    return f'{stem}_{suffix}{extension}'
+
+
+def mimetype(path):
+    return MIMETYPES.get(os.path.splitext(path)[1].lower(), 'application/octet-stream')
+
+
+def _save(image, path, max_side, quality):
+    # Write a copy of image no larger than max_side, atomically
+    image = image.copy()
+    image.thumbnail((max_side, max_side), Image.LANCZOS)
+    image_format = SAVE_FORMATS.get(os.path.splitext(path)[1].lower(), 'JPEG')
+    partial_path = path + '.part'
+    image.save(partial_path, image_format, quality=quality, optimize=image_format == 'JPEG')
+    os.replace(partial_path, path)
+
+
+def save_profile_picture(image, path, quality=85, variants=True):
+    # Save an RGB array or PIL image as the full picture at path and, unless
+    # variants is False, every smaller variant next to it
+    if not isinstance(image, Image.Image):
+        image = Image.fromarray(image)
+    image = image.convert('RGB')
+    for size, max_side in VARIANT_SIZES.items():
+        if size == 'full' or variants:
+            _save(image, variant_path(path, size), max_side, quality)
+    return path
+
+
+def _generate_variants(path, quality):
+    # Variants of a picture saved without them. The thumbnail is written
+    # last, so its presence means the others exist
+    with Image.open(path) as image:
+        image = image.convert('RGB')
+    if max(image.size) > VARIANT_SIZES['full']:
+        _save(image, _suffixed(path, 'full'), VARIANT_SIZES['full'], quality)
+    for size in ('medium', 'thumb'):
+        _save(image, variant_path(path, size), VARIANT_SIZES[size], quality)
+
+
+def ensure_variant(path, size, quality=85):
+    # Path of the requested variant of the picture at path, generating the
+    # variants from the stored picture if needed; None if there is no picture
+    if not os.path.exists(path):
+        return None
+    if not os.path.exists(variant_path(path, 'thumb')):
+        _generate_variants(path, quality)
+    if size == 'full':
+        capped_path = _suffixed(path, 'full')
+        return capped_path if os.path.exists(capped_path) else path
+    return variant_path(path, size)
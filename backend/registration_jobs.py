@@ -0,0 +1,55 @@
+import logging
+import uuid
+from background import BoundedExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class RegistrationError(Exception):
+    # A registration refused because of its image, e.g. no face in it
+
+    def __init__(self, outcome, message, status=400):
+        super().__init__(message)
+        self.outcome = outcome
+        self.status = status
+
+
+class RegistrationQueue:
+    # Background registrations.
+    #
+    # submit() records a queued job in the user store and returns its id
+    # straight away; a pool of threads then runs the registration, which
+    # reports progress through the job record: processing, matchable (the
+    # user is in the gallery), then completed or failed. Job records live in
+    # the database, so any worker process can answer status requests.
+
+    def __init__(self, user_store, workers=2, max_pending=100):
+        self.user_store = user_store
+        self.max_pending = max_pending
+        self._executor = BoundedExecutor(workers, max_pending, 'registration')
+
+    def submit(self, name, register):
+        # Queue register(report) and return the job id, or None if the queue
+        # is full. register returns (user_id, profile_picture) and may call
+        # report(status, **fields) to publish progress.
+        job_id = uuid.uuid4().hex
+        future = self._executor.submit(self._run, job_id, register,
+                                       before=lambda: self.user_store.create_job(job_id, name))
+        return job_id if future is not None else None
+
+    def pending(self):
+        return self._executor.pending()
+
+    def _run(self, job_id, register):
+        def report(status, **fields):
+            self.user_store.update_job(job_id, status, **fields)
+
+        try:
+            report('processing')
+            user_id, profile_picture = register(report)
+            report('completed', user_id=user_id, profile_picture=profile_picture)
+        except RegistrationError as e:
+            report('failed', message=str(e))
+        except Exception as e:
+            logger.exception("Registration job %s failed", job_id)
+            report('failed', message=str(e))
@@ -0,0 +1,261 @@
+import argparse
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import config
+from logging_setup import configure_logging, stop_logging
+from metrics import set_worker_label
+
+# Production entry point: a pre-fork pool of Flask workers on one port.
+#
+# The parent binds the listening socket first, so early clients queue in the
+# backlog instead of being refused, and answers /healthz and /readyz on it
+# while it starts up. It imports app.py once and runs its init_app(), which
+# maps the face gallery and loads the dlib detector, the shape predictor and
+# face_recognition's models in the background, waits for the models and for
+# the face index to catch up with the gallery (training it if needed), and
+# forks one worker per core. Workers inherit the loaded models and index
+# copy-on-write instead of loading their own, and all of them accept() on
+# the shared socket, so a slow /api/verify in one worker no longer blocks
+# /api/detect-face polls served by the others. Registrations are appended to
+# the shared embedding file and every worker maps new rows before matching.
+#
+# Platforms without os.fork (Windows) fall back to a single threaded server.
+
+logger = logging.getLogger('faceguard.serve')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Serve FaceGuard Pro with a pool of worker processes')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='number of worker processes (default: one per core)')
+    parser.add_argument('--no-threads', action='store_true',
+                        help='handle one request at a time in each worker')
+    parser.add_argument('--backlog', type=int, default=128)
+    return parser.parse_args()
+
+
+def warm_up_worker(app_module):
+    # Touch the inherited models once so the first real request does not pay
+    # for faulting their pages in, and bring the face index up to date
+    import numpy as np
+    blank = np.zeros((64, 64), dtype=np.uint8)
+    app_module.models.detector(blank)
+    app_module.gallery.refresh()
+    app_module.face_index.sync()
+
+
+def run_worker(app_module, listener, index, threaded, index_conn):
+    from werkzeug.serving import make_server
+
+    # Each worker reports its own metrics series
+    set_worker_label(index)
+    if index_conn is not None:
+        # Query the parent's gallery shards rather than start its own
+        from sharded_index import RemoteIndex
+        app_module.face_index = RemoteIndex(app_module.gallery, index_conn)
+    start = time.perf_counter()
+    warm_up_worker(app_module)
+    load_ms = (time.perf_counter() - start) * 1000.0
+    logger.info("Worker %d (pid %d) ready: models shared from parent, warm-up took %.1f ms, "
+                "gallery has %d encodings", index, os.getpid(), load_ms, len(app_module.gallery))
+
+    host, port = listener.getsockname()[:2]
+    server = make_server(host, port, app_module.app, threaded=threaded, fd=listener.fileno())
+    # The parent handles Ctrl+C and stops workers with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        stop_logging()
+        os._exit(0)
+
+
+def spawn_worker(app_module, listener, index, threaded, index_server):
+    index_conn = index_server.connect() if index_server is not None else None
+    pid = os.fork()
+    if pid == 0:
+        try:
+            run_worker(app_module, listener, index, threaded, index_conn)
+        except BaseException:
+            logger.exception("Worker %d failed", index)
+            stop_logging()
+            os._exit(1)
+    if index_conn is not None:
+        index_conn.close()
+    return pid
+
+
+def start_index_server(app_module):
+    # One set of gallery shards for every worker, started before forking and
+    # reading a gallery of its own, so no worker shares a lock with the
+    # threads answering them. Its shards are loaded by the caller
+    from embedding_file import EmbeddingFile
+    from gallery import FaceGallery
+    from sharded_index import IndexServer
+    index = app_module.create_face_index(FaceGallery(embedding_file=EmbeddingFile(app_module.EMBEDDING_FILE)))
+    return IndexServer(index)
+
+
+class StartupProbes:
+    # WSGI app the parent serves on the listening socket until the workers
+    # take over: /healthz answers 200 (500 once the models fail to load),
+    # /readyz 503 with the startup progress, and anything else 503
+
+    def __init__(self):
+        self.app_module = None
+
+    def status(self):
+        app_module = self.app_module
+        if app_module is None or app_module.models is None:
+            return {'ready': False, 'stage': 'starting', 'error': None}
+        return dict(app_module.models.status(), ready=False,
+                    faceIndexReady=app_module.index_ready.is_set(), faceIndexError=app_module.index_error)
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        status = self.status()
+        if path == '/healthz' and status['error'] is None:
+            code, body = '200 OK', {'status': 'ok'}
+        elif path == '/healthz':
+            code, body = '500 Internal Server Error', {'status': 'error', 'error': status['error']}
+        elif path == '/readyz':
+            code, body = '503 Service Unavailable', status
+        else:
+            code, body = '503 Service Unavailable', {
+                'success': False, 'message': 'The server is starting. Please retry shortly.'}
+        payload = json.dumps(body).encode('utf-8')
+        start_response(code, [('Content-Type', 'application/json'), ('Content-Length', str(len(payload))),
+                              ('Retry-After', '1')])
+        return [payload]
+
+
+def serve_probes(listener, probes):
+    # Answer probes from a thread of the parent while it starts up; returns
+    # a function that stops that before forking
+    from werkzeug.serving import make_server
+    host, port = listener.getsockname()[:2]
+    server = make_server(host, port, probes, threaded=False, fd=listener.fileno())
+    thread = threading.Thread(target=server.serve_forever, name='startup-probes', daemon=True)
+    thread.start()
+
+    def stop():
+        server.shutdown()
+        thread.join()
+        server.server_close()
+    return stop
+
+
+def wait_for_index(app_module):
+    # True once the face index caught up with the gallery, False if that failed
+    while not app_module.index_ready.wait(1.0):
+        if app_module.index_error is not None:
+            return False
+    return True
+
+
+def main():
+    args = parse_args()
+    configure_logging(config.LOG_LEVEL, config.LOG_FORMAT, config.LOG_FRAME_SAMPLE_EVERY)
+
+    if not hasattr(os, 'fork'):
+        # Models load and the face index syncs in the background while this
+        # server already answers /healthz and /readyz
+        logger.warning("os.fork is not available on this platform; serving from a single process")
+        import app as app_module
+        app_module.init_app()
+        app_module.sync_index_in_background()
+        app_module.app.run(host=args.host, port=args.port, threaded=not args.no_threads)
+        return
+
+    workers = max(1, args.workers)
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((args.host, args.port))
+    listener.listen(args.backlog)
+    listener.set_inheritable(True)
+    logger.info("Listening on %s:%d", args.host, args.port)
+
+    probes = StartupProbes()
+    stop_probes = serve_probes(listener, probes)
+
+    logger.info("Loading application and models in the parent process...")
+    start = time.perf_counter()
+    import app as app_module
+    app_module.init_app()
+    probes.app_module = app_module
+    logger.info("Application loaded in %.2f s", time.perf_counter() - start)
+
+    # The face index catches up with the gallery while the models load
+    index_server = start_index_server(app_module) if config.FACE_INDEX == 'sharded' else None
+    app_module.sync_index_in_background(index_server.index if index_server is not None else None)
+
+    # Workers share the parent's models and index, so both are ready before
+    # forking
+    if not app_module.models.wait():
+        logger.error("Face models failed to load: %s", app_module.models.error)
+        stop_logging()
+        sys.exit(1)
+    logger.info("Models ready %.2f s after start", time.perf_counter() - start)
+    if not wait_for_index(app_module):
+        logger.error("Face index failed to load: %s", app_module.index_error)
+        stop_logging()
+        sys.exit(1)
+    stop_probes()
+
+    # SQLite connections must not be carried across fork; each worker opens
+    # its own on first use
+    app_module.user_store.close()
+
+    logger.info("Starting %d worker processes on %s:%d (%s workers)", workers, args.host, args.port,
+                'threaded' if not args.no_threads else 'single-threaded')
+    children = {}
+    for index in range(workers):
+        children[spawn_worker(app_module, listener, index, not args.no_threads, index_server)] = index
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # Supervise: replace workers that die until asked to stop
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        index = children.pop(pid, None)
+        if index is None or stopping:
+            continue
+        logger.warning("Worker %d (pid %d) exited with status %d; restarting", index, pid, status)
+        children[spawn_worker(app_module, listener, index, not args.no_threads, index_server)] = index
+
+    listener.close()
+    if index_server is not None:
+        index_server.close()
+    logger.info("All workers stopped")
+    stop_logging()
+
+
+if __name__ == '__main__':
+    main()
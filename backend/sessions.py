@@ -0,0 +1,57 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class DetectionSession:
+    # Per-client state carried between detect-face frames
+
+    def __init__(self, tracker=None, liveness=None, frames=None):
+        self.lock = threading.Lock()
+        self.tracker = tracker
+        self.liveness = liveness
+        self.frames = frames
+
+
+class SessionRegistry:
+    # Detection sessions keyed by the client's session id.
+    #
+    # Sessions are created on first use by factory(session_id), expire after ttl_seconds without a
+    # frame and are evicted least-recently-used beyond max_sessions, so
+    # abandoned kiosk tabs cannot grow memory without bound.
+    #
+    # A registry belongs to one process. serve.py's workers share one
+    # listening socket, so only the WebSocket stream keeps every frame of a
+    # session on one worker. HTTP frames may reach any worker. Their face
+    # tracker and frame-difference cache are therefore per-worker caches,
+    # and a frame reaching another worker just gets a full analysis. Their
+    # liveness state, which must see the whole blink, is saved in the user
+    # store between frames.
+
+    def __init__(self, factory, ttl_seconds=60.0, max_sessions=1000):
+        self.factory = factory
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, session_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            if entry is None or now - entry[1] > self.ttl_seconds:
+                session = self.factory(session_id)
+            else:
+                session = entry[0]
+            self._sessions[session_id] = (session, now)
+
+            # Oldest entries are at the front
+            while self._sessions:
+                oldest_id, (_, last_seen) = next(iter(self._sessions.items()))
+                if len(self._sessions) <= self.max_sessions and now - last_seen <= self.ttl_seconds:
+                    break
+                del self._sessions[oldest_id]
+            return session
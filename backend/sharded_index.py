@@ -0,0 +1,336 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import numpy as np
+from gallery import FaceGallery
+
+# Gallery partitioned across local shard processes, queried scatter-gather.
+#
+# Users are hashed into BUCKETS fixed buckets and each bucket is assigned to
+# one shard process holding the gallery rows of its users in memory. A query
+# is sent to every shard at once, each shard scans only its own rows and
+# returns its top-k, and the coordinator merges them, so scan time shrinks
+# with the number of shards (and cores).
+#
+# The coordinator reads rows from the FaceGallery like the other indexes and
+# forwards rows the gallery gained since the last query to their shards.
+# resize() adds or removes shards while queries continue: the buckets that
+# move are first loaded into their new shards, then the bucket map switches
+# over, and only then do the old shards drop them. A user present in two
+# shards meanwhile is merged by id.
+#
+# Shard processes belong to the process that started them; a process forked
+# afterwards starts its own on first use. serve.py instead starts one set of
+# shards in its parent, before forking, and shares it with every worker
+# through an IndexServer: each worker queries it over a pipe of its own with
+# a RemoteIndex.
+
+BUCKETS = 256
+
+# Rows per message when loading shards
+FEED_CHUNK = 65536
+
+logger = logging.getLogger(__name__)
+
+
+def bucket_of(user_id):
+    digest = hashlib.blake2b(str(user_id).encode('utf-8'), digest_size=4).digest()
+    return int.from_bytes(digest, 'little') % BUCKETS
+
+
+def _context():
+    # Shards are started from threaded servers, where a forked child could
+    # inherit locks other threads hold, so they are spawned: a fresh
+    # interpreter that imports this module and numpy
+    return multiprocessing.get_context('spawn')
+
+
+def _serve_shard(conn):
+    # Shard process: answers ('search', query, top_k) with its top-k and
+    # applies ('add', ids, encodings), ('drop', buckets) and ('stop',)
+    # The coordinator handles Ctrl+C; a shard stops when told to or when
+    # the coordinator's end of the pipe closes
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    gallery = FaceGallery()
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        kind = message[0]
+        if kind == 'search':
+            conn.send(gallery.search(message[1], top_k=message[2]))
+        elif kind == 'add':
+            gallery.add_many(message[1], message[2])
+        elif kind == 'drop':
+            ids, encodings = gallery.rows(0, len(gallery))
+            keep = np.array([bucket_of(user_id) not in message[1] for user_id in ids], dtype=bool)
+            kept = FaceGallery(initial_capacity=max(int(keep.sum()), 1))
+            kept.add_many(ids[keep].tolist(), encodings[keep])
+            gallery = kept
+        elif kind == 'stop':
+            break
+    conn.close()
+
+
+class _Shard:
+
+    def __init__(self, index):
+        context = _context()
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_serve_shard, args=(child_conn,),
+                                       name=f'gallery-shard-{index}', daemon=True)
+        self.process.start()
+        child_conn.close()
+        self._send_lock = threading.Lock()
+
+    def send(self, message):
+        with self._send_lock:
+            self.conn.send(message)
+
+    def stop(self):
+        try:
+            self.send(('stop',))
+        except OSError:
+            pass
+        self.process.join(timeout=5)
+        self.conn.close()
+
+
+def balanced_assignment(current, shard_count):
+    # Bucket-to-shard map for shard_count shards that moves as few buckets
+    # as possible away from the current map
+    targets = [BUCKETS // shard_count + (1 if i < BUCKETS % shard_count else 0) for i in range(shard_count)]
+    assignment = np.array(current, dtype=np.int64)
+    free = [bucket for bucket in range(BUCKETS) if assignment[bucket] >= shard_count]
+    for shard in range(shard_count):
+        owned = np.flatnonzero(assignment == shard)
+        free.extend(owned[targets[shard]:].tolist())
+    loads = np.bincount(assignment[assignment < shard_count], minlength=shard_count)
+    for bucket in free:
+        if assignment[bucket] < shard_count:
+            loads[assignment[bucket]] -= 1
+        shard = int(np.argmin(loads - np.array(targets)))
+        assignment[bucket] = shard
+        loads[shard] += 1
+    return assignment
+
+
+class ShardedIndex:
+
+    def __init__(self, gallery, shards=2):
+        self.gallery = gallery
+        self.shard_count = max(1, shards)
+        self._sync_lock = threading.RLock()
+        self._query_lock = threading.Lock()
+        self._pid = None
+        self._shards = []
+        self._assignment = np.arange(BUCKETS) % self.shard_count
+        self._row_buckets = np.empty(0, dtype=np.int16)
+        self._indexed = 0
+
+    def __len__(self):
+        return len(self.gallery)
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        # Shards inherited from a parent process are not ours to use
+        self._shards = [_Shard(index) for index in range(self.shard_count)]
+        self._assignment = np.arange(BUCKETS) % self.shard_count
+        self._indexed = 0
+        self._pid = os.getpid()
+        logger.info("Started %d gallery shard processes", self.shard_count)
+
+    def _send_rows(self, rows, assignment, shards):
+        # Send gallery rows (ascending, so a user's newest row stays current)
+        # to the shards their buckets are assigned to
+        if len(rows) == 0:
+            return
+        ids, encodings = self.gallery.rows(0, self._indexed)
+        targets = assignment[self._row_buckets[rows]]
+        for shard_index in np.unique(targets):
+            shard_rows = rows[targets == shard_index]
+            for start in range(0, len(shard_rows), FEED_CHUNK):
+                chunk = shard_rows[start:start + FEED_CHUNK]
+                shards[shard_index].send(('add', ids[chunk].tolist(),
+                                          np.ascontiguousarray(encodings[chunk], dtype=np.float32)))
+
+    def sync(self):
+        # Start this process's shards if needed and forward new gallery rows
+        with self._sync_lock:
+            self._ensure_started()
+            start, size = self._indexed, len(self.gallery)
+            if size <= start:
+                return
+            ids, _ = self.gallery.rows(start, size)
+            if size > len(self._row_buckets):
+                row_buckets = np.empty(max(size, 2 * len(self._row_buckets)), dtype=np.int16)
+                row_buckets[:start] = self._row_buckets[:start]
+                self._row_buckets = row_buckets
+            self._row_buckets[start:size] = [bucket_of(user_id) for user_id in ids]
+            self._indexed = size
+            self._send_rows(np.arange(start, size), self._assignment, self._shards)
+
+    def search(self, encoding, top_k=1):
+        if top_k <= 0 or len(self.gallery) == 0:
+            return []
+        # Pick up new rows, unless a resize holds the sync lock: then search
+        # what the shards already have rather than wait for it
+        if self._pid != os.getpid():
+            self.sync()
+        elif self._sync_lock.acquire(blocking=False):
+            try:
+                self.sync()
+            finally:
+                self._sync_lock.release()
+
+        query = np.asarray(encoding, dtype=np.float32).reshape(self.gallery.dim)
+        with self._query_lock:
+            shards = self._shards
+            for shard in shards:
+                shard.send(('search', query, top_k))
+            results = [shard.conn.recv() for shard in shards]
+
+        best = {}
+        for shard_results in results:
+            for user_id, distance in shard_results:
+                if distance < best.get(user_id, np.inf):
+                    best[user_id] = distance
+        return sorted(best.items(), key=lambda match: match[1])[:top_k]
+
+    def resize(self, shard_count):
+        # Change the number of shards without pausing queries
+        shard_count = max(1, shard_count)
+        with self._sync_lock:
+            self.sync()
+            old_assignment = self._assignment
+            old_count = len(self._shards)
+            shards = self._shards + [_Shard(index) for index in range(old_count, shard_count)]
+            assignment = balanced_assignment(old_assignment, shard_count)
+            moved = np.flatnonzero(assignment != old_assignment)
+
+            # Load the moving buckets into their new shards first
+            rows = np.flatnonzero(np.isin(self._row_buckets[:self._indexed], moved))
+            self._send_rows(rows, assignment, shards)
+            with self._query_lock:
+                self._shards = shards[:shard_count]
+                self._assignment = assignment
+            self.shard_count = shard_count
+
+            # Then let the old owners drop them and stop removed shards
+            for index in range(min(old_count, shard_count)):
+                dropped = set(moved[old_assignment[moved] == index].tolist())
+                if dropped:
+                    shards[index].send(('drop', dropped))
+            for shard in shards[shard_count:]:
+                shard.stop()
+            logger.info("Resized gallery from %d to %d shards, moving %d of %d buckets",
+                        old_count, shard_count, len(moved), BUCKETS)
+
+    def close(self):
+        with self._sync_lock, self._query_lock:
+            if self._pid == os.getpid():
+                for shard in self._shards:
+                    shard.stop()
+            self._shards = []
+            self._pid = None
+
+    def stats(self):
+        return {
+            'shards': self.shard_count,
+            'bucketsPerShard': np.bincount(self._assignment, minlength=self.shard_count).tolist(),
+        }
+
+
+class IndexServer:
+    # Answers queries from other processes against one ShardedIndex.
+    #
+    # serve.py builds it in its parent before forking and gives each worker
+    # the pipe returned by connect(); a thread of the parent answers that
+    # pipe. The index should read a gallery of its own: those threads keep
+    # running while the parent forks replacement workers, which must not
+    # inherit a gallery lock one of them holds.
+
+    def __init__(self, index):
+        self.index = index
+
+    def connect(self):
+        # A new pipe for one worker process; the caller passes the returned
+        # end to the worker and closes its own copy once it has forked
+        server_conn, client_conn = multiprocessing.Pipe()
+        threading.Thread(target=self._serve, args=(server_conn,), name='index-server', daemon=True).start()
+        return client_conn
+
+    def _serve(self, conn):
+        with conn:
+            while True:
+                try:
+                    kind, *args = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    reply = ('ok', self._handle(kind, args))
+                except Exception as e:
+                    logger.exception("Sharded index %s request failed", kind)
+                    reply = ('error', str(e))
+                try:
+                    conn.send(reply)
+                except OSError:
+                    return
+
+    def _handle(self, kind, args):
+        if kind in ('sync', 'search'):
+            # Map rows other workers appended to the embedding file
+            self.index.gallery.refresh()
+            self.index.sync()
+            return self.index.search(*args) if kind == 'search' else None
+        if kind == 'resize':
+            return self.index.resize(*args)
+        if kind == 'stats':
+            return self.index.stats()
+        raise ValueError(f'Unknown sharded index request {kind!r}')
+
+    def close(self):
+        self.index.close()
+
+
+class RemoteIndex:
+    # A worker's view of the ShardedIndex behind an IndexServer, with the
+    # interface of the other indexes
+
+    def __init__(self, gallery, conn):
+        self.gallery = gallery
+        self.conn = conn
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.gallery)
+
+    def _call(self, *message):
+        with self._lock:
+            self.conn.send(message)
+            status, result = self.conn.recv()
+        if status != 'ok':
+            raise RuntimeError(f'Sharded index request failed: {result}')
+        return result
+
+    def sync(self):
+        self._call('sync')
+
+    def search(self, encoding, top_k=1):
+        if top_k <= 0 or len(self.gallery) == 0:
+            return []
+        return self._call('search', np.asarray(encoding, dtype=np.float32), top_k)
+
+    def resize(self, shard_count):
+        self._call('resize', shard_count)
+
+    def stats(self):
+        return self._call('stats')
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,67 @@
+import numpy as np
+from gallery import ENCODING_DIM
+
+# Face templates aggregated from several enrollment samples of one person.
+#
+# A user's gallery row is the centroid (mean) of every sample enrolled for
+# them, which sits closer to new captures of that person than any single
+# sample does. A few of the samples are also kept as exemplars, picked to be
+# as different from each other as possible (glasses on and off, different
+# lighting); the best candidates of a search are re-scored against them.
+
+
+def as_matrix(encodings):
+    return np.asarray(encodings, dtype=np.float64).reshape(-1, ENCODING_DIM)
+
+
+def centroid(encodings):
+    return as_matrix(encodings).mean(axis=0)
+
+
+def update_centroid(current, count, encodings):
+    # Centroid of `count` samples averaging `current` plus the new encodings,
+    # and the new sample count
+    encodings = as_matrix(encodings)
+    total = count + len(encodings)
+    return (np.asarray(current, dtype=np.float64) * count + encodings.sum(axis=0)) / total, total
+
+
+def max_distance(encodings):
+    # Largest distance between any two of the encodings
+    encodings = as_matrix(encodings)
+    if len(encodings) < 2:
+        return 0.0
+    diff = encodings[:, None, :] - encodings[None, :, :]
+    return float(np.sqrt(np.einsum('ijk,ijk->ij', diff, diff)).max())
+
+
+def select_exemplars(encodings, max_count):
+    # Indices of up to max_count diverse encodings: greedy farthest-point
+    # selection starting from the one nearest the centroid
+    encodings = as_matrix(encodings)
+    if len(encodings) <= max_count:
+        return list(range(len(encodings)))
+    if max_count <= 0:
+        return []
+    first = int(np.argmin(np.linalg.norm(encodings - encodings.mean(axis=0), axis=1)))
+    chosen = [first]
+    nearest = np.linalg.norm(encodings - encodings[first], axis=1)
+    while len(chosen) < max_count:
+        index = int(np.argmax(nearest))
+        chosen.append(index)
+        nearest = np.minimum(nearest, np.linalg.norm(encodings - encodings[index], axis=1))
+    return sorted(chosen)
+
+
+def rescore(encoding, matches, exemplars):
+    # Re-rank (user_id, centroid distance) pairs by the closer of the centroid
+    # and the user's nearest exemplar; exemplars maps user ids to matrices
+    query = np.asarray(encoding, dtype=np.float32).reshape(ENCODING_DIM)
+    rescored = []
+    for user_id, distance in matches:
+        user_exemplars = exemplars.get(user_id)
+        if user_exemplars is not None and len(user_exemplars):
+            distance = min(distance, float(np.linalg.norm(user_exemplars - query, axis=1).min()))
+        rescored.append((user_id, distance))
+    rescored.sort(key=lambda match: match[1])
+    return rescored
@@ -0,0 +1,199 @@
+import os
+import threading
+import numpy as np
+import pytest
+from ann_index import FlatIndex, create_index
+from embedding_file import EmbeddingFile
+from gallery import FaceGallery
+from sharded_index import IndexServer, RemoteIndex
+
+# Every gallery index against the exact scan of FlatIndex, on synthetic
+# encodings shaped like dlib's (identity centres, captures with noise).
+
+GALLERY_SIZE = 3000
+QUERIES = 100
+
+INDEXES = {
+    'ivfpq': dict(kind='ivfpq', nlist=32, nprobe=8, rerank=64, min_train_size=1),
+    'float16': dict(kind='float16', rerank=0, min_train_size=1),
+    'float16-rerank': dict(kind='float16', rerank=32, min_train_size=1),
+    'int8': dict(kind='int8', rerank=0, min_train_size=1),
+    'int8-rerank': dict(kind='int8', rerank=32, min_train_size=1),
+    'sharded': dict(kind='sharded', shards=2),
+}
+
+# Least recall@1 each index must reach; the compact scans without re-scoring
+# may swap near ties, the others must agree with the exact scan
+MIN_RECALL = {'ivfpq': 0.95, 'float16': 0.99, 'int8': 0.95}
+
+
+def synthetic_encodings(count, rng):
+    return rng.normal(0.0, 0.09, size=(count, 128)).astype(np.float32)
+
+
+def capture(encodings, rng, noise=0.03):
+    return encodings + rng.normal(0.0, noise, size=encodings.shape).astype(np.float32)
+
+
+def build_index(gallery, name):
+    options = dict(INDEXES[name])
+    return create_index(gallery, options.pop('kind'), **options)
+
+
+@pytest.fixture
+def index_factory():
+    # Builds indexes and stops any shard processes they start
+    indexes = []
+
+    def factory(gallery, name):
+        index = build_index(gallery, name)
+        indexes.append(index)
+        return index
+
+    yield factory
+    for index in indexes:
+        if hasattr(index, 'close'):
+            index.close()
+
+
+@pytest.fixture(scope='module')
+def populated():
+    rng = np.random.default_rng(0)
+    encodings = synthetic_encodings(GALLERY_SIZE, rng)
+    gallery = FaceGallery(initial_capacity=GALLERY_SIZE)
+    gallery.add_many([str(i) for i in range(GALLERY_SIZE)], encodings)
+    queries = capture(encodings[rng.choice(GALLERY_SIZE, QUERIES, replace=False)], rng)
+    return gallery, queries
+
+
+@pytest.mark.parametrize('name', sorted(INDEXES))
+def test_recall_against_flat(populated, index_factory, name):
+    gallery, queries = populated
+    exact = FlatIndex(gallery)
+    index = index_factory(gallery, name)
+    hits = 0
+    for query in queries:
+        result = index.search(query, top_k=5)
+        assert result, 'no match returned from a populated gallery'
+        assert [distance for _, distance in result] == sorted(distance for _, distance in result)
+        hits += result[0][0] == exact.search(query, top_k=1)[0][0]
+    assert hits / len(queries) >= MIN_RECALL.get(name, 1.0)
+
+
+@pytest.mark.parametrize('name', ['flat'] + sorted(INDEXES))
+def test_empty_gallery(index_factory, name):
+    gallery = FaceGallery()
+    index = FlatIndex(gallery) if name == 'flat' else index_factory(gallery, name)
+    index.sync()
+    assert index.search(np.zeros(128, dtype=np.float32), top_k=5) == []
+
+
+@pytest.mark.parametrize('name', sorted(INDEXES))
+def test_superseded_rows_are_not_returned(index_factory, name):
+    rng = np.random.default_rng(1)
+    encodings = synthetic_encodings(1000, rng)
+    gallery = FaceGallery()
+    gallery.add_many([str(i) for i in range(len(encodings))], encodings)
+    index = index_factory(gallery, name)
+    index.sync()
+
+    # User 0 re-enrolls many times near their old template, then moves far
+    # away: the rows nearest the old template are all superseded
+    old = encodings[0]
+    for _ in range(100):
+        gallery.add('0', capture(old[None, :], rng, noise=0.001)[0])
+    new = synthetic_encodings(1, rng)[0]
+    gallery.add('0', new)
+
+    result = index.search(old, top_k=3)
+    assert len(result) == 3
+    assert '0' not in [user_id for user_id, _ in result] or \
+        dict(result)['0'] == pytest.approx(float(np.linalg.norm(new - old)), rel=0.05)
+    assert index.search(new, top_k=1)[0][0] == '0'
+
+
+@pytest.mark.parametrize('name', sorted(INDEXES))
+def test_rows_from_another_process_after_refresh(tmp_path, index_factory, name):
+    rng = np.random.default_rng(2)
+    path = str(tmp_path / 'embeddings.f32')
+    writer = FaceGallery(embedding_file=EmbeddingFile(path))
+    encodings = synthetic_encodings(500, rng)
+    writer.add_many([str(i) for i in range(len(encodings))], encodings)
+
+    reader = FaceGallery(embedding_file=EmbeddingFile(path))
+    index = index_factory(reader, name)
+    index.sync()
+
+    # Another worker registers a user and updates an existing one
+    added = synthetic_encodings(1, rng)[0]
+    moved = synthetic_encodings(1, rng)[0]
+    writer.add('new', added)
+    writer.add('7', moved)
+    reader.refresh()
+
+    assert index.search(added, top_k=1)[0][0] == 'new'
+    assert index.search(moved, top_k=1)[0][0] == '7'
+    assert '7' not in [user_id for user_id, _ in index.search(encodings[7], top_k=3)]
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_forked_worker_queries_shared_shards(tmp_path):
+    # serve.py's layout: the parent serves shards over a pipe per worker
+    rng = np.random.default_rng(3)
+    path = str(tmp_path / 'embeddings.f32')
+    writer = FaceGallery(embedding_file=EmbeddingFile(path))
+    encodings = synthetic_encodings(500, rng)
+    writer.add_many([str(i) for i in range(len(encodings))], encodings)
+    added = synthetic_encodings(1, rng)[0]
+
+    server = IndexServer(create_index(FaceGallery(embedding_file=EmbeddingFile(path)), 'sharded', shards=2))
+    try:
+        server.index.sync()
+        conn = server.connect()
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            worker_gallery = FaceGallery(embedding_file=EmbeddingFile(path))
+            index = RemoteIndex(worker_gallery, conn)
+            index.sync()
+            found = [index.search(encodings[i], top_k=1)[0][0] for i in (0, 250, 499)]
+            # A registration appended by another worker
+            FaceGallery(embedding_file=EmbeddingFile(path)).add('new', added)
+            worker_gallery.refresh()
+            found.append(index.search(added, top_k=1)[0][0])
+            index.resize(3)
+            found.append(str(index.stats()['shards']))
+            os.write(write, ','.join(found).encode('utf-8'))
+            os._exit(0)
+        conn.close()
+        os.close(write)
+        os.waitpid(pid, 0)
+        assert os.read(read, 1024).decode('utf-8') == '0,250,499,new,3'
+    finally:
+        server.close()
+
+
+@pytest.mark.parametrize('name', ['ivfpq', 'int8', 'float16'])
+def test_search_during_first_sync_answers_with_exact_scan(populated, index_factory, name):
+    gallery, queries = populated
+    index = index_factory(gallery, name)
+    flat = FlatIndex(gallery)
+    # Another thread is busy with the first sync, e.g. training at startup
+    busy = threading.Event()
+    release = threading.Event()
+
+    def hold_lock():
+        with index._lock:
+            busy.set()
+            release.wait(10)
+
+    holder = threading.Thread(target=hold_lock)
+    holder.start()
+    try:
+        busy.wait(5)
+        assert index.search(queries[0], top_k=3) == flat.search(queries[0], top_k=3)
+    finally:
+        release.set()
+        holder.join()
+    index.sync()
+    assert index.search(queries[0], top_k=1)[0][0] == flat.search(queries[0], top_k=1)[0][0]
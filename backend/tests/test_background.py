@@ -0,0 +1,37 @@
+import os
+import threading
+import pytest
+from background import BoundedExecutor, ProcessLocal
+
+# The per-process background helpers: bounded submission, and a fresh value
+# in a forked child.
+
+
+def test_bounded_executor_refuses_beyond_max_pending():
+    executor = BoundedExecutor(workers=1, max_pending=2, name='test')
+    release = threading.Event()
+    recorded = []
+    futures = [executor.submit(release.wait, before=lambda: recorded.append(1)) for _ in range(3)]
+    assert futures[2] is None
+    assert recorded == [1, 1]
+    assert executor.pending() == 2
+    release.set()
+    for future in futures[:2]:
+        future.result(timeout=5)
+    assert executor.pending() == 0
+    assert executor.submit(lambda: 'done').result(timeout=5) == 'done'
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_process_local_rebuilds_in_forked_child():
+    local = ProcessLocal(lambda: os.getpid())
+    assert local.get() == os.getpid()
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        ok = local.peek() is None and local.get() == os.getpid()
+        os.write(write, b'1' if ok else b'0')
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert os.read(read, 1) == b'1'
+    assert local.get() == os.getpid()
@@ -0,0 +1,45 @@
+import os
+import time
+import numpy as np
+import pytest
+from gallery import FaceGallery
+from sharded_index import ShardedIndex
+
+# Sharding must pay off where there are cores for it: two shards answer at
+# least 0.7 x min(2, cpus) times faster than one (benchmarks/shard_scaling.py
+# applies the same bound to larger galleries and shard counts).
+
+GALLERY_SIZE = 200000
+QUERIES = 40
+SHARDS = 2
+EFFICIENCY = 0.7
+
+
+def median_latency(index, queries):
+    index.sync()
+    index.search(queries[0], top_k=5)
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query, top_k=5)
+        latencies.append(time.perf_counter() - start)
+    return float(np.median(latencies))
+
+
+@pytest.mark.skipif((os.cpu_count() or 1) < 2, reason='needs at least 2 CPUs')
+def test_two_shards_scale_over_one():
+    rng = np.random.default_rng(0)
+    gallery = FaceGallery(initial_capacity=GALLERY_SIZE)
+    gallery.add_many([str(i) for i in range(GALLERY_SIZE)],
+                     rng.normal(0.0, 0.09, size=(GALLERY_SIZE, 128)).astype(np.float32))
+    queries = rng.normal(0.0, 0.09, size=(QUERIES, 128)).astype(np.float32)
+
+    latencies = {}
+    for shards in (1, SHARDS):
+        index = ShardedIndex(gallery, shards=shards)
+        try:
+            latencies[shards] = median_latency(index, queries)
+        finally:
+            index.close()
+
+    assert latencies[1] / latencies[SHARDS] >= EFFICIENCY * min(SHARDS, os.cpu_count())
@@ -0,0 +1,468 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+import numpy as np
+from templates import select_exemplars, update_centroid
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    face_encoding BLOB,
+    registered_at TEXT NOT NULL,
+    profile_picture TEXT,
+    sample_count INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS face_samples (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    face_encoding BLOB NOT NULL,
+    added_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS face_samples_user_id ON face_samples (user_id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS registration_jobs (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    status TEXT NOT NULL,
+    user_id INTEGER,
+    profile_picture TEXT,
+    message TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS imports (
+    id TEXT PRIMARY KEY,
+    source TEXT,
+    created_at TEXT NOT NULL,
+    committed_at TEXT,
+    status TEXT,
+    message TEXT
+);
+CREATE TABLE IF NOT EXISTS import_items (
+    import_id TEXT NOT NULL,
+    item_key TEXT NOT NULL,
+    name TEXT,
+    status TEXT NOT NULL,
+    message TEXT,
+    face_encoding BLOB,
+    staged_picture TEXT,
+    user_id INTEGER,
+    PRIMARY KEY (import_id, item_key)
+);
+CREATE TABLE IF NOT EXISTS liveness_nonces (
+    nonce TEXT PRIMARY KEY,
+    expires_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS liveness_nonces_expires_at ON liveness_nonces (expires_at);
+CREATE TABLE IF NOT EXISTS liveness_states (
+    session_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS liveness_states_updated_at ON liveness_states (updated_at);
+"""
+
+
+def encoding_to_blob(encoding):
+    if encoding is None:
+        return None
+    return np.asarray(encoding, dtype='<f8').tobytes()
+
+
+def blob_to_encoding(blob):
+    if blob is None:
+        return None
+    return np.frombuffer(blob, dtype='<f8')
+
+
+class UserStore:
+    # Enrolled users in SQLite (WAL mode).
+    #
+    # Registrations are single-row inserts instead of a rewrite of the whole
+    # users.json, and ids come from an AUTOINCREMENT key so they are
+    # monotonic and never reused, even across concurrent registrations or
+    # after deletions. Each thread gets its own connection; WAL lets readers
+    # proceed while a registration commits.
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.executescript(SCHEMA)
+            # Databases created before multi-sample templates
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(users)')}
+            if 'sample_count' not in columns:
+                conn.execute('ALTER TABLE users ADD COLUMN sample_count INTEGER NOT NULL DEFAULT 1')
+            # ... and before queued imports
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(imports)')}
+            if 'status' not in columns:
+                conn.execute('ALTER TABLE imports ADD COLUMN status TEXT')
+                conn.execute('ALTER TABLE imports ADD COLUMN message TEXT')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def add_user(self, name, face_encoding, registered_at=None, exemplars=None, sample_count=1):
+        # Insert a user and return the newly assigned id as a string.
+        # face_encoding is the template centroid of sample_count samples, of
+        # which exemplars (if any) are kept
+        registered_at = registered_at or datetime.now().isoformat()
+        with self._connection() as conn:
+            cursor = conn.execute(
+                'INSERT INTO users (name, face_encoding, registered_at, sample_count) VALUES (?, ?, ?, ?)',
+                (name, encoding_to_blob(face_encoding), registered_at, sample_count))
+            if exemplars is not None:
+                conn.executemany(
+                    'INSERT INTO face_samples (user_id, face_encoding, added_at) VALUES (?, ?, ?)',
+                    [(cursor.lastrowid, encoding_to_blob(encoding), registered_at) for encoding in exemplars])
+        return str(cursor.lastrowid)
+
+    def add_samples(self, user_id, encodings, max_exemplars=5):
+        # Fold new samples into a user's template: the centroid becomes the
+        # mean of every sample so far and the exemplars are re-selected from
+        # the kept ones plus the new ones. Returns (centroid, sample count),
+        # or None if the user is unknown or has no encoding.
+        conn = self._connection()
+        now = datetime.now().isoformat()
+        with conn:
+            # Take the write lock first so concurrent additions cannot
+            # overwrite each other's centroid
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT face_encoding, sample_count FROM users WHERE id = ?',
+                               (int(user_id),)).fetchone()
+            if row is None or row[0] is None:
+                return None
+            current, count = blob_to_encoding(row[0]), row[1] or 1
+            kept = conn.execute('SELECT id, face_encoding FROM face_samples WHERE user_id = ? ORDER BY id',
+                                (int(user_id),)).fetchall()
+            candidates = [(sample_id, blob_to_encoding(blob)) for sample_id, blob in kept]
+            if not candidates and count == 1:
+                # A single-sample template is its own exemplar
+                candidates = [(None, current)]
+            candidates += [(None, np.asarray(encoding, dtype=np.float64)) for encoding in encodings]
+            chosen = set(select_exemplars([encoding for _, encoding in candidates], max_exemplars))
+
+            conn.executemany('DELETE FROM face_samples WHERE id = ?',
+                             [(sample_id,) for i, (sample_id, _) in enumerate(candidates)
+                              if sample_id is not None and i not in chosen])
+            conn.executemany('INSERT INTO face_samples (user_id, face_encoding, added_at) VALUES (?, ?, ?)',
+                             [(int(user_id), encoding_to_blob(encoding), now)
+                              for i, (sample_id, encoding) in enumerate(candidates)
+                              if sample_id is None and i in chosen])
+            template, count = update_centroid(current, count, encodings)
+            conn.execute('UPDATE users SET face_encoding = ?, sample_count = ? WHERE id = ?',
+                         (encoding_to_blob(template), count, int(user_id)))
+        return template, count
+
+    def load_exemplars(self, user_ids):
+        # Kept samples of the given users as float32 matrices, by user id;
+        # users enrolled from a single sample have none
+        user_ids = [int(user_id) for user_id in user_ids if str(user_id).isdigit()]
+        if not user_ids:
+            return {}
+        placeholders = ','.join('?' * len(user_ids))
+        rows = self._connection().execute(
+            f'SELECT user_id, face_encoding FROM face_samples WHERE user_id IN ({placeholders}) ORDER BY id',
+            user_ids)
+        exemplars = {}
+        for user_id, blob in rows:
+            exemplars.setdefault(str(user_id), []).append(blob_to_encoding(blob))
+        return {user_id: np.asarray(encodings, dtype=np.float32) for user_id, encodings in exemplars.items()}
+
+    def set_profile_picture(self, user_id, profile_picture):
+        with self._connection() as conn:
+            conn.execute('UPDATE users SET profile_picture = ? WHERE id = ?',
+                         (profile_picture, int(user_id)))
+
+    def _row_to_user(self, row):
+        encoding = blob_to_encoding(row['face_encoding'])
+        user = {
+            'name': row['name'],
+            'faceEncoding': encoding.tolist() if encoding is not None else None,
+            'registeredAt': row['registered_at'],
+        }
+        if row['profile_picture']:
+            user['profilePicture'] = row['profile_picture']
+        return user
+
+    def get_user(self, user_id):
+        # Same shape as a users.json entry, or None if the id is unknown
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return None
+        row = self._connection().execute(
+            'SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
+        return self._row_to_user(row) if row is not None else None
+
+    def get_profile_picture(self, user_id):
+        # Profile picture path of a user: None if the id is unknown, an empty
+        # string if the user has no picture
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return None
+        row = self._connection().execute(
+            'SELECT profile_picture FROM users WHERE id = ?', (user_id,)).fetchone()
+        return (row[0] or '') if row is not None else None
+
+    def count(self):
+        return self._connection().execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    def encoded_user_ids(self):
+        # Ids of every user that has a face encoding
+        rows = self._connection().execute(
+            'SELECT id FROM users WHERE face_encoding IS NOT NULL ORDER BY id')
+        return [str(user_id) for user_id, in rows]
+
+    def load_encodings(self, user_ids=None):
+        # Ids, float32 encodings and names of the given users (default: every
+        # user that has a face encoding), in a shape ready for
+        # FaceGallery.add_many()
+        query = 'SELECT id, face_encoding, name FROM users WHERE face_encoding IS NOT NULL'
+        conn = self._connection()
+        if user_ids is None:
+            rows = conn.execute(query + ' ORDER BY id').fetchall()
+        else:
+            user_ids = [int(user_id) for user_id in user_ids]
+            rows = []
+            for start in range(0, len(user_ids), 500):
+                chunk = user_ids[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                rows.extend(conn.execute(
+                    f'{query} AND id IN ({placeholders}) ORDER BY id', chunk).fetchall())
+        ids = [str(row[0]) for row in rows]
+        names = [row[2] for row in rows]
+        if not rows:
+            return ids, np.empty((0, 128), dtype=np.float32), names
+        encodings = np.asarray([blob_to_encoding(row[1]) for row in rows], dtype=np.float32)
+        return ids, encodings, names
+
+    def get_meta(self, key):
+        row = self._connection().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def migrate_from_json(self, json_path):
+        # One-shot import of the legacy users.json. Existing ids are kept and
+        # users saved without a faceEncoding are imported with a NULL
+        # encoding. Returns the number of users imported, or None if the
+        # migration already ran.
+        if self.get_meta('migrated_from_json') is not None or not os.path.exists(json_path):
+            return None
+        with open(json_path, 'r') as f:
+            users = json.load(f)
+
+        conn = self._connection()
+        with conn:
+            for user_id, user_data in users.items():
+                encoding = user_data.get('faceEncoding')
+                values = (
+                    user_data.get('name') or '',
+                    encoding_to_blob(encoding) if encoding else None,
+                    user_data.get('registeredAt') or datetime.now().isoformat(),
+                    user_data.get('profilePicture'),
+                )
+                if str(user_id).isdigit():
+                    conn.execute(
+                        'INSERT OR REPLACE INTO users (id, name, face_encoding, registered_at, profile_picture) '
+                        'VALUES (?, ?, ?, ?, ?)', (int(user_id),) + values)
+                else:
+                    conn.execute(
+                        'INSERT INTO users (name, face_encoding, registered_at, profile_picture) '
+                        'VALUES (?, ?, ?, ?)', values)
+            conn.execute('INSERT INTO meta (key, value) VALUES (?, ?)',
+                         ('migrated_from_json', datetime.now().isoformat()))
+        return len(users)
+
+    def create_job(self, job_id, name):
+        now = datetime.now().isoformat()
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO registration_jobs (id, name, status, created_at, updated_at) "
+                "VALUES (?, ?, 'queued', ?, ?)", (job_id, name, now, now))
+
+    def update_job(self, job_id, status, user_id=None, profile_picture=None, message=None):
+        # Fields left as None keep their current value
+        with self._connection() as conn:
+            conn.execute(
+                'UPDATE registration_jobs SET status = ?, user_id = COALESCE(?, user_id), '
+                'profile_picture = COALESCE(?, profile_picture), message = COALESCE(?, message), '
+                'updated_at = ? WHERE id = ?',
+                (status, int(user_id) if user_id is not None else None, profile_picture, message,
+                 datetime.now().isoformat(), job_id))
+
+    def get_job(self, job_id):
+        row = self._connection().execute(
+            'SELECT * FROM registration_jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            'jobId': row['id'],
+            'name': row['name'],
+            'status': row['status'],
+            'userId': str(row['user_id']) if row['user_id'] is not None else None,
+            'profilePicture': row['profile_picture'],
+            'message': row['message'],
+            'createdAt': row['created_at'],
+            'updatedAt': row['updated_at'],
+        }
+
+    def finish_interrupted_jobs(self):
+        # Close jobs a previous server run left unfinished: those not yet
+        # matchable failed, the others only lack their profile picture.
+        # Returns the number of jobs closed.
+        now = datetime.now().isoformat()
+        with self._connection() as conn:
+            failed = conn.execute(
+                "UPDATE registration_jobs SET status = 'failed', "
+                "message = 'Interrupted by a server restart', updated_at = ? "
+                "WHERE status IN ('queued', 'processing')", (now,)).rowcount
+            completed = conn.execute(
+                "UPDATE registration_jobs SET status = 'completed', "
+                "message = 'Profile picture was not saved', updated_at = ? "
+                "WHERE status = 'matchable'", (now,)).rowcount
+        return failed + completed
+
+    def use_liveness_nonce(self, nonce, expires_at):
+        # Record a liveness token's nonce as used; False if it already was.
+        # Nonces of expired tokens are pruned, as those tokens are refused
+        # anyway.
+        with self._connection() as conn:
+            conn.execute('DELETE FROM liveness_nonces WHERE expires_at < ?', (int(time.time()),))
+            inserted = conn.execute('INSERT OR IGNORE INTO liveness_nonces (nonce, expires_at) VALUES (?, ?)',
+                                    (nonce, expires_at)).rowcount
+        return inserted == 1
+
+    def get_liveness_state(self, session_id):
+        # Liveness state last saved for a detect-face session, or None
+        row = self._connection().execute(
+            'SELECT state FROM liveness_states WHERE session_id = ?', (session_id,)).fetchone()
+        return json.loads(row['state']) if row else None
+
+    def save_liveness_state(self, session_id, state, max_age):
+        # Save a session's liveness state, pruning those of sessions idle for
+        # more than max_age seconds
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute('DELETE FROM liveness_states WHERE updated_at < ?', (now - max_age,))
+            conn.execute('INSERT OR REPLACE INTO liveness_states (session_id, state, updated_at) VALUES (?, ?, ?)',
+                         (session_id, json.dumps(state), now))
+
+    def start_import(self, import_id, source=None):
+        # Create the import if it is new; returns its committed_at timestamp
+        # (None while it is still open)
+        with self._connection() as conn:
+            conn.execute('INSERT OR IGNORE INTO imports (id, source, created_at) VALUES (?, ?, ?)',
+                         (import_id, source, datetime.now().isoformat()))
+            row = conn.execute('SELECT committed_at FROM imports WHERE id = ?', (import_id,)).fetchone()
+        return row[0]
+
+    def get_import(self, import_id):
+        row = self._connection().execute(
+            'SELECT source, created_at, committed_at, status, message FROM imports WHERE id = ?',
+            (import_id,)).fetchone()
+        if row is None:
+            return None
+        return {
+            'importId': import_id,
+            'source': row['source'],
+            'status': row['status'],
+            'message': row['message'],
+            'createdAt': row['created_at'],
+            'committedAt': row['committed_at'],
+        }
+
+    def update_import(self, import_id, status, message=None):
+        with self._connection() as conn:
+            conn.execute('UPDATE imports SET status = ?, message = ? WHERE id = ?', (status, message, import_id))
+
+    def finish_interrupted_imports(self):
+        # Mark imports a previous server run left queued or running as
+        # interrupted; sending the same batch again with their id resumes
+        # them. Returns the number of imports marked.
+        with self._connection() as conn:
+            return conn.execute(
+                "UPDATE imports SET status = 'interrupted', "
+                "message = 'Interrupted by a server restart; send the batch again with this importId to resume' "
+                "WHERE status IN ('queued', 'processing')").rowcount
+
+    def staged_import_keys(self, import_id):
+        rows = self._connection().execute(
+            'SELECT item_key FROM import_items WHERE import_id = ?', (import_id,))
+        return {item_key for item_key, in rows}
+
+    def stage_import_items(self, import_id, items):
+        # Record encoded (or failed) items of an open import; items are dicts
+        # with key, name, status, message, encoding and picture
+        with self._connection() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO import_items '
+                '(import_id, item_key, name, status, message, face_encoding, staged_picture) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(import_id, item['key'], item.get('name'), item['status'], item.get('message'),
+                  encoding_to_blob(item.get('encoding')), item.get('picture'))
+                 for item in items])
+
+    def commit_import(self, import_id, picture_path):
+        # Create a user for every successfully encoded item of the import in
+        # one transaction. picture_path(user_id) gives each user's profile
+        # picture path. Returns (user_id, name, encoding, staged_picture,
+        # profile_picture) tuples for the users created; committing an import
+        # twice creates nothing the second time.
+        conn = self._connection()
+        created = []
+        with conn:
+            rows = conn.execute(
+                "SELECT item_key, name, face_encoding, staged_picture FROM import_items "
+                "WHERE import_id = ? AND status = 'ok' AND user_id IS NULL ORDER BY rowid",
+                (import_id,)).fetchall()
+            registered_at = datetime.now().isoformat()
+            for item_key, name, blob, staged_picture in rows:
+                user_id = conn.execute(
+                    'INSERT INTO users (name, face_encoding, registered_at) VALUES (?, ?, ?)',
+                    (name, blob, registered_at)).lastrowid
+                profile_picture = picture_path(str(user_id)) if staged_picture else None
+                conn.execute('UPDATE users SET profile_picture = ? WHERE id = ?', (profile_picture, user_id))
+                conn.execute('UPDATE import_items SET user_id = ? WHERE import_id = ? AND item_key = ?',
+                             (user_id, import_id, item_key))
+                created.append((str(user_id), name, blob_to_encoding(blob), staged_picture, profile_picture))
+            conn.execute('UPDATE imports SET committed_at = ? WHERE id = ? AND committed_at IS NULL',
+                         (registered_at, import_id))
+        return created
+
+    def import_items(self, import_id):
+        # Per-item outcome of an import, in staging order
+        rows = self._connection().execute(
+            'SELECT item_key, name, status, message, user_id FROM import_items '
+            'WHERE import_id = ? ORDER BY rowid', (import_id,))
+        return [{'key': key, 'name': name, 'status': status, 'message': message,
+                 'userId': str(user_id) if user_id is not None else None}
+                for key, name, status, message, user_id in rows]
+
+    def import_pictures(self, import_id):
+        # (staged_picture, profile_picture) of every user an import created
+        rows = self._connection().execute(
+            'SELECT i.staged_picture, u.profile_picture FROM import_items i '
+            'JOIN users u ON u.id = i.user_id '
+            'WHERE i.import_id = ? AND i.staged_picture IS NOT NULL', (import_id,))
+        return rows.fetchall()
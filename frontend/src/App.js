@@ -1,6 +1,12 @@
 import React, { useState, useRef, useEffect } from 'react';
 import './App.css';
 
+// Registration job polling: backoff from the initial to the maximum delay,
+// giving up after the timeout
+const REGISTRATION_POLL_INITIAL_MS = 250;
+const REGISTRATION_POLL_MAX_MS = 2000;
+const REGISTRATION_POLL_TIMEOUT_MS = 60000;
+
 function App() {
   const [name, setName] = useState('');
   const [message, setMessage] = useState('');
@@ -22,6 +28,15 @@ function App() {
   const videoRef = useRef(null);
   const canvasRef = useRef(null);
   const detectionInterval = useRef(null);
+  const detectionSocket = useRef(null);
+  // Latest liveness token earned by this camera session, sent with verification
+  const livenessToken = useRef(null);
+  // Identifies this camera session so the server can track the face between frames
+  const sessionId = useRef(
+    window.crypto && window.crypto.randomUUID
+      ? window.crypto.randomUUID()
+      : `${Date.now()}-${Math.random().toString(36).slice(2)}`
+  );
 
   const startCamera = async () => {
     try {
@@ -66,10 +81,72 @@ function App() {
     detectPort();
   }, []);
 
-  const startFaceDetection = () => {
-    if (detectionInterval.current) {
-      clearInterval(detectionInterval.current);
+  // Encode the current canvas contents as a JPEG blob for binary upload
+  const canvasToBlob = (quality) => new Promise((resolve, reject) => {
+    canvasRef.current.toBlob(
+      (blob) => (blob ? resolve(blob) : reject(new Error('Could not capture frame'))),
+      'image/jpeg',
+      quality
+    );
+  });
+
+  const handleDetectionResult = (data) => {
+    console.log('Face detection response:', data);
+    
+    setIsFaceDetected(data.faceDetected);
+    livenessToken.current = data.livenessToken || null;
+    if (data.faceQuality) {
+      setFaceQuality(data.faceQuality);
+      if (data.message) {
+        setMessage(data.message);
+      } else {
+        setMessage('');
+      }
+    } else if (data.message) {
+      setMessage(data.message);
+    }
+
+    // Update face position if detected
+    if (data.facePosition) {
+      setFacePosition(data.facePosition);
+      // Check if face is centered (within 30% of center)
+      const isCentered = 
+        Math.abs(data.facePosition.x) < 0.3 && 
+        Math.abs(data.facePosition.y) < 0.3 &&
+        Math.abs(data.facePosition.scale - 1) < 0.3;
+      
+      console.log('Face position:', data.facePosition);
+      console.log('Is centered:', isCentered);
+      
+      setIsFaceCentered(isCentered);
     }
+  };
+
+  // Open the streaming detection socket; resolves to null if the server
+  // does not support it, in which case detection falls back to HTTP polling
+  const openDetectionStream = () => new Promise((resolve) => {
+    let socket;
+    try {
+      socket = new WebSocket(
+        `ws://localhost:${serverPort}/api/detect-face/stream?sessionId=${encodeURIComponent(sessionId.current)}`);
+    } catch (err) {
+      resolve(null);
+      return;
+    }
+    socket.onopen = () => resolve(socket);
+    socket.onerror = () => resolve(null);
+    socket.onmessage = (event) => handleDetectionResult(JSON.parse(event.data));
+    socket.onclose = () => {
+      if (detectionSocket.current === socket) {
+        detectionSocket.current = null;
+      }
+    };
+  });
+
+  const startFaceDetection = async () => {
+    stopFaceDetection();
+    detectionSocket.current = await openDetectionStream();
+    console.log(detectionSocket.current ? 'Streaming frames for detection' : 'Polling for detection');
 
     detectionInterval.current = setInterval(async () => {
       if (!videoRef.current || !canvasRef.current) {
@@ -83,52 +160,34 @@ function App() {
         canvasRef.current.height = videoRef.current.videoHeight;
         context.drawImage(videoRef.current, 0, 0);
 
-        const imageData = canvasRef.current.toDataURL('image/jpeg', 0.8);
-        console.log('Sending image for detection, size:', imageData.length);
+        const imageBlob = await canvasToBlob(0.8);
+
+        const socket = detectionSocket.current;
+        if (socket && socket.readyState === WebSocket.OPEN) {
+          // Skip this frame while the previous one is still being sent;
+          // the server also drops frames it cannot keep up with
+          if (socket.bufferedAmount === 0) {
+            socket.send(imageBlob);
+          }
+          return;
+        }
+
+        console.log('Sending image for detection, size:', imageBlob.size);
 
         const response = await fetch(`http://localhost:${serverPort}/api/detect-face`, {
           method: 'POST',
           headers: {
-            'Content-Type': 'application/json',
+            'Content-Type': 'image/jpeg',
+            'X-Session-Id': sessionId.current,
           },
-          body: JSON.stringify({
-            image: imageData
-          })
+          body: imageBlob
         });
 
         if (!response.ok) {
           throw new Error(`HTTP error! status: ${response.status}`);
         }
 
-        const data = await response.json();
-        console.log('Face detection response:', data);
-        
-        setIsFaceDetected(data.faceDetected);
-        if (data.faceQuality) {
-          setFaceQuality(data.faceQuality);
-          if (data.message) {
-            setMessage(data.message);
-          } else {
-            setMessage('');
-          }
-        } else if (data.message) {
-          setMessage(data.message);
-        }
-
-        // Update face position if detected
-        if (data.facePosition) {
-          setFacePosition(data.facePosition);
-          // Check if face is centered (within 30% of center)
-          const isCentered = 
-            Math.abs(data.facePosition.x) < 0.3 && 
-            Math.abs(data.facePosition.y) < 0.3 &&
-            Math.abs(data.facePosition.scale - 1) < 0.3;
-          
-          console.log('Face position:', data.facePosition);
-          console.log('Is centered:', isCentered);
-          
-          setIsFaceCentered(isCentered);
-        }
+        handleDetectionResult(await response.json());
       } catch (err) {
         console.error('Face detection error:', err);
         if (err.message.includes('Failed to fetch') || err.message.includes('ERR_CONNECTION_REFUSED')) {
@@ -147,6 +206,11 @@ function App() {
       clearInterval(detectionInterval.current);
       detectionInterval.current = null;
     }
+    if (detectionSocket.current) {
+      const socket = detectionSocket.current;
+      detectionSocket.current = null;
+      socket.close();
+    }
   };
 
   useEffect(() => {
@@ -185,25 +249,37 @@ function App() {
     setMessage('Processing...');
     
     try {
-      const response = await fetch(`http://localhost:${serverPort}/api/register`, {
+      const formData = new FormData();
+      formData.append('name', name);
+      formData.append('image', await (await fetch(capturedImage)).blob(), 'capture.jpg');
+
+      // Registration runs in the background; poll the job until it is done
+      const response = await fetch(`http://localhost:${serverPort}/api/registrations`, {
         method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-          name: name,
-          image: capturedImage
-        })
+        body: formData
       });
       
-      const data = await response.json();
-      if (data.success) {
-        // Fetch and display profile picture
-        const picResponse = await fetch(`http://localhost:${serverPort}/api/profile-picture/${data.userId}`);
-        const picData = await picResponse.json();
-        if (picData.success) {
-          setProfilePicture(picData.image);
+      let data = await response.json();
+      const jobId = data.jobId;
+      let delay = REGISTRATION_POLL_INITIAL_MS;
+      let waited = 0;
+      while (data.success && data.status !== 'completed' && data.status !== 'failed') {
+        if (waited >= REGISTRATION_POLL_TIMEOUT_MS) {
+          // The job may have been lost, e.g. by a server restart
+          data = { success: false, message: 'Registration is taking too long. Please check the user list or try again.' };
+          break;
         }
+        await new Promise(resolve => setTimeout(resolve, delay));
+        waited += delay;
+        delay = Math.min(delay * 2, REGISTRATION_POLL_MAX_MS);
+        data = await (await fetch(`http://localhost:${serverPort}/api/registrations/${jobId}`)).json();
+      }
+      if (data.status === 'failed') {
+        data = { success: false, message: data.message || 'Registration failed' };
+      }
+      if (data.success) {
+        // Display the profile picture; the browser fetches and caches it
+        setProfilePicture(`http://localhost:${serverPort}/api/profile-picture/${data.userId}/image?size=medium`);
         // Reset form for new registration
         setName('');
         setMessage('Registration successful! You can register another person now.');
@@ -247,16 +323,18 @@ function App() {
       canvasRef.current.height = videoRef.current.videoHeight;
       context.drawImage(videoRef.current, 0, 0);
       
-      const imageData = canvasRef.current.toDataURL('image/jpeg');
+      const imageBlob = await canvasToBlob(0.92);
       
+      // Liveness tokens are bound to this session and accepted only once
+      const headers = { 'Content-Type': 'image/jpeg', 'X-Session-Id': sessionId.current };
+      if (livenessToken.current) {
+        headers['X-Liveness-Token'] = livenessToken.current;
+        livenessToken.current = null;
+      }
       const response = await fetch(`http://localhost:${serverPort}/api/verify`, {
         method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-          image: imageData
-        })
+        headers,
+        body: imageBlob
       });
       
       const data = await response.json();